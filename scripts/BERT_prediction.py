@@ -1,117 +1,397 @@
-from transformers import AutoTokenizer, AutoModelForTokenClassification
-import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from prediction_cache import PredictionCache, model_fingerprint
+from prediction_store import CONFIDENCE_SUFFIX, STORE_SUFFIX, encode_confidences, encode_prediction_store, \
+    remove_confidences, write_confidences, write_prediction_store
+from batching import BatchScheduler, summarize_batches
+from labels import label_to_index, index_to_label
+from instrumentation import available_memory_kb, context_from_filename, profiler
+from manifest import file_hash, load_manifest, record_unit, save_manifest, unit_changed
+import multiprocessing
+import io
 import os
 
-# Define a dictionary to map labels to indices
-label_to_index = {'ARG0': 0, 'ARG1': 1, 'ARG1-DSP': 2, 'ARG2': 3, 'ARG3': 4, 'ARG4': 5, 'ARG5': 6, 'ARGA': 7,
-                      'ARGM-ADJ': 8, 'ARGM-ADV': 9, 'ARGM-CAU': 10, 'ARGM-COM': 11, 'ARGM-CXN': 12, 'ARGM-DIR': 13,
-                      'ARGM-DIS': 14, 'ARGM-EXT': 15, 'ARGM-GOL': 16, 'ARGM-LOC': 17, 'ARGM-LVB': 18, 'ARGM-MNR': 19,
-                      'ARGM-MOD': 20, 'ARGM-NEG': 21, 'ARGM-PRD': 22, 'ARGM-PRP': 23, 'ARGM-PRR': 24, 'ARGM-REC': 25,
-                      'ARGM-TMP': 26, 'C-ARG0': 27, 'C-ARG1': 28, 'C-ARG1-DSP': 29, 'C-ARG2': 30, 'C-ARG3': 31,
-                      'C-ARG4': 32, 'C-ARGM-ADV': 33, 'C-ARGM-COM': 34, 'C-ARGM-CXN': 35, 'C-ARGM-DIR': 36,
-                      'C-ARGM-EXT': 37, 'C-ARGM-GOL': 38, 'C-ARGM-LOC': 39, 'C-ARGM-MNR': 40, 'C-ARGM-PRP': 41,
-                      'C-ARGM-PRR': 42, 'C-ARGM-TMP': 43, 'R-ARG0': 44, 'R-ARG1': 45, 'R-ARG2': 46, 'R-ARG3': 47,
-                      'R-ARG4': 48, 'R-ARGM-ADJ': 49, 'R-ARGM-ADV': 50, 'R-ARGM-CAU': 51, 'R-ARGM-COM': 52,
-                      'R-ARGM-DIR': 53, 'R-ARGM-GOL': 54, 'R-ARGM-LOC': 55, 'R-ARGM-MNR': 56, 'R-ARGM-TMP': 57, '_': 58}
-index_to_label = {v: k for k, v in label_to_index.items()}
+# Inference backends, from the reference fp32 eager mode to the faster but less exact ones. They are implemented in
+# inference_backends.py, which needs torch; the names are kept here so that they can be checked without it.
+BACKENDS = ('fp32', 'int8', 'bf16', 'trace', 'compile')
+# Memory a worker needs per byte of model files: the weights and the activations of its batches
+MODEL_MEMORY_FACTOR = 2
 
 
-def determine_label(subtoken_labels):
+# Ways of pooling the subtoken labels of a word into its label (see align_word_labels)
+POOLING_METHODS = ('majority', 'first')
+
+
+def word_slots(word_ids, words):
     """
-    Determine the most common label among the subtoken labels.
+    Number the (row, word) slots of a batch for scatter operations over its subtokens.
+
+    Word w of row r gets slot r * (words + 1) + w. Subtokens outside of any word (special tokens and padding)
+    go to an extra slot after the words of their row.
 
     Args:
-        subtoken_labels (list): List of labels for the subtokens.
+        word_ids (list): The word index of every subtoken of every row (None for special tokens and padding).
+        words (int): Number of word slots per row, at least the number of words of the longest sentence.
 
     Returns:
-        The most common label among the subtoken labels.
+        A flat tensor with the slot of every subtoken of the batch.
     """
-    return max(set(subtoken_labels), key=subtoken_labels.count)
+    import torch
+
+    slots = torch.tensor([[words if word_index is None else word_index for word_index in row_word_ids]
+                          for row_word_ids in word_ids])
+    return (slots + torch.arange(len(word_ids))[:, None] * (words + 1)).view(-1)
+
 
-def bert_e2e(model, tokenizer, index_to_label, input_file_path, output_file_path):
+def align_word_labels(predictions, word_ids, words, label_count, pooling='majority'):
     """
-    Perform end-to-end prediction using a BERT model.
+    Pool the subtoken label predictions of a batch into word labels with scatter operations over the whole batch.
+
+    With 'majority' pooling, a word gets the label predicted for most of its subtokens; on a tie, the label
+    that occurs first among its subtokens wins. With 'first' pooling, a word gets the label of its first
+    subtoken.
+
+    Args:
+        predictions (Tensor): The predicted label index of every subtoken, of shape (rows, subtokens).
+        word_ids (list): The word index of every subtoken of every row (None for special tokens and padding).
+        words (int): Number of words of the longest sentence of the batch.
+        label_count (int): Number of labels of the model.
+        pooling (str): One of POOLING_METHODS.
+
+    Returns:
+        A tensor of shape (rows, words) with the label index of every word, -1 for words without subtokens.
+    """
+    import torch
+
+    if pooling not in POOLING_METHODS:
+        raise ValueError(f"Unknown pooling method {pooling!r}, expected one of {POOLING_METHODS}")
+    rows, subtokens = predictions.shape
+    slot_count = rows * (words + 1)
+    slots = word_slots(word_ids, words)
+    predictions = predictions.reshape(-1)
+    positions = torch.arange(rows * subtokens)
+    # The position of the first subtoken of every slot, past the end for empty slots
+    first = torch.full((slot_count,), rows * subtokens).scatter_reduce_(0, slots, positions, 'amin')
+    if pooling == 'first':
+        labels = predictions[first.clamp(max=rows * subtokens - 1)]
+    else:
+        # Count every label per slot, and find the position where it first occurs in the slot
+        slot_labels = slots * label_count + predictions
+        counts = torch.bincount(slot_labels, minlength=slot_count * label_count)
+        first_label = torch.full((slot_count * label_count,), rows * subtokens).scatter_reduce_(
+            0, slot_labels, positions, 'amin')
+        # Rank by count, then by first occurrence; labels that do not occur rank lowest
+        rank = counts * (rows * subtokens + 1) + (rows * subtokens - first_label)
+        labels = rank.view(slot_count, label_count).argmax(dim=1)
+    labels = labels.masked_fill(first == rows * subtokens, -1)
+    return labels.view(rows, words + 1)[:, :words]
+
+
+def word_confidences(probabilities, word_ids, word_label_ids):
+    """
+    Aggregate subtoken label probabilities into a confidence for every word label of a batch.
+
+    The confidence of a word comes from the subtokens that predicted its label, i.e. the subtokens that carried
+    the vote of align_word_labels. For each of them, the probability of the label and its margin over the most
+    probable other label are taken, and both are averaged over those subtokens with a single index_add over the
+    whole batch. Since the label is the most probable one for each of these subtokens, the margin is never
+    negative, and a small margin means the word label only just won.
+
+    Args:
+        probabilities (Tensor): Label probabilities of shape (rows, subtokens, labels).
+        word_ids (list): The word index of every subtoken of every row (None for special tokens and padding).
+        word_label_ids (list): The label index of every word of every row (None for words without subtokens).
+
+    Returns:
+        A list with a (probability, margin) tuple for every word of every row (None for words without subtokens).
+    """
+    import torch
+
+    rows, subtokens, label_count = probabilities.shape
+    words = max(len(row_label_ids) for row_label_ids in word_label_ids)
+    slots = word_slots(word_ids, words)
+    # The label of every word slot, -1 for the extra slots and words without a label
+    slot_labels = torch.tensor([[-1 if label_index is None else label_index for label_index in row_label_ids]
+                                + [-1] * (words + 1 - len(row_label_ids)) for row_label_ids in word_label_ids])
+    labels = slot_labels.view(-1)[slots]
+
+    # Probability and margin of the word label for every subtoken that predicted it
+    flat = probabilities.reshape(-1, label_count)
+    voted = (flat.argmax(dim=1) == labels) & (labels >= 0)
+    label_probability = flat.gather(1, labels.clamp(min=0)[:, None]).squeeze(1)
+    runner_up = flat.scatter(1, labels.clamp(min=0)[:, None], -1.0).max(dim=1).values
+    values = torch.stack([label_probability, label_probability - runner_up], dim=1) * voted[:, None]
+
+    sums = torch.zeros(rows * (words + 1), 2).index_add_(0, slots, values)
+    counts = torch.bincount(slots, weights=voted.float(), minlength=rows * (words + 1)).clamp(min=1)
+    mean = (sums / counts[:, None]).view(rows, words + 1, 2)[:, :words]
+    probability, margin = mean[..., 0], mean[..., 1]
+
+    return [[None if label_index is None else (row_probability[word_index], row_margin[word_index])
+             for word_index, label_index in enumerate(row_label_ids)]
+            for row_label_ids, row_probability, row_margin
+            in zip(word_label_ids, probability.tolist(), margin.tolist())]
+
+
+def pad_batch(encoded, positions, pad_token_id):
+    """
+    Pad some sentences of a tokenized (unpadded) batch on the right to the longest of them.
+
+    Args:
+        encoded (BatchEncoding): The tokenizer output for a list of sentences.
+        positions (list): Positions of the sentences to pad in encoded.
+        pad_token_id (int): Id of the tokenizer's padding token.
+
+    Returns:
+        A tuple of the model inputs as tensors and the word index of every subtoken of every row (None for special
+        tokens and padding), as word_ids() would give for the padded batch.
+    """
+    import torch
+
+    length = max(len(encoded['input_ids'][position]) for position in positions)
+    inputs = {}
+    for name, values in encoded.items():
+        pad = pad_token_id if name == 'input_ids' else 0
+        inputs[name] = torch.tensor([values[position] + [pad] * (length - len(values[position]))
+                                     for position in positions])
+    word_ids = [encoded.word_ids(position) + [None] * (length - len(encoded['input_ids'][position]))
+                for position in positions]
+    return inputs, word_ids
+
+
+def predict_word_labels(model, tokenizer, index_to_label, sentences, batch_size=32, cache=None,
+                        with_confidence=False, pooling='majority', scheduler=None):
+    """
+    Predict a label for every word of every sentence using batched, padded inference.
+
+    Sentences are tokenized once, sorted by their length in subtokens and cut into batches of similar
+    length by the batch scheduler, so padding stays low.
+    Each batch is fed to the model in a single forward pass, and the subtoken predictions of the whole
+    batch are pooled into word labels with the tokenizer's word_ids() (see align_word_labels). If a
+    prediction cache is given, sentences predicted before are taken from it and only the others are
+    run through the model.
 
     Args:
         model (AutoModelForTokenClassification): The BERT model.
+        tokenizer (AutoTokenizer): The tokenizer (must be a fast tokenizer for word_ids()).
+        index_to_label (dict): Mapping from indices to labels.
+        sentences (list): List of sentences, each a list of words.
+        batch_size (int): Maximum number of sentences per forward pass, if no scheduler is given.
+        cache (PredictionCache): Optional prediction cache for this model.
+        with_confidence (bool): Whether to also compute the confidence of every word label from the logits of the
+            same forward passes (see word_confidences). The cache holds no confidences, so it is not used then.
+        pooling (str): How the subtoken labels of a word are pooled, one of POOLING_METHODS. The cache holds
+            majority-pooled labels, so it is only used with 'majority'.
+        scheduler (BatchScheduler): Optional scheduler that cuts the sentences into batches, e.g. by a token
+            budget (see batching.py); it records the statistics of every batch. Defaults to batches of batch_size.
+
+    Returns:
+        A list with the word labels of each sentence, in the same order as the input sentences.
+        Words without any subtoken (e.g. cut off by truncation) get the label None.
+        With with_confidence, a tuple of that list and a list with the (probability, margin) of every word
+        of each sentence (None for words without any subtoken).
+    """
+    import torch
+
+    # Initialize the output lists, filled in batch by batch
+    all_word_labels = [None] * len(sentences)
+    all_word_confidences = [None] * len(sentences)
+    if pooling != 'majority':
+        cache = None
+    if with_confidence:
+        cache = None
+        label_indices = {label: index for index, label in index_to_label.items()}
+    # Indices of the sentences that have to be run through the model
+    pending = range(len(sentences))
+    if cache is not None:
+        # Take the sentences that were predicted before from the cache
+        with profiler.stage('cache_lookup'):
+            all_word_labels = cache.get_many(sentences)
+        pending = [index for index, word_labels in enumerate(all_word_labels) if word_labels is None]
+    # Tokenize all sentences to be predicted at once, without padding, to learn their lengths in subtokens
+    with profiler.stage('hf_tokenize'):
+        encoded = None
+        if len(pending):
+            encoded = tokenizer([sentences[index] for index in pending], is_split_into_words=True, truncation=True)
+    positions = {index: position for position, index in enumerate(pending)}
+    lengths = {index: len(encoded['input_ids'][position]) for index, position in positions.items()}
+    # Sort the sentence indices by length so that every batch holds sentences of similar length
+    order = sorted(pending, key=lambda index: lengths[index])
+    if scheduler is None:
+        scheduler = BatchScheduler(batch_size)
+
+    # Set the model to evaluation mode once for the whole run
+    model.eval()
+    # Iterate over the length-sorted sentences one batch at a time, as cut by the scheduler
+    for batch_indices in scheduler.batches(order, lengths):
+        # Pad the batch to its longest sentence
+        with profiler.stage('pad_batch'):
+            inputs, batch_word_ids = pad_batch(encoded, [positions[index] for index in batch_indices],
+                                               tokenizer.pad_token_id)
+            words = max(len(sentences[index]) for index in batch_indices)
+        # Disable gradient calculation and feed the batch to the model
+        with profiler.stage('forward'), scheduler.timed(len(batch_indices), inputs['input_ids'].numel()), \
+                torch.no_grad():
+            outputs = model(**inputs)
+            # Get the predicted labels by finding the maximum value in the logits
+            predictions = torch.argmax(outputs.logits, dim=-1)
+            if with_confidence:
+                probabilities = torch.softmax(outputs.logits.float(), dim=-1)
+
+        # Map the subtoken predictions of every row back to the words of its sentence
+        with profiler.stage('merge_labels'):
+            word_labels = align_word_labels(predictions, batch_word_ids, words, len(index_to_label), pooling)
+            for sentence_index, row_labels in zip(batch_indices, word_labels.tolist()):
+                all_word_labels[sentence_index] = [None if label_index < 0 else index_to_label[label_index]
+                                                   for label_index in row_labels[:len(sentences[sentence_index])]]
+
+        if with_confidence:
+            with profiler.stage('word_confidences'):
+                batch_confidences = word_confidences(
+                    probabilities, batch_word_ids,
+                    [[None if label is None else label_indices[label] for label in all_word_labels[index]]
+                     for index in batch_indices])
+            for sentence_index, confidences in zip(batch_indices, batch_confidences):
+                all_word_confidences[sentence_index] = confidences
+
+    # Store the new predictions in the cache
+    if cache is not None and order:
+        with profiler.stage('cache_store'):
+            cache.put_many([sentences[index] for index in order], [all_word_labels[index] for index in order])
+
+    if with_confidence:
+        return all_word_labels, all_word_confidences
+    return all_word_labels
+
+def bert_e2e(model, tokenizer, index_to_label, input_file_path, output_file_path, batch_size=32, cache=None,
+             with_confidence=False, pooling='majority', scheduler=None):
+    """
+    Perform end-to-end prediction using a BERT model.
+
+    Args:
+        model (AutoModelForTokenClassification): The BERT model, or a model prepared for a faster
+            inference backend with inference_backends.prepare_model.
         tokenizer (AutoTokenizer): The tokenizer.
         index_to_label (dict): Mapping from indices to labels.
         input_file_path (str): Path to the input file.
-        output_file_path (str): Path to the output file.
+        output_file_path (str): Path to the output file; predictions are written as a binary prediction store
+            (see prediction_store.py) if it ends with STORE_SUFFIX, else in the 5-column conllu layout.
+        batch_size (int): Maximum number of sentences per forward pass.
+        cache (PredictionCache): Optional prediction cache for this model, consulted before running the model.
+        with_confidence (bool): Whether to also write the confidence of every word label to a sidecar file
+            (output_file_path followed by CONFIDENCE_SUFFIX, see prediction_store.encode_confidences).
+        pooling (str): How the subtoken labels of a word are pooled into its label (see align_word_labels).
+        scheduler (BatchScheduler): Optional scheduler that cuts the sentences into batches (see batching.py),
+            used instead of batches of batch_size sentences.
         This function is created by using ChatGPT4 with prompting
         "Create a function that takes a BERT model, a tokenizer, a dictionary mapping indices to labels,
         an input file path, and an output file path, and performs end-to-end prediction using the BERT model
         on the input file, writing the output to the output file." and modified manually in accordance with the specific needs.
     """
-    # Read sentences and their gold labels from the input file
-    sentence_list, gold_list = read_sentences_from_file(input_file_path)
-
-    # Open the output file in write mode with UTF-8 encoding
-    with open(output_file_path, 'w', encoding='utf-8') as output_file:
-        # Initialize sentence ID
-        sentence_id = 1
-        # Iterate over each sentence and its corresponding gold labels
-        for sentence, gold_labels in zip(sentence_list, gold_list):
-            # Tokenize the sentence and prepare it for the model
-            inputs = tokenizer(sentence, is_split_into_words=True, return_tensors="pt", padding=True, truncation=True,
-                               return_offsets_mapping=True)
-            # Get the offset mapping from the inputs and remove it from the inputs
-            offset_mapping = inputs.pop('offset_mapping')
-
-            # Set the model to evaluation mode
-            model.eval()
-            # Disable gradient calculation
-            with torch.no_grad():
-                # Feed the inputs to the model and get the outputs
-                outputs = model(**inputs)
-            # Get the logits from the outputs
-            logits = outputs.logits
-            # Get the predicted labels by finding the maximum value in the logits
-            predictions = torch.argmax(logits, dim=-1)
-
-            # Initialize a list to hold the labels for each word in the sentence
-            word_labels = [None] * len(sentence)
-            # Initialize the current word index
-            current_word_index = 0
-            # Initialize a list to hold the labels for each subtoken in a word
-            subtoken_labels = []
-
-            # Iterate over each subtoken, its offset, and its predicted label
-            for idx, ((start, end), pred) in enumerate(zip(offset_mapping[0], predictions[0])):
-                # If the start and end offsets are both 0, skip this subtoken
-                if start == end == 0:
-                    continue
-
-                # Get the label corresponding to the predicted index
-                label = index_to_label[pred.item()]
-
-                # If the start offset is 0 and there are already some subtoken labels,
-                # determine the label for the current word, increment the word index, and reset the subtoken labels
-                if start == 0 and subtoken_labels:
-                    word_labels[current_word_index] = determine_label(subtoken_labels)
-                    current_word_index += 1
-                    subtoken_labels = []
-                # Add the label for the current subtoken to the list of subtoken labels
-                subtoken_labels.append(label)
-
-            # If there are any remaining subtoken labels, determine the label for the current word
-            if subtoken_labels:
-                word_labels[current_word_index] = determine_label(subtoken_labels)
-
-            # Iterate over each token, its system label, and its gold label
-            for token_id, (token, system_label, gold_label) in enumerate(zip(sentence, word_labels, gold_labels)):
-                # If the token is "[SEP]", break the loop
-                if token == "[SEP]":
-                    break
-                # If the token starts with "[PRED] ", remove this prefix
-                if token[0:7] == "[PRED] ":
-                    token = token[7:]
-                    # Write the sentence ID, token ID, token, gold label, and system label to the output file
-                output_file.write(f"{sentence_id}\t{token_id+1}\t{token}\t{gold_label}\t{system_label}\n")
-            # Write an empty line to the output file to separate sentences
-            output_file.write("\n")  # Separate sentences with an empty line
-            # Increment the sentence ID
-            sentence_id += 1
+    # Attribute the profiled stages to the (version, capability, test_type) of the file
+    with profiler.context(**context_from_filename(input_file_path)):
+        # Read sentences and their gold labels from the input file
+        with profiler.stage('read_input'):
+            sentence_list, gold_list = read_sentences_from_file(input_file_path)
+        profiler.count(len(sentence_list))
+        # Predict the word labels of all sentences in batches
+        word_labels_list = predict_word_labels(model, tokenizer, index_to_label, sentence_list, batch_size, cache,
+                                               with_confidence, pooling, scheduler)
+        if with_confidence:
+            word_labels_list, word_confidences_list = word_labels_list
+
+        with profiler.stage('write_predictions'):
+            if output_file_path.endswith(STORE_SUFFIX):
+                write_prediction_store(output_file_path,
+                                       prediction_sentences(sentence_list, gold_list, word_labels_list))
+            else:
+                # Open the output file in write mode with UTF-8 encoding and write the predictions to it
+                with open(output_file_path, 'w', encoding='utf-8') as output_file:
+                    write_predictions(output_file, sentence_list, gold_list, word_labels_list)
+            if with_confidence:
+                write_confidences(output_file_path + CONFIDENCE_SUFFIX,
+                                  prediction_sentences(sentence_list, gold_list, word_confidences_list))
+            else:
+                remove_confidences(output_file_path)
+
+def prediction_sentences(sentence_list, gold_list, word_labels_list):
+    """
+    Arrange predictions into the rows that are written to a predictions file.
+
+    Sentences are numbered from 1, tokens from the [SEP] token on are left out and the "[PRED] "
+    prefix is removed from tokens.
+
+    Args:
+        sentence_list (list): List of sentences, each a list of words.
+        gold_list (list): List of gold labels for each sentence.
+        word_labels_list (list): List of predicted word labels for each sentence.
+
+    Yields:
+        A tuple (sentence_id, rows) for each sentence, where rows is a list of
+        (token_id, token, gold_label, system_label) tuples.
+    """
+    # Iterate over each sentence, its gold labels and its predicted labels
+    for sentence_id, (sentence, gold_labels, word_labels) in enumerate(zip(sentence_list, gold_list,
+                                                                            word_labels_list), start=1):
+        rows = []
+        # Iterate over each token, its system label, and its gold label
+        for token_id, (token, system_label, gold_label) in enumerate(zip(sentence, word_labels, gold_labels)):
+            # If the token is "[SEP]", break the loop
+            if token == "[SEP]":
+                break
+            # If the token starts with "[PRED] ", remove this prefix
+            if token[0:7] == "[PRED] ":
+                token = token[7:]
+            rows.append((token_id + 1, token, gold_label, system_label))
+        yield sentence_id, rows
+
+def write_predictions(output_file, sentence_list, gold_list, word_labels_list):
+    """
+    Write predictions in the 5-column format (sentence ID, token ID, token, gold label, system label).
+
+    Args:
+        output_file (file): An open, writable text file (or any object with a write method).
+        sentence_list (list): List of sentences, each a list of words.
+        gold_list (list): List of gold labels for each sentence.
+        word_labels_list (list): List of predicted word labels for each sentence.
+    """
+    for sentence_id, rows in prediction_sentences(sentence_list, gold_list, word_labels_list):
+        for token_id, token, gold_label, system_label in rows:
+            # Write the sentence ID, token ID, token, gold label, and system label to the output file
+            output_file.write(f"{sentence_id}\t{token_id}\t{token}\t{gold_label}\t{system_label}\n")
+        # Write an empty line to the output file to separate sentences
+        output_file.write("\n")
+
+def backend_fingerprint(fingerprint, backend):
+    """
+    Combine a model fingerprint with the inference backend, so that the prediction cache and the run
+    manifest do not mix up predictions of different backends. fp32 keeps the plain model fingerprint.
+
+    Args:
+        fingerprint (str): The model fingerprint (see prediction_cache.model_fingerprint).
+        backend (str): The inference backend.
+
+    Returns:
+        The fingerprint of the model run with the backend.
+    """
+    return fingerprint if backend == 'fp32' else f'{fingerprint}:{backend}'
+
+
+def output_filename(filename, output_format='conllu'):
+    """
+    Get the name of the predictions file of an input file.
+
+    Args:
+        filename (str): Name of the input file ('{capability}_{test_type}_V{version}.conllu').
+        output_format (str): 'conllu' for the 5-column text layout, or 'store' for a binary prediction store.
+
+    Returns:
+        The input filename for 'conllu', or the filename with STORE_SUFFIX for 'store'.
+    """
+    if output_format == 'conllu':
+        return filename
+    if output_format == 'store':
+        return os.path.splitext(filename)[0] + STORE_SUFFIX
+    raise ValueError(f"Unknown output format: {output_format}")
 
 def read_sentences_from_file(file_path):
     """
@@ -120,6 +400,20 @@ def read_sentences_from_file(file_path):
     Args:
         file_path (str): Path to the file.
 
+    Returns:
+        A tuple of two lists: The first list contains the sentences, and the second list contains the gold labels.
+    """
+    # Open the file in read mode with UTF-8 encoding
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return read_sentences(file)
+
+def read_sentences(lines):
+    """
+    Read sentences and their gold labels from the lines of a conllu input file.
+
+    Args:
+        lines (iterable): The lines, e.g. an open file or the lines of a conllu text.
+
     Returns:
         A tuple of two lists: The first list contains the sentences, and the second list contains the gold labels.
     """
@@ -129,38 +423,38 @@ def read_sentences_from_file(file_path):
     current_sentence_tokens = []
     current_sentence_gold = []
 
-    # Open the file in read mode with UTF-8 encoding
-    with open(file_path, 'r', encoding='utf-8') as file:
-        # Iterate over each line in the file
-        for line in file:
-            # If the line is empty (i.e., it's the end of a sentence)
-            if line.strip() == "":
-                # If there are tokens in the current sentence
-                if current_sentence_tokens:
-                    # Add the current sentence tokens and gold labels to their respective lists
-                    sentences.append(current_sentence_tokens)
-                    gold_list.append(current_sentence_gold)
-                    # Reset the current sentence tokens and gold labels
-                    current_sentence_tokens = []
-                    current_sentence_gold = []
-            else:
-                # If the line is not empty, it contains a token and its gold label
-                # Split the line on tabs and get the token and gold label
-                token, gold = line.strip().split('\t')[2:4]
-                # Add the token and gold label to their respective lists
-                current_sentence_tokens.append(token)
-                current_sentence_gold.append(gold)
-
-        # If there are tokens left in the current sentence after reading the entire file
-        if current_sentence_tokens:
-            # Add the remaining tokens and gold labels to their respective lists
-            sentences.append(current_sentence_tokens)
-            gold_list.append(current_sentence_gold)
+    # Iterate over each line
+    for line in lines:
+        # If the line is empty (i.e., it's the end of a sentence)
+        if line.strip() == "":
+            # If there are tokens in the current sentence
+            if current_sentence_tokens:
+                # Add the current sentence tokens and gold labels to their respective lists
+                sentences.append(current_sentence_tokens)
+                gold_list.append(current_sentence_gold)
+                # Reset the current sentence tokens and gold labels
+                current_sentence_tokens = []
+                current_sentence_gold = []
+        else:
+            # If the line is not empty, it contains a token and its gold label
+            # Split the line on tabs and get the token and gold label
+            token, gold = line.strip().split('\t')[2:4]
+            # Add the token and gold label to their respective lists
+            current_sentence_tokens.append(token)
+            current_sentence_gold.append(gold)
+
+    # If there are tokens left in the current sentence after reading all lines
+    if current_sentence_tokens:
+        # Add the remaining tokens and gold labels to their respective lists
+        sentences.append(current_sentence_tokens)
+        gold_list.append(current_sentence_gold)
 
     # Return the sentences and gold labels
     return sentences, gold_list
 
-def process_all_files(input_directory, output_directory, model, tokenizer, index_to_label, version):
+def process_all_files(input_directory, output_directory, model, tokenizer, index_to_label, version, batch_size=32,
+                      cache=None, manifest_path=None, backend='fp32', output_format='conllu', with_confidence=False,
+                      scheduler=None):
     """
         Process all files in a directory using a BERT model.
 
@@ -171,28 +465,358 @@ def process_all_files(input_directory, output_directory, model, tokenizer, index
             tokenizer (AutoTokenizer): The tokenizer.
             index_to_label (dict): Mapping from indices to labels.
             version (int): Version number.
+            batch_size (int): Maximum number of sentences per forward pass.
+            cache (PredictionCache): Optional prediction cache for this model, keyed with the
+                inference_backends.backend_fingerprint of the model and backend.
+            manifest_path (str): Optional path to the run manifest. If given, only files whose input or model
+                changed since the last run (or whose predictions are missing or modified) are predicted.
+            backend (str): Inference backend, one of inference_backends.BACKENDS (default: fp32 eager mode).
+            output_format (str): 'conllu' (default) or 'store' to write binary prediction stores.
+            with_confidence (bool): Whether to write a confidence sidecar next to every predictions file.
+            scheduler (BatchScheduler): Optional batch scheduler shared by all files, e.g. with a token budget
+                (see batching.py).
         """
+    # Imported here, inference_backends builds on this module
+    from inference_backends import prepare_model
+
+    manifest = None
+    if manifest_path is not None:
+        manifest = load_manifest(manifest_path)
+        # The model was loaded with from_pretrained, so name_or_path points to its directory
+        fingerprint = backend_fingerprint(model_fingerprint(model.name_or_path), backend)
+    model = prepare_model(model, backend)
+
     for filename in os.listdir(input_directory):
         if filename.endswith(f'V{version}.conllu'):
             input_file_path = os.path.join(input_directory, filename)
-            output_file_path = os.path.join(output_directory, filename)
-            bert_e2e(model, tokenizer, index_to_label, input_file_path, output_file_path)
-
-
-model_path1 = "/home/mumu/VU/PGRD/playground/BERT1_new"
-model_path2 = "/home/mumu/VU/PGRD/playground/BERT2_new"
-model_path3 = "/home/mumu/VU/PGRD/playground/BERT3_new"
-
-# Define your models
-model1 = AutoModelForTokenClassification.from_pretrained(model_path1)
-model2 = AutoModelForTokenClassification.from_pretrained(model_path2)
-model3 = AutoModelForTokenClassification.from_pretrained(model_path3)
-tokenizer1 = AutoTokenizer.from_pretrained(model_path1)
-tokenizer2 = AutoTokenizer.from_pretrained(model_path2)
-tokenizer3 = AutoTokenizer.from_pretrained(model_path3)
-
-os.makedirs('../predictions', exist_ok=True)
-# Process files for each model
-process_all_files('../dataset/bert_input', '../predictions', model1, tokenizer1, index_to_label, 1)
-process_all_files('../dataset/bert_input', '../predictions', model2, tokenizer2, index_to_label, 2)
-process_all_files('../dataset/bert_input', '../predictions', model3, tokenizer3, index_to_label, 3)
\ No newline at end of file
+            output_file_path = os.path.join(output_directory, output_filename(filename, output_format))
+            if manifest is None:
+                bert_e2e(model, tokenizer, index_to_label, input_file_path, output_file_path, batch_size, cache,
+                         with_confidence, scheduler=scheduler)
+                continue
+            inputs = {'input': file_hash(input_file_path), 'model': fingerprint}
+            output_paths = [output_file_path]
+            if with_confidence:
+                output_paths.append(output_file_path + CONFIDENCE_SUFFIX)
+            if unit_changed(manifest, 'predict', filename, inputs, output_paths):
+                bert_e2e(model, tokenizer, index_to_label, input_file_path, output_file_path, batch_size, cache,
+                         with_confidence, scheduler=scheduler)
+                record_unit(manifest, 'predict', filename, inputs, output_paths)
+
+    if manifest is not None:
+        save_manifest(manifest, manifest_path)
+
+
+def load_model(model_path):
+    """
+    Load a fine-tuned BERT model and its tokenizer.
+
+    Args:
+        model_path (str): Path to the model directory.
+
+    Returns:
+        A tuple of the model (AutoModelForTokenClassification) and the tokenizer (AutoTokenizer).
+    """
+    # Imported here, so that the rest of this module can be used without loading transformers
+    from transformers import AutoTokenizer, AutoModelForTokenClassification
+
+    model = AutoModelForTokenClassification.from_pretrained(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    return model, tokenizer
+
+
+# Model, tokenizer, prediction cache and batch scheduler of the current worker process, set up once by _init_worker
+_worker_model = None
+_worker_tokenizer = None
+_worker_cache = None
+_worker_scheduler = None
+
+
+def _init_worker(model_path, num_threads, cache_path=None, fingerprint=None, cache_max_bytes=None, profile=False,
+                 backend='fp32', batch_size=32, token_budget=None, rss_limit_mb=None, adaptive=False):
+    """
+    Initialize a scheduler worker: limit its torch threads and load and prepare its model once.
+
+    Args:
+        model_path (str): Path to the model directory the worker serves.
+        num_threads (int): Number of intra-op threads torch may use in this worker.
+        cache_path (str): Optional path to the prediction cache database.
+        fingerprint (str): Fingerprint of the model, used to key the prediction cache.
+        cache_max_bytes (int): Maximum size of the prediction cache.
+        profile (bool): Whether to record profiling data in the worker.
+        backend (str): Inference backend to prepare the model for.
+        batch_size (int): Maximum number of sentences per forward pass.
+        token_budget (int): Optional maximum number of padded subtokens per forward pass.
+        rss_limit_mb (float): Optional ceiling in MiB on the RSS the batches of the worker add to its loaded model.
+        adaptive (bool): Whether to tune the token budget from the measured throughput.
+    """
+    import torch
+    from inference_backends import prepare_model
+
+    global _worker_model, _worker_tokenizer, _worker_cache, _worker_scheduler
+    # Limit the intra-op threads so that the workers together do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+    if profile:
+        profiler.enable()
+    model, _worker_tokenizer = load_model(model_path)
+    _worker_model = prepare_model(model, backend)
+    if cache_path is not None:
+        _worker_cache = PredictionCache(cache_path, fingerprint, cache_max_bytes)
+    # One scheduler for all units of the worker, so that its tuning carries over from file to file
+    _worker_scheduler = BatchScheduler(batch_size, token_budget, rss_limit_mb, adaptive)
+
+
+def _predict_file(input_file_path, output_format='conllu', with_confidence=False):
+    """
+    Predict one input file with the model and batch scheduler of the current worker.
+
+    Args:
+        input_file_path (str): Path to the input file.
+        output_format (str): 'conllu' or 'store' (see output_filename).
+        with_confidence (bool): Whether to also compute the confidences of the word labels.
+
+    Returns:
+        A tuple of the predictions (in the 5-column format as a string, or as prediction store bytes), the confidence
+        sidecar (bytes, or None without with_confidence), the number of prediction cache hits and misses for this
+        file, the statistics of its batches (see BatchScheduler.record) and the profiling records of this file.
+    """
+    hits, misses = (_worker_cache.hits, _worker_cache.misses) if _worker_cache is not None else (0, 0)
+    with profiler.context(**context_from_filename(input_file_path)):
+        with profiler.stage('read_input'):
+            sentence_list, gold_list = read_sentences_from_file(input_file_path)
+        profiler.count(len(sentence_list))
+        word_labels_list = predict_word_labels(_worker_model, _worker_tokenizer, index_to_label, sentence_list,
+                                               cache=_worker_cache, with_confidence=with_confidence,
+                                               scheduler=_worker_scheduler)
+        confidences = None
+        if with_confidence:
+            word_labels_list, word_confidences_list = word_labels_list
+            confidences = encode_confidences(prediction_sentences(sentence_list, gold_list, word_confidences_list))
+        with profiler.stage('format_predictions'):
+            if output_format == 'store':
+                predictions = encode_prediction_store(prediction_sentences(sentence_list, gold_list,
+                                                                           word_labels_list))
+            else:
+                output = io.StringIO()
+                write_predictions(output, sentence_list, gold_list, word_labels_list)
+                predictions = output.getvalue()
+    if _worker_cache is not None:
+        hits, misses = _worker_cache.hits - hits, _worker_cache.misses - misses
+    records = profiler.take_records() if profiler.enabled else None
+    return predictions, confidences, hits, misses, _worker_scheduler.take_stats(), records
+
+
+def default_workers(version_units):
+    """
+    Choose the number of scheduler workers when none is given: one per core, but no more than there are
+    units to do, nor than there are model copies that fit into the available memory (though at least one
+    per model version).
+
+    Args:
+        version_units (dict): Maps each model version to its (model path, fingerprint, units), as collected
+            by run_scheduler.
+
+    Returns:
+        The number of worker processes.
+    """
+    workers = os.cpu_count() or 1
+    available_kb = available_memory_kb()
+    if available_kb is not None and version_units:
+        # Every worker holds a full copy of its model, plus the memory its batches need
+        model_kb = max(directory_size(model_path) for model_path, _, _ in version_units.values()) / 1024
+        if model_kb > 0:
+            workers = min(workers, max(len(version_units), int(available_kb // (model_kb * MODEL_MEMORY_FACTOR))))
+    workers = min(workers, sum(len(units) for _, _, units in version_units.values()))
+    # Every model version needs a worker of its own
+    return max(1, len(version_units), workers)
+
+
+def directory_size(directory):
+    """
+    Get the total size in bytes of the files in a directory and its subdirectories.
+    """
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, files in os.walk(directory) for filename in files)
+
+
+def run_scheduler(model_paths, input_directory, output_directory, workers=None, batch_size=32, cache_path=None,
+                  cache_max_bytes=256 * 1024 * 1024, manifest_path=None, backend='fp32', output_format='conllu',
+                  with_confidence=False, token_budget=None, rss_limit_mb=None, adaptive=True):
+    """
+    Predict all input files for all model versions concurrently on a pool of processes.
+
+    The work is split into (model version, conllu file) units. Every version gets its own group of
+    worker processes, each of which loads the model once and then takes units of that version.
+    The torch threads per worker are limited so that all workers together use each core once.
+    Finished predictions are streamed back and written to the output directory as they arrive.
+    With a cache_path, the workers share a persistent prediction cache and only sentences that
+    changed since an earlier run are run through the models. With a manifest_path, only the units
+    whose input file or model changed since the last run are scheduled at all. With a token_budget, the
+    workers batch sentences by their padded number of subtokens instead of by count, and can tune that
+    budget and keep below an RSS ceiling (see batching.BatchScheduler). If the shared profiler
+    is enabled, the workers profile their units and send the records back to it.
+
+    Args:
+        model_paths (dict): Mapping from version number to model directory.
+        input_directory (str): Path to the input directory.
+        output_directory (str): Path to the output directory.
+        workers (int): Total number of worker processes (defaults to the number of cores).
+        batch_size (int): Maximum number of sentences per forward pass.
+        cache_path (str): Optional path to the prediction cache database.
+        cache_max_bytes (int): Maximum size of the prediction cache.
+        manifest_path (str): Optional path to the run manifest.
+        backend (str): Inference backend, one of inference_backends.BACKENDS (default: fp32 eager mode).
+            Predictions of different backends are cached and tracked in the manifest separately.
+        output_format (str): 'conllu' (default) or 'store' to write binary prediction stores.
+        with_confidence (bool): Whether to write a confidence sidecar next to every predictions file
+            (computed from the same forward passes; the prediction cache is not used then).
+        token_budget (int): Optional maximum number of padded subtokens per forward pass (batch_size still caps
+            the number of sentences).
+        rss_limit_mb (float): Optional ceiling in MiB on the memory the batches of all workers together add to their
+            loaded models, shared out evenly; it needs a token_budget.
+        adaptive (bool): Whether the workers tune their token budget from the measured throughput.
+
+    Returns:
+        A dict with the total number of prediction cache 'hits' and 'misses', and a summary of the forward passes
+        under 'batching' (see batching.summarize_batches).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    manifest = load_manifest(manifest_path) if manifest_path is not None else None
+
+    # Collect the units of every version that have to be (re)done
+    version_units = {}
+    for version, model_path in sorted(model_paths.items()):
+        # Fingerprint the model once here rather than in every worker
+        fingerprint = None
+        if cache_path is not None or manifest is not None:
+            fingerprint = backend_fingerprint(model_fingerprint(model_path), backend)
+        units = []
+        for filename in sorted(os.listdir(input_directory)):
+            if filename.endswith(f'V{version}.conllu'):
+                input_file_path = os.path.join(input_directory, filename)
+                output_paths = [os.path.join(output_directory, output_filename(filename, output_format))]
+                if with_confidence:
+                    output_paths.append(output_paths[0] + CONFIDENCE_SUFFIX)
+                inputs = None
+                if manifest is not None:
+                    inputs = {'input': file_hash(input_file_path), 'model': fingerprint}
+                    if not unit_changed(manifest, 'predict', filename, inputs, output_paths):
+                        continue
+                units.append((filename, input_file_path, output_paths, inputs))
+        # Do not load the model at all if nothing changed for it
+        if units:
+            version_units[version] = (model_path, fingerprint, units)
+
+    cpu_count = os.cpu_count() or 1
+    if workers is None:
+        workers = default_workers(version_units)
+    if version_units and workers < len(version_units):
+        print(f"Warning: {workers} workers requested, but every model version needs its own; "
+              f"starting {len(version_units)}.")
+    # Divide the workers over the model versions, with at least one and at most one per unit for each version
+    workers_per_version = {version: min(len(units), max(1, workers // len(version_units)))
+                           for version, (_, _, units) in version_units.items()}
+    total_workers = max(1, sum(workers_per_version.values()))
+    num_threads = max(1, cpu_count // total_workers)
+    worker_rss_limit_mb = None
+    if rss_limit_mb is not None:
+        worker_rss_limit_mb = rss_limit_mb / total_workers
+    adaptive = adaptive and token_budget is not None
+    # Use fresh interpreters for the workers, torch does not cope well with forked threads
+    context = multiprocessing.get_context('spawn')
+
+    executors = []
+    futures = {}
+    cache_stats = {'hits': 0, 'misses': 0}
+    batch_stats = []
+    try:
+        for version, (model_path, fingerprint, units) in version_units.items():
+            executor = ProcessPoolExecutor(max_workers=workers_per_version[version], mp_context=context,
+                                           initializer=_init_worker,
+                                           initargs=(model_path, num_threads, cache_path, fingerprint,
+                                                     cache_max_bytes, profiler.enabled, backend, batch_size,
+                                                     token_budget, worker_rss_limit_mb, adaptive))
+            executors.append(executor)
+            for filename, input_file_path, output_paths, inputs in units:
+                future = executor.submit(_predict_file, input_file_path, output_format, with_confidence)
+                futures[future] = (filename, output_paths, inputs)
+
+        # Write the predictions of each unit as soon as it is finished
+        for future in as_completed(futures):
+            predictions, confidences, hits, misses, file_batch_stats, records = future.result()
+            filename, output_paths, inputs = futures[future]
+            if records is not None:
+                profiler.merge(records)
+            with profiler.context(**context_from_filename(filename)), profiler.stage('write_predictions'):
+                if isinstance(predictions, bytes):
+                    with open(output_paths[0], 'wb') as output_file:
+                        output_file.write(predictions)
+                else:
+                    with open(output_paths[0], 'w', encoding='utf-8') as output_file:
+                        output_file.write(predictions)
+                if confidences is not None:
+                    with open(output_paths[1], 'wb') as output_file:
+                        output_file.write(confidences)
+                else:
+                    remove_confidences(output_paths[0])
+            cache_stats['hits'] += hits
+            cache_stats['misses'] += misses
+            batch_stats.extend(file_batch_stats)
+            if manifest is not None:
+                record_unit(manifest, 'predict', filename, inputs, output_paths)
+    except BaseException:
+        # Do not wait for the units still queued when a unit failed or the run was interrupted
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+        raise
+    finally:
+        for executor in executors:
+            executor.shutdown()
+        # Save the finished units even if the run was interrupted
+        if manifest is not None:
+            save_manifest(manifest, manifest_path)
+    cache_stats['batching'] = summarize_batches(batch_stats)
+    return cache_stats
+
+
+if __name__ == "__main__":
+    # Paths to the fine-tuned models for each input format version
+    model_paths = {1: "/home/mumu/VU/PGRD/playground/BERT1_new",
+                   2: "/home/mumu/VU/PGRD/playground/BERT2_new",
+                   3: "/home/mumu/VU/PGRD/playground/BERT3_new"}
+    # Number of sentences fed to the model in one forward pass
+    batch_size = 32
+    # Maximum number of padded subtokens per forward pass (None batches by batch_size only)
+    token_budget = None
+    # Memory in MiB the batches of all workers together may add to the loaded models; batches shrink above it
+    # (needs a token budget; None for no ceiling)
+    rss_limit_mb = None
+    # Number of worker processes (None uses one per core)
+    workers = None
+    # Prediction cache shared by all runs (None disables it)
+    cache_path = '../cache/predictions.sqlite'
+    # Manifest of the finished units, so that a re-run only redoes what changed (None disables it)
+    manifest_path = '../cache/manifest.json'
+    # Inference backend: 'fp32', 'int8', 'bf16', 'trace' or 'compile' (check the accuracy with inference_backends.py)
+    backend = 'fp32'
+    # Format of the predictions files: 'conllu' (5-column text) or 'store' (binary, see prediction_store.py)
+    output_format = 'conllu'
+    # Whether to write the confidence of every word label next to the predictions (for evaluation.py's near misses)
+    with_confidence = False
+    # Where to write a profile of the run, e.g. '../cache/profile_prediction.json' (None disables profiling)
+    profile_path = None
+    if profile_path is not None:
+        profiler.enable()
+
+    os.makedirs('../predictions', exist_ok=True)
+    # Process files for all models concurrently
+    cache_stats = run_scheduler(model_paths, '../dataset/bert_input', '../predictions', workers, batch_size,
+                                cache_path, manifest_path=manifest_path, backend=backend, output_format=output_format,
+                                with_confidence=with_confidence, token_budget=token_budget, rss_limit_mb=rss_limit_mb)
+    if cache_path is not None:
+        print(f"Prediction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    print(f"Forward passes: {cache_stats['batching']['batches']} batches, "
+          f"{cache_stats['batching']['tokens_per_second']:.0f} subtokens/s")
+    if profile_path is not None:
+        profiler.write_report(profile_path)
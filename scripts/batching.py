@@ -0,0 +1,185 @@
+import time
+from instrumentation import current_rss_kb
+
+# Bounds of the token budget while it adapts, in padded subtokens per forward pass
+MIN_TOKEN_BUDGET = 128
+MAX_TOKEN_BUDGET = 1 << 16
+# Factor the token budget grows by while larger batches keep raising throughput
+GROWTH_FACTOR = 1.25
+# A budget whose throughput is this much below the best one seen is given up for the best one
+THROUGHPUT_TOLERANCE = 0.05
+# After this many filled batches below the RSS ceiling in a row, the memory cap is relaxed by GROWTH_FACTOR
+RELAX_AFTER = 20
+
+
+class BatchScheduler:
+    """
+    Cuts length-sorted sentences into batches for the forward passes of predict_word_labels.
+
+    Without a token budget, every batch holds max_batch_size sentences. With a token budget, a batch holds as many
+    sentences as fit into the budget once padded to its longest sentence (and at most max_batch_size), so batches of
+    short sentences hold many of them and batches of long ones few.
+
+    With adaptive batching, the scheduler tunes the token budget from the throughput of the previous batches: it keeps
+    growing the budget while that raises the subtokens processed per second, and returns to the best budget seen when
+    it does not. With an RSS ceiling, the budget is halved whenever a batch that filled it left the process using
+    more memory than that on top of the RSS it had when the scheduler was created (i.e. once the model was loaded).
+    The budget then stays below the size of that batch until RELAX_AFTER filled batches in a row stayed below the
+    ceiling, after which the cap is relaxed step by step. RSS is sampled after every forward pass, so the ceiling
+    steers the batch size but cannot stop a single forward pass from going over it.
+
+    One scheduler can serve many files in a row, so that what it learned carries over.
+    """
+
+    def __init__(self, max_batch_size=32, token_budget=None, rss_limit_mb=None, adaptive=False):
+        """
+        Args:
+            max_batch_size (int): Maximum number of sentences per batch (None for no limit with a token budget).
+            token_budget (int): Maximum number of padded subtokens per batch (None batches by sentence count only).
+            rss_limit_mb (float): Optional ceiling in MiB on the RSS the batches add to that of the process at this
+                point, so create the scheduler once the model is loaded; needs a token budget.
+            adaptive (bool): Whether to tune the token budget from the measured throughput; needs a token budget.
+        """
+        if token_budget is None and (rss_limit_mb is not None or adaptive):
+            raise ValueError("An RSS ceiling and adaptive batching need a token budget")
+        if token_budget is None and max_batch_size is None:
+            raise ValueError("Batches need a maximum batch size or a token budget")
+        self.max_batch_size = max_batch_size
+        self.token_budget = token_budget
+        # The budget asked for, which a non-adaptive scheduler returns to once memory pressure is over
+        self.initial_budget = token_budget
+        self.rss_limit_kb = rss_limit_mb * 1024 if rss_limit_mb is not None else None
+        # The RSS of the process before any batch, e.g. of the loaded model and the torch runtime
+        self.baseline_rss_kb = current_rss_kb()
+        if self.rss_limit_kb is not None and self.baseline_rss_kb is None:
+            print('Warning: the RSS of the process cannot be measured on this system, ignoring the RSS ceiling.')
+            self.rss_limit_kb = None
+        self.adaptive = adaptive
+        # The budget must stay below this many tokens after memory pressure
+        self.memory_cap = MAX_TOKEN_BUDGET + 1
+        # Filled batches below the RSS ceiling since the last memory pressure
+        self.batches_under_limit = 0
+        # Budget with the highest throughput so far and that throughput in subtokens per second
+        self.best_budget = token_budget
+        self.best_throughput = 0.0
+        # Statistics of every batch, see record
+        self.stats = []
+
+    def batches(self, order, lengths):
+        """
+        Cut sentences into batches.
+
+        The token budget is looked up whenever a batch is started, so feedback recorded for one batch already shapes
+        the next.
+
+        Args:
+            order (list): Sentence indices, sorted by length.
+            lengths (list): The number of subtokens of every sentence, by sentence index.
+
+        Yields:
+            The sentence indices of each batch.
+        """
+        start = 0
+        while start < len(order):
+            end = start + 1
+            while end < len(order) and (self.max_batch_size is None or end - start < self.max_batch_size):
+                # Sentences are sorted by length, so the next one is the longest of the batch it would join
+                if self.token_budget is not None and (end + 1 - start) * lengths[order[end]] > self.token_budget:
+                    break
+                end += 1
+            yield order[start:end]
+            start = end
+
+    def timed(self, sentences, tokens):
+        """
+        Measure a forward pass and record it (see record), e.g. `with scheduler.timed(len(batch), tokens): ...`.
+        """
+        return _TimedBatch(self, sentences, tokens)
+
+    def record(self, sentences, tokens, seconds):
+        """
+        Record the statistics of a batch and adapt the token budget to them.
+
+        Args:
+            sentences (int): Number of sentences in the batch.
+            tokens (int): Number of padded subtokens in the batch.
+            seconds (float): Wall time of the forward pass.
+        """
+        rss_kb = current_rss_kb()
+        throughput = tokens / seconds if seconds > 0 else 0.0
+        self.stats.append({'sentences': sentences, 'tokens': tokens, 'seconds': seconds,
+                           'tokens_per_second': throughput, 'token_budget': self.token_budget, 'rss_kb': rss_kb})
+        # Only batches that filled the budget tell how well it works; the rest were cut short by their file
+        if self.token_budget is None or tokens < self.token_budget / GROWTH_FACTOR:
+            return
+
+        if self.rss_limit_kb is not None:
+            if rss_kb - self.baseline_rss_kb > self.rss_limit_kb:
+                # Back off at once, and keep the budget below the batch that hit the ceiling for a while
+                self.memory_cap = max(MIN_TOKEN_BUDGET + 1, min(self.memory_cap, tokens))
+                self.token_budget = max(MIN_TOKEN_BUDGET, min(self.token_budget // 2, self.memory_cap - 1))
+                self.best_budget = min(self.best_budget, self.token_budget)
+                self.best_throughput = 0.0
+                self.batches_under_limit = 0
+                return
+            self.batches_under_limit += 1
+            if self.batches_under_limit >= RELAX_AFTER and self.memory_cap <= MAX_TOKEN_BUDGET:
+                self.memory_cap = min(MAX_TOKEN_BUDGET + 1, int(self.memory_cap * GROWTH_FACTOR))
+                self.batches_under_limit = 0
+                if not self.adaptive:
+                    self.token_budget = max(self.token_budget, min(self.initial_budget, self.memory_cap - 1))
+        if not self.adaptive:
+            return
+
+        if throughput >= self.best_throughput:
+            self.best_budget = self.token_budget
+            self.best_throughput = throughput
+            # Grow, but stay below the memory cap
+            self.token_budget = max(self.token_budget, min(int(self.token_budget * GROWTH_FACTOR),
+                                                           self.memory_cap - 1, MAX_TOKEN_BUDGET))
+        elif throughput < self.best_throughput * (1 - THROUGHPUT_TOLERANCE):
+            self.token_budget = self.best_budget
+
+    def take_stats(self):
+        """
+        Remove and return the batch statistics recorded so far, e.g. to send them from a worker process to the main
+        process.
+        """
+        stats = self.stats
+        self.stats = []
+        return stats
+
+
+class _TimedBatch:
+    """
+    Context manager that measures the forward pass of a batch for a BatchScheduler.
+    """
+
+    def __init__(self, scheduler, sentences, tokens):
+        self.scheduler = scheduler
+        self.sentences = sentences
+        self.tokens = tokens
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.scheduler.record(self.sentences, self.tokens, time.perf_counter() - self.wall)
+        return False
+
+
+def summarize_batches(stats):
+    """
+    Summarize batch statistics (see BatchScheduler.record).
+
+    Returns:
+        A dict with the number of 'batches', 'sentences' and padded 'tokens', the forward 'seconds', the overall
+        'tokens_per_second' and the 'peak_rss_mb' seen after a batch.
+    """
+    seconds = sum(batch['seconds'] for batch in stats)
+    tokens = sum(batch['tokens'] for batch in stats)
+    return {'batches': len(stats), 'sentences': sum(batch['sentences'] for batch in stats), 'tokens': tokens,
+            'seconds': seconds, 'tokens_per_second': tokens / seconds if seconds > 0 else 0.0,
+            'peak_rss_mb': max((batch['rss_kb'] for batch in stats if batch['rss_kb'] is not None), default=0) / 1024}
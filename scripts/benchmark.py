@@ -0,0 +1,268 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import tempfile
+import time
+import torch
+from transformers import BertConfig, BertForTokenClassification, BertTokenizerFast
+import preprocess
+from BERT_prediction import index_to_label, predict_word_labels, read_sentences_from_file, write_predictions
+from evaluation import evaluate_inv, evaluate_mft
+from labels import label_to_index
+
+
+def generate_synthetic_dataset(data, scale):
+    """
+    Scale a hierarchical dataset up by repeating the items of every test_type.
+
+    Each test_type's item list is repeated as a whole, so INV pairs stay next to each other,
+    and the copies get new sentence IDs following the original ones.
+
+    Args:
+        data (dict): The hierarchical data, mapping capability to test_type to a list of items.
+        scale (int): How many times every test_type's items appear in the result.
+
+    Returns:
+        The scaled hierarchical data.
+    """
+    scaled = {}
+    for capability in data:
+        scaled[capability] = {}
+        for test_type, items in data[capability].items():
+            id_offset = max((item['sentence_id'] for item in items), default=0)
+            scaled_items = []
+            for copy_index in range(scale):
+                for item in items:
+                    scaled_item = copy.deepcopy(item)
+                    scaled_item['sentence_id'] = item['sentence_id'] + copy_index * id_offset
+                    scaled_items.append(scaled_item)
+            scaled[capability][test_type] = scaled_items
+    return scaled
+
+
+def make_tiny_model(input_directory, model_directory, seed=0):
+    """
+    Create a tiny randomly-initialized token classification model with the 59-label head, so that
+    inference can be benchmarked offline. Its WordPiece vocabulary is built from the benchmark inputs.
+
+    Args:
+        input_directory (str): Directory with the conllu input files whose words make up the vocabulary.
+        model_directory (str): Directory to save the model and tokenizer to.
+        seed (int): Seed for the random weights.
+
+    Returns:
+        A tuple of the model and the tokenizer.
+    """
+    words = set()
+    for filename in os.listdir(input_directory):
+        for sentence in read_sentences_from_file(os.path.join(input_directory, filename))[0]:
+            for word in sentence:
+                words.update(word.lower().split())
+    # Split long words into two pieces, so that the benchmark also covers multi-piece words
+    pieces = set()
+    for word in words:
+        if len(word) > 6:
+            pieces.update([word[:4], '##' + word[4:]])
+        else:
+            pieces.add(word)
+    vocabulary = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(pieces - {'[sep]'})
+
+    os.makedirs(model_directory, exist_ok=True)
+    vocabulary_path = os.path.join(model_directory, 'vocab.txt')
+    with open(vocabulary_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(vocabulary) + '\n')
+    tokenizer = BertTokenizerFast(vocabulary_path)
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocabulary), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, num_labels=len(label_to_index), id2label=index_to_label,
+                        label2id=label_to_index)
+    model = BertForTokenClassification(config)
+    model.save_pretrained(model_directory)
+    tokenizer.save_pretrained(model_directory)
+    return model, tokenizer
+
+
+def percentile(values, fraction):
+    """
+    Get a percentile of a list of values (nearest-rank method).
+
+    Args:
+        values (list): The values.
+        fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+        The value at the percentile, or None for an empty list.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def count_items(data):
+    """
+    Count the items (sentences) of a hierarchical dataset.
+    """
+    return sum(len(items) for capability in data for items in data[capability].values())
+
+
+def bench_preprocess(json_file, output_directory, sentences):
+    """
+    Benchmark preprocess_V1, preprocess_V2 and preprocess_V3.
+
+    Args:
+        json_file (str): Path to the hierarchical JSON dataset.
+        output_directory (str): Directory to write the conllu files to.
+        sentences (int): Number of items in the dataset.
+
+    Returns:
+        A dict with the time and throughput of each version.
+    """
+    results = {}
+    for version, function in [('V1', preprocess.preprocess_V1), ('V2', preprocess.preprocess_V2),
+                              ('V3', preprocess.preprocess_V3)]:
+        start = time.perf_counter()
+        function(json_file, output_directory)
+        seconds = time.perf_counter() - start
+        results[version] = {'sentences': sentences, 'seconds': seconds, 'sentences_per_sec': sentences / seconds}
+    return results
+
+
+def bench_inference(model, tokenizer, input_directory, output_directory, batch_size):
+    """
+    Benchmark batched inference (as done by bert_e2e) over all input files.
+
+    Args:
+        model (AutoModelForTokenClassification): The model.
+        tokenizer (AutoTokenizer): The tokenizer.
+        input_directory (str): Directory with the conllu input files.
+        output_directory (str): Directory to write the predictions to.
+        batch_size (int): Maximum number of sentences per forward pass.
+
+    Returns:
+        A dict with the total time, the throughput and the p50/p99 latency of the forward pass per batch.
+    """
+    # Time every forward pass with hooks, so that the inference code itself is benchmarked unchanged
+    batch_latencies = []
+    batch_start = []
+    pre_hook = model.register_forward_pre_hook(lambda module, inputs: batch_start.append(time.perf_counter()))
+    hook = model.register_forward_hook(
+        lambda module, inputs, outputs: batch_latencies.append(time.perf_counter() - batch_start.pop()))
+
+    sentences = 0
+    seconds = 0.0
+    try:
+        for filename in sorted(os.listdir(input_directory)):
+            sentence_list, gold_list = read_sentences_from_file(os.path.join(input_directory, filename))
+            start = time.perf_counter()
+            word_labels_list = predict_word_labels(model, tokenizer, index_to_label, sentence_list, batch_size)
+            seconds += time.perf_counter() - start
+            sentences += len(sentence_list)
+            with open(os.path.join(output_directory, filename), 'w', encoding='utf-8') as output_file:
+                write_predictions(output_file, sentence_list, gold_list, word_labels_list)
+    finally:
+        pre_hook.remove()
+        hook.remove()
+
+    return {'sentences': sentences, 'seconds': seconds, 'sentences_per_sec': sentences / seconds,
+            'batches': len(batch_latencies), 'batch_size': batch_size,
+            'batch_latency_p50': percentile(batch_latencies, 0.5),
+            'batch_latency_p99': percentile(batch_latencies, 0.99)}
+
+
+def bench_evaluation(predictions_directory):
+    """
+    Benchmark evaluate_mft and evaluate_inv over all predictions files.
+
+    Args:
+        predictions_directory (str): Directory with the predictions files.
+
+    Returns:
+        A dict with the time and throughput of each test kind.
+    """
+    results = {}
+    for kind, function in [('MFT', evaluate_mft), ('INV', evaluate_inv)]:
+        tokens = 0
+        seconds = 0.0
+        for filename in sorted(os.listdir(predictions_directory)):
+            if kind not in filename:
+                continue
+            file_path = os.path.join(predictions_directory, filename)
+            with open(file_path, 'r', encoding='utf-8') as file:
+                tokens += sum(1 for line in file if line.strip())
+            start = time.perf_counter()
+            function(file_path)
+            seconds += time.perf_counter() - start
+        results[kind] = {'tokens': tokens, 'seconds': seconds,
+                         'tokens_per_sec': tokens / seconds if seconds else None}
+    return results
+
+
+def run_benchmark(json_file, scale=1, batch_size=32, stages=('preprocess', 'inference', 'evaluation')):
+    """
+    Run the benchmark on a synthetic dataset scaled up from a hierarchical JSON dataset.
+
+    Args:
+        json_file (str): Path to the hierarchical JSON dataset.
+        scale (int): How many times the dataset is repeated (e.g. 10 to 1000).
+        batch_size (int): Maximum number of sentences per forward pass.
+        stages (tuple): The stages to benchmark. Inference needs the preprocessed inputs and evaluation
+            the predictions, so those stages are still run (untimed) when they are needed.
+
+    Returns:
+        A JSON-serializable dict with the results of every stage and a description of the environment.
+    """
+    with open(json_file, 'r') as f:
+        data = generate_synthetic_dataset(json.load(f), scale)
+    sentences = count_items(data)
+    results = {'environment': {'python': platform.python_version(), 'torch': torch.__version__,
+                               'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                               'torch_threads': torch.get_num_threads()},
+               'scale': scale, 'sentences': sentences}
+
+    with tempfile.TemporaryDirectory() as directory:
+        scaled_json_file = os.path.join(directory, 'dataset.json')
+        with open(scaled_json_file, 'w') as f:
+            json.dump(data, f)
+        input_directory = os.path.join(directory, 'bert_input')
+        predictions_directory = os.path.join(directory, 'predictions')
+        os.makedirs(input_directory)
+        os.makedirs(predictions_directory)
+
+        if 'preprocess' in stages:
+            results['preprocess'] = bench_preprocess(scaled_json_file, input_directory, sentences)
+        elif 'inference' in stages or 'evaluation' in stages:
+            preprocess.run_pipeline(scaled_json_file, input_directory)
+
+        if 'inference' in stages or 'evaluation' in stages:
+            model, tokenizer = make_tiny_model(input_directory, os.path.join(directory, 'model'))
+            inference = bench_inference(model, tokenizer, input_directory, predictions_directory, batch_size)
+            if 'inference' in stages:
+                results['inference'] = inference
+
+        if 'evaluation' in stages:
+            results['evaluation'] = bench_evaluation(predictions_directory)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark preprocessing, inference and evaluation throughput.')
+    parser.add_argument('--dataset', default='../dataset/hierarchical_dataset.json',
+                        help='hierarchical JSON dataset to scale up')
+    parser.add_argument('--scale', type=int, default=10, help='how many times the dataset is repeated')
+    parser.add_argument('--batch-size', type=int, default=32, help='sentences per forward pass')
+    parser.add_argument('--stages', nargs='+', default=['preprocess', 'inference', 'evaluation'],
+                        choices=['preprocess', 'inference', 'evaluation'], help='stages to benchmark')
+    parser.add_argument('--output', help='file to write the JSON results to (default: print them)')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(args.dataset, args.scale, args.batch_size, tuple(args.stages))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_results, f, indent=2)
+    else:
+        print(json.dumps(benchmark_results, indent=2))
@@ -0,0 +1,192 @@
+import argparse
+import os
+
+# Every subcommand imports the modules it needs itself, so that e.g. 'evaluate' starts
+# without loading NLTK, torch or transformers.
+
+
+def parse_model_paths(models):
+    """
+    Parse '--model VERSION=PATH' arguments.
+
+    Args:
+        models (list): The arguments, e.g. ['1=../models/BERT1', '2=../models/BERT2'].
+
+    Returns:
+        A dict mapping version number to model directory.
+    """
+    model_paths = {}
+    for model in models:
+        version, model_path = model.split('=', 1)
+        model_paths[int(version)] = model_path
+    return model_paths
+
+
+def manifest_path_of(args):
+    """
+    Get the manifest path of the parsed arguments (None if --no-manifest was given).
+    """
+    return None if args.no_manifest else args.manifest
+
+
+def run_preprocess(args):
+    """
+    Write the bert_input files of all JSON datasets.
+    """
+    from preprocess import process_all_json_files
+    process_all_json_files(args.dataset, args.streaming, manifest_path_of(args), args.workers)
+
+
+def run_predict(args):
+    """
+    Predict all bert_input files with the models of every version.
+    """
+    from BERT_prediction import run_scheduler
+    os.makedirs(args.predictions, exist_ok=True)
+    cache_stats = run_scheduler(parse_model_paths(args.model), args.input, args.predictions, args.workers,
+                                args.batch_size, args.cache, manifest_path=manifest_path_of(args),
+                                backend=args.backend, output_format=args.output_format,
+                                with_confidence=args.with_confidence, token_budget=args.token_budget,
+                                rss_limit_mb=args.rss_limit, adaptive=not args.no_adapt)
+    if args.cache is not None:
+        print(f"Prediction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    print(f"Forward passes: {cache_stats['batching']['batches']} batches, "
+          f"{cache_stats['batching']['tokens_per_second']:.0f} subtokens/s")
+
+
+def run_evaluate(args):
+    """
+    Score all predictions files and print the results.
+    """
+    from evaluation import evaluate_all_files
+    evaluate_all_files(args.predictions, args.evaluation_backend, manifest_path_of(args), args.workers)
+
+
+def run_compare(args):
+    """
+    Compare the predictions of all model versions, diff them against a baseline run and export the report.
+    """
+    from comparison import compare_directory, export_csv, export_json, format_comparison
+    comparison = compare_directory(args.predictions, args.baseline, args.tolerance, args.workers)
+    print(format_comparison(comparison), end='')
+    if args.json is not None:
+        export_json(comparison, args.json)
+    if args.csv is not None:
+        export_csv(comparison, args.csv)
+
+
+def run_all(args):
+    """
+    Run the whole checklist: preprocess, predict and evaluate.
+    """
+    run_preprocess(args)
+    run_predict(args)
+    run_evaluate(args)
+
+
+def build_parser():
+    """
+    Build the command line parser with the 'preprocess', 'predict', 'evaluate', 'compare' and 'run' subcommands.
+    """
+    parser = argparse.ArgumentParser(description='Run the semantic role labeling checklist.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_common_arguments(subparser):
+        subparser.add_argument('--manifest', default='../cache/manifest.json',
+                               help='run manifest, so that a re-run only redoes what changed')
+        subparser.add_argument('--no-manifest', action='store_true',
+                               help='redo everything and do not record the run')
+        subparser.add_argument('--profile', help='write a profile of the run to this JSON file')
+        subparser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+
+    def add_preprocess_arguments(subparser):
+        subparser.add_argument('--dataset', default='../dataset', help='directory with the JSON datasets')
+        subparser.add_argument('--streaming', action='store_true', help='tokenize and write one item at a time')
+
+    def add_predict_arguments(subparser, input_default):
+        subparser.add_argument('--model', action='append', required=True, metavar='VERSION=PATH',
+                               help='model directory for an input format version, e.g. 1=../models/BERT1 '
+                                    '(repeatable)')
+        subparser.add_argument('--input', default=input_default, help='directory with the bert_input files')
+        subparser.add_argument('--batch-size', type=int, default=32, help='sentences per forward pass')
+        subparser.add_argument('--token-budget', type=int,
+                               help='batch by padded subtokens per forward pass instead (--batch-size still caps the '
+                                    'sentences)')
+        subparser.add_argument('--rss-limit', type=float, metavar='MIB',
+                               help='memory the batches of all workers together may add to the loaded models; '
+                                    'batches shrink above it (needs --token-budget)')
+        subparser.add_argument('--no-adapt', action='store_true',
+                               help='keep the token budget fixed instead of tuning it from the measured throughput')
+        subparser.add_argument('--backend', default='fp32', help='inference backend (see inference_backends.py)')
+        subparser.add_argument('--output-format', choices=['conllu', 'store'], default='conllu',
+                               help="write the predictions as 5-column text or as binary prediction stores")
+        subparser.add_argument('--with-confidence', action='store_true',
+                               help='also write the confidence of every word label (for near-miss reports)')
+        subparser.add_argument('--cache', default='../cache/predictions.sqlite',
+                               help='prediction cache database (empty to disable)')
+
+    def add_evaluate_arguments(subparser):
+        subparser.add_argument('--evaluation-backend', choices=['python', 'numpy'], default='python',
+                               help='evaluation backend')
+
+    def add_predictions_argument(subparser):
+        subparser.add_argument('--predictions', default='../predictions', help='directory with the predictions')
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='write the bert_input files')
+    add_preprocess_arguments(preprocess_parser)
+    add_common_arguments(preprocess_parser)
+    preprocess_parser.set_defaults(function=run_preprocess)
+
+    predict_parser = subparsers.add_parser('predict', help='predict the bert_input files')
+    add_predict_arguments(predict_parser, '../dataset/bert_input')
+    add_predictions_argument(predict_parser)
+    add_common_arguments(predict_parser)
+    predict_parser.set_defaults(function=run_predict)
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='score the predictions')
+    add_predictions_argument(evaluate_parser)
+    add_evaluate_arguments(evaluate_parser)
+    add_common_arguments(evaluate_parser)
+    evaluate_parser.set_defaults(function=run_evaluate)
+
+    compare_parser = subparsers.add_parser('compare', help='compare the model versions and diff against a baseline')
+    add_predictions_argument(compare_parser)
+    compare_parser.add_argument('--baseline', help='JSON report of a previous run to diff against')
+    compare_parser.add_argument('--tolerance', type=float, default=0.0,
+                                help='percentage points a failure rate may rise before it counts as a regression')
+    compare_parser.add_argument('--json', help='write the report as JSON to this file')
+    compare_parser.add_argument('--csv', help='write the test results as CSV to this file')
+    add_common_arguments(compare_parser)
+    compare_parser.set_defaults(function=run_compare)
+
+    run_parser = subparsers.add_parser('run', help='preprocess, predict and evaluate')
+    add_preprocess_arguments(run_parser)
+    add_predict_arguments(run_parser, None)
+    add_predictions_argument(run_parser)
+    add_evaluate_arguments(run_parser)
+    add_common_arguments(run_parser)
+    run_parser.set_defaults(function=run_all)
+    return parser
+
+
+def main(argv=None):
+    """
+    Parse the command line and run the chosen subcommand.
+    """
+    args = build_parser().parse_args(argv)
+    if getattr(args, 'cache', None) == '':
+        args.cache = None
+    if args.command == 'run' and args.input is None:
+        # Predict what the preprocessing step just wrote
+        args.input = os.path.join(args.dataset, 'bert_input')
+
+    if args.profile is not None:
+        from instrumentation import profiler
+        profiler.enable()
+    args.function(args)
+    if args.profile is not None:
+        profiler.write_report(args.profile)
+
+
+if __name__ == "__main__":
+    main()
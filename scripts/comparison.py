@@ -0,0 +1,315 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import context_from_filename, profiler
+from evaluation import NO_LABEL_ID, read_prediction_sentences, scorer_for
+
+# Columns of the CSV export, one row per (capability, test_type, version)
+CSV_FIELDS = ['capability', 'test_type', 'version', 'sentences', 'failure_rate', 'failed', 'baseline_failure_rate',
+              'delta', 'regression']
+
+
+def group_test_files(directory):
+    """
+    Group the MFT and INV predictions files of a directory by test, without reading them.
+
+    Args:
+        directory (str): Directory with predictions files named '{capability}_{test_type}_V{version}' (conllu or
+            prediction stores).
+
+    Returns:
+        A dict mapping each (capability, test_type) to a dict from version (e.g. 'V1') to filename, ordered by test.
+    """
+    tests = {}
+    for filename in sorted(os.listdir(directory)):
+        if scorer_for(filename) is None:
+            continue
+        context = context_from_filename(filename)
+        if context['version'] is None:
+            continue
+        tests.setdefault((context['capability'], context['test_type']), {})[context['version']] = filename
+    return dict(sorted(tests.items()))
+
+
+def _recorded(sentences, evaluated):
+    """
+    Pass a sentence stream through to a scorer, recording the system labels of the evaluated tokens of every sentence.
+
+    Args:
+        sentences (iterable): (sentence_id, gold_ids, system_ids) tuples, as yielded by read_prediction_sentences.
+        evaluated (dict): Filled with the tuple of evaluated system label ids of every sentence, by sentence ID.
+    """
+    for sentence in sentences:
+        sentence_id, gold_ids, system_ids = sentence
+        evaluated[sentence_id] = tuple(system for gold, system in zip(gold_ids, system_ids) if gold != NO_LABEL_ID)
+        yield sentence
+
+
+def compare_test(directory, files):
+    """
+    Score the versions of one test and compare them sentence by sentence, reading every file once.
+
+    A sentence disagrees if it failed for some versions and passed for others (for INV tests, a sentence failed if
+    its pair failed). Its labels differ if the versions predicted different labels for its evaluated tokens.
+
+    Args:
+        directory (str): Directory with the predictions files.
+        files (dict): Maps each version of the test to its filename (see group_test_files).
+
+    Returns:
+        A tuple of a dict mapping each version to its result ({'sentences', 'failure_rate', 'failed_sentence_ids'})
+        and the disagreement of the versions ({'sentences', 'disagreeing', 'differing_labels',
+        'disagreeing_sentence_ids'}).
+    """
+    results = {}
+    failed = {}
+    evaluated = {}
+    for version, filename in files.items():
+        file_path = os.path.join(directory, filename)
+        evaluated[version] = {}
+        with profiler.context(**context_from_filename(filename)), profiler.stage('parse_and_score'):
+            failure_rate, failed_sentence_ids = scorer_for(filename)(
+                _recorded(read_prediction_sentences(file_path), evaluated[version]))
+        results[version] = {'sentences': len(evaluated[version]), 'failure_rate': failure_rate,
+                            'failed_sentence_ids': failed_sentence_ids}
+        failed[version] = {str(sentence_id) for sentence_id in failed_sentence_ids}
+
+    # Sentences of any version, in the order of the first version that has them
+    sentence_ids = list(dict.fromkeys(sentence_id for labels in evaluated.values() for sentence_id in labels))
+    disagreeing_sentence_ids = []
+    differing_labels = 0
+    for sentence_id in sentence_ids:
+        if len({sentence_id in failed[version] for version in files}) > 1:
+            disagreeing_sentence_ids.append(sentence_id)
+        if len({evaluated[version].get(sentence_id) for version in files}) > 1:
+            differing_labels += 1
+    disagreement = {'sentences': len(sentence_ids), 'disagreeing': len(disagreeing_sentence_ids),
+                    'differing_labels': differing_labels, 'disagreeing_sentence_ids': disagreeing_sentence_ids}
+    return results, disagreement
+
+
+def _compare_tests(directory, tests, profile):
+    """
+    Compare some tests of a directory in a worker process (see compare_directory).
+
+    Returns:
+        A tuple of a dict mapping each (capability, test_type) to its compare_test result, and the profiling records
+        of the worker (None if not profiling).
+    """
+    if profile:
+        profiler.enable()
+    compared = {test: compare_test(directory, files) for test, files in tests}
+    return compared, profiler.take_records() if profile else None
+
+
+def failure_rate_tables(results):
+    """
+    Aggregate test results into failure-rate tables.
+
+    Args:
+        results (dict): Maps (capability, test_type, version) to a result of compare_test.
+
+    Returns:
+        A tuple of the per-capability table, mapping each capability to a dict from version to the mean failure rate
+        of its tests, and the per-model table, mapping each version to {'tests', 'mean_failure_rate',
+        'failing_tests'}, where failing tests are those with a failure rate above 0.
+    """
+    rates = {}
+    for (capability, _, version), result in results.items():
+        rates.setdefault(capability, {}).setdefault(version, []).append(result['failure_rate'])
+    capability_table = {capability: {version: sum(values) / len(values) for version, values in sorted(versions.items())}
+                        for capability, versions in sorted(rates.items())}
+
+    model_rates = {}
+    for (_, _, version), result in results.items():
+        model_rates.setdefault(version, []).append(result['failure_rate'])
+    model_table = {version: {'tests': len(values), 'mean_failure_rate': sum(values) / len(values),
+                             'failing_tests': sum(1 for value in values if value > 0)}
+                   for version, values in sorted(model_rates.items())}
+    return capability_table, model_table
+
+
+def load_baseline(report_path):
+    """
+    Load the test results of a report exported by export_json, e.g. the run of a previous checkpoint.
+
+    Returns:
+        A dict mapping (capability, test_type, version) to the result of the test in that run.
+    """
+    with open(report_path, 'r', encoding='utf-8') as file:
+        report = json.load(file)
+    return {(test['capability'], test['test_type'], test['version']): test for test in report['tests']}
+
+
+def diff_baseline(results, baseline, tolerance=0.0):
+    """
+    Compare test results with those of a baseline run.
+
+    Args:
+        results (dict): Maps (capability, test_type, version) to a result of compare_test.
+        baseline (dict): The baseline results, as returned by load_baseline.
+        tolerance (float): How many percentage points a failure rate may rise before it counts as a regression.
+
+    Returns:
+        A dict mapping every test of both runs to {'failure_rate', 'baseline_failure_rate', 'delta', 'regression',
+        'newly_failed_sentence_ids'}; rates of tests missing from one run are None.
+    """
+    diff = {}
+    for key in sorted(set(results) | set(baseline), key=lambda key: [str(part) for part in key]):
+        current, previous = results.get(key), baseline.get(key)
+        failure_rate = current['failure_rate'] if current is not None else None
+        baseline_failure_rate = previous['failure_rate'] if previous is not None else None
+        delta = None
+        newly_failed = []
+        if current is not None and previous is not None:
+            delta = failure_rate - baseline_failure_rate
+            previously_failed = {str(sentence_id) for sentence_id in previous['failed_sentence_ids']}
+            newly_failed = [sentence_id for sentence_id in current['failed_sentence_ids']
+                            if str(sentence_id) not in previously_failed]
+        diff[key] = {'failure_rate': failure_rate, 'baseline_failure_rate': baseline_failure_rate, 'delta': delta,
+                     'regression': delta is not None and delta > tolerance, 'newly_failed_sentence_ids': newly_failed}
+    return diff
+
+
+def compare_directory(directory, baseline_path=None, tolerance=0.0, workers=1):
+    """
+    Build the cross-model comparison report of a predictions directory.
+
+    Every predictions file is read once: it is scored and the system labels of its sentences are kept only until
+    the versions of its test have been compared, so memory use does not grow with the number of files.
+
+    Args:
+        directory (str): Directory with the predictions files of all versions.
+        baseline_path (str): Optional report exported from a previous run (see export_json) to diff against.
+        tolerance (float): How many percentage points a failure rate may rise before it counts as a regression.
+        workers (int): Number of worker processes the tests are spread over (None uses one per core, 1 compares
+            everything in this process).
+
+    Returns:
+        A dict with the 'results' and 'disagreement' of every test, keyed by (capability, test_type, version) and
+        (capability, test_type), the 'capability_table' and 'model_table' (see failure_rate_tables) and the
+        'baseline' diff (None without a baseline).
+    """
+    tests = list(group_test_files(directory).items())
+    if workers == 1:
+        compared = _compare_tests(directory, tests, False)[0]
+    else:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        compared = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_compare_tests, directory, tests[start::workers], profiler.enabled)
+                       for start in range(min(workers, len(tests)))]
+            for future in futures:
+                share, records = future.result()
+                compared.update(share)
+                if records is not None:
+                    profiler.merge(records)
+
+    results = {}
+    disagreement = {}
+    for (capability, test_type), (versions, test_disagreement) in sorted(compared.items()):
+        for version, result in versions.items():
+            results[(capability, test_type, version)] = result
+        disagreement[(capability, test_type)] = test_disagreement
+    capability_table, model_table = failure_rate_tables(results)
+    baseline = None
+    if baseline_path is not None:
+        baseline = diff_baseline(results, load_baseline(baseline_path), tolerance)
+    return {'results': results, 'disagreement': disagreement, 'capability_table': capability_table,
+            'model_table': model_table, 'baseline': baseline}
+
+
+def format_comparison(report):
+    """
+    Format a comparison report (see compare_directory) as text: the per-model and per-capability tables, the tests
+    whose versions disagree and the regressions against the baseline.
+    """
+    versions = list(report['model_table'])
+    lines = ["Model     Tests  Mean Failure Rate  Failing Tests"]
+    for version, row in report['model_table'].items():
+        lines.append(f"{version:<9} {row['tests']:>5}  {row['mean_failure_rate']:>16.2f}%  {row['failing_tests']:>13}")
+
+    width = max([len('Capability')] + [len(capability) for capability in report['capability_table']])
+    lines.append("")
+    lines.append(f"{'Capability':<{width}}" + ''.join(f"  {version:>8}" for version in versions))
+    for capability, rates in report['capability_table'].items():
+        lines.append(f"{capability:<{width}}" + ''.join(
+            f"  {rates[version]:>7.2f}%" if version in rates else f"  {'-':>8}" for version in versions))
+
+    lines.append("")
+    lines.append("Disagreement between versions (sentences failing for some versions only):")
+    for (capability, test_type), test_disagreement in report['disagreement'].items():
+        if test_disagreement['disagreeing'] or test_disagreement['differing_labels']:
+            lines.append(f"{capability}_{test_type}: {test_disagreement['disagreeing']} of "
+                         f"{test_disagreement['sentences']} sentences disagree, "
+                         f"{test_disagreement['differing_labels']} with differing labels, "
+                         f"Sentence IDs: {test_disagreement['disagreeing_sentence_ids']}")
+
+    if report['baseline'] is not None:
+        lines.append("")
+        regressions = [(key, test) for key, test in report['baseline'].items() if test['regression']]
+        lines.append(f"Regressions against the baseline: {len(regressions)}")
+        for (capability, test_type, version), test in regressions:
+            lines.append(f"{capability}_{test_type}_{version}: {test['baseline_failure_rate']}% -> "
+                         f"{test['failure_rate']}%, Newly Failed Sentence IDs: {test['newly_failed_sentence_ids']}")
+    return '\n'.join(lines) + '\n'
+
+
+def export_json(report, report_path):
+    """
+    Write a comparison report as JSON, e.g. for dashboards or as the baseline of a later run (see load_baseline).
+    """
+    tests = []
+    for (capability, test_type, version), result in report['results'].items():
+        tests.append({'capability': capability, 'test_type': test_type, 'version': version, **result})
+    disagreement = [{'capability': capability, 'test_type': test_type, **test_disagreement}
+                    for (capability, test_type), test_disagreement in report['disagreement'].items()]
+    baseline = None
+    if report['baseline'] is not None:
+        baseline = [{'capability': capability, 'test_type': test_type, 'version': version, **test}
+                    for (capability, test_type, version), test in report['baseline'].items()]
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump({'tests': tests, 'disagreement': disagreement, 'capability_table': report['capability_table'],
+                   'model_table': report['model_table'], 'baseline': baseline}, file, indent=1)
+
+
+def export_csv(report, csv_path):
+    """
+    Write the test results of a comparison report as CSV, one row per (capability, test_type, version) with the
+    baseline failure rate and delta if the report has a baseline.
+    """
+    baseline = report['baseline'] or {}
+    with open(csv_path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, CSV_FIELDS)
+        writer.writeheader()
+        for key, result in report['results'].items():
+            capability, test_type, version = key
+            test_baseline = baseline.get(key, {})
+            writer.writerow({'capability': capability, 'test_type': test_type, 'version': version,
+                             'sentences': result['sentences'], 'failure_rate': result['failure_rate'],
+                             'failed': len(result['failed_sentence_ids']),
+                             'baseline_failure_rate': test_baseline.get('baseline_failure_rate'),
+                             'delta': test_baseline.get('delta'), 'regression': test_baseline.get('regression')})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the predictions of all model versions and diff them '
+                                                 'against a baseline run.')
+    parser.add_argument('predictions', nargs='?', default='../predictions', help='directory with the predictions')
+    parser.add_argument('--baseline', help='JSON report of a previous run to diff against')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='percentage points a failure rate may rise before it counts as a regression')
+    parser.add_argument('--json', help='write the report as JSON to this file')
+    parser.add_argument('--csv', help='write the test results as CSV to this file')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    comparison = compare_directory(args.predictions, args.baseline, args.tolerance, args.workers)
+    print(format_comparison(comparison), end='')
+    if args.json is not None:
+        export_json(comparison, args.json)
+    if args.csv is not None:
+        export_csv(comparison, args.csv)
@@ -1,119 +1,454 @@
 import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import context_from_filename, profiler
+from labels import label_id
+from manifest import file_hash, load_manifest, record_unit, save_manifest, unit_changed
+from prediction_store import CONFIDENCE_SUFFIX, STORE_SUFFIX, PredictionStore, read_confidences
 
+# Id of the gold label '_', which marks tokens that are not evaluated
+NO_LABEL_ID = label_id('_')
+# A failure is a near miss if the wrong labels won by less than this probability margin
+NEAR_MISS_MARGIN = 0.1
 
-def evaluate_mft(file_path):
+
+def read_prediction_sentences(file_path):
     """
-    Evaluates Minimum Functionality Tests (MFT) by comparing system labels to gold labels for each sentence in the dataset.
+    Streams the sentences of a predictions file one at a time.
     Parameters:
-    - file_path (str): The path to the file containing the dataset with system predictions.
-    Returns:
-    - tuple: Contains the failure rate (as a percentage) and a list of sentence IDs that failed the MFT.
+    - file_path (str): The path to the file containing the dataset with system predictions, in the conllu layout or
+      as a binary prediction store (see prediction_store.py).
+    Yields:
+    - tuple: (sentence_id, gold_ids, system_ids) for each sentence, where sentence_id is the ID from the first
+      column as a string and gold_ids/system_ids are compact arrays with the label ids (see labels.label_id)
+      of the gold and system label of each token.
     """
-    # Open the file in read mode with UTF-8 encoding
+    if file_path.endswith(STORE_SUFFIX):
+        with PredictionStore(file_path) as store:
+            yield from store.label_id_sentences()
+            profiler.count(len(store))
+        return
+
+    sentence_id = None
+    gold_ids = array('H')
+    system_ids = array('H')
+    sentences = 0
+
     with open(file_path, 'r', encoding='utf-8') as file:
-        # Split the file into sentences
-        sentences = file.read().split('\n\n')
-        # Count the sentences, adjusting for a trailing empty string if present
-        total_sentences = len(sentences) - 1 if sentences[-1] == '' else len(sentences)
-        # Initialize counters for failed sentences and a list for their IDs
-        failed_sentences = 0
-        failed_sentence_ids = []
-
-        # Iterate over each sentence
-        for sentence in sentences:
-            # Skip empty lines
-            if sentence == '':
+        for line in file:
+            # An empty line ends the current sentence
+            if line.strip() == "":
+                if sentence_id is not None:
+                    sentences += 1
+                    yield sentence_id, gold_ids, system_ids
+                    sentence_id = None
+                    gold_ids = array('H')
+                    system_ids = array('H')
                 continue
-            # Split the sentence into lines
-            lines = sentence.split('\n')
-            # Get the sentence ID from the first line
-            sentence_id = lines[0].split('\t')[0]
-            # Get the gold labels and system labels for each line, ignoring lines with a gold label of '_'
-            gold_labels = [line.split('\t')[3] for line in lines if line.split('\t')[3] != '_']
-            system_labels = [line.split('\t')[4] for line in lines if line.split('\t')[3] != '_']
-            # If the gold labels and system labels do not match, increment the failed sentences counter and add the sentence ID to the list of failed sentences
-            if gold_labels != system_labels:
-                failed_sentences += 1
-                failed_sentence_ids.append(sentence_id)
+
+            current_id, token_id, token, gold_label, system_label = line.strip().split('\t')
+            if sentence_id is None:
+                sentence_id = current_id
+            gold_ids.append(label_id(gold_label))
+            system_ids.append(label_id(system_label))
+
+    # The last sentence may not be followed by an empty line
+    if sentence_id is not None:
+        sentences += 1
+        yield sentence_id, gold_ids, system_ids
+    profiler.count(sentences)
+
+
+def evaluated_labels(gold_ids, system_ids):
+    """
+    Selects the (gold, system) label id pairs of the tokens with a relevant gold label (not '_').
+    Parameters:
+    - gold_ids (array): The gold label ids of a sentence.
+    - system_ids (array): The system label ids of a sentence.
+    Returns:
+    - list: The (gold, system) label id pairs of the evaluated tokens, in token order.
+    """
+    return [(gold, system) for gold, system in zip(gold_ids, system_ids) if gold != NO_LABEL_ID]
+
+
+def score_mft(sentences):
+    """
+    Scores a stream of sentences as a Minimum Functionality Test (MFT).
+    Parameters:
+    - sentences (iterable): (sentence_id, gold_ids, system_ids) tuples, as yielded by read_prediction_sentences.
+    Returns:
+    - tuple: Contains the failure rate (as a percentage) and a list of sentence IDs that failed the MFT.
+    """
+    total_sentences = 0
+    failed_sentences = 0
+    failed_sentence_ids = []
+
+    for sentence_id, gold_ids, system_ids in sentences:
+        total_sentences += 1
+        # A sentence fails if any token with a gold label other than '_' got a different system label
+        if any(gold != system for gold, system in evaluated_labels(gold_ids, system_ids)):
+            failed_sentences += 1
+            failed_sentence_ids.append(sentence_id)
 
     # Calculate the failure rate as a percentage
     failure_rate = (failed_sentences / total_sentences) * 100
     # Return the failure rate and the list of failed sentence IDs
     return failure_rate, failed_sentence_ids
-def evaluate_inv(file_path):
+
+
+def score_inv(sentences):
     """
-    Evaluates Invariance tests (INV) by comparing pairs of sentences to ensure that system labels for tokens with relevant gold labels (not '_') do not change between the sentence pairs regardless of perturbations.
+    Scores a stream of sentences as an Invariance test (INV).
+    Consecutive sentences form a pair (sentences without any token with a relevant gold label are skipped, and
+    sentence IDs are expected in ascending order, as written by BERT_prediction.py). A pair fails if a token of the
+    first sentence got a different system label than the token with the same gold label in the second sentence.
     Parameters:
-    - file_path (str): The path to the file containing the dataset with system predictions.
+    - sentences (iterable): (sentence_id, gold_ids, system_ids) tuples, as yielded by read_prediction_sentences.
     Returns:
     - tuple: Contains the failure rate (as a percentage) and a list of sentence pair IDs that failed the INV test.
     """
-    sentences_data = {}
     total_pairs = 0
     failed_pairs = 0
     failed_sentence_ids = []
+    # The first sentence of the pair being collected
+    first_sentence = None
 
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            if line.strip() == "":
-                continue
+    for sentence_id, gold_ids, system_ids in sentences:
+        sentence_data = evaluated_labels(gold_ids, system_ids)
+        # Skip sentences that only have tokens with gold label '_'
+        if not sentence_data:
+            continue
+        if first_sentence is None:
+            first_sentence = (int(sentence_id), sentence_data)
+            continue
 
-            sentence_id, token_id, token, gold_label, system_label = line.strip().split('\t')
-            sentence_id = int(sentence_id)
-            
-            # Skip tokens with gold label '_'
-            if gold_label == "_":
-                continue
-            
-            # If it's a new sentence ID, initialise it with an empty list
-            if sentence_id not in sentences_data:
-                sentences_data[sentence_id] = []
-            
-            # Store both gold and system labels for tokens with gold labels other than '_'
-            sentences_data[sentence_id].append((gold_label, system_label))
-
-        sentence_ids = sorted(sentences_data.keys())
-        # Making sure that the number of input sentences is even
-        if len(sentence_ids) % 2 != 0: 
-            print('Warning: uneven number of sentences!')
-
-        # Evaluating sentences in pairs
-        for i in range(0, len(sentence_ids), 2):
-            first_sentence_data = sentences_data[sentence_ids[i]]
-            second_sentence_data = sentences_data[sentence_ids[i+1]]
-            total_pairs += 1
-            pair_failed = False
-
-            # Map gold labels to system labels for easier comparison
-            first_sentence_map = {gold: system for gold, system in first_sentence_data}
-            second_sentence_map = {gold: system for gold, system in second_sentence_data}
-
-            # Iterate over tokens in the first sentence
-            for gold_label, system_label in first_sentence_data:
-                # Check if the same gold label exists in the second sentence and focus on comparing system labels
-                if gold_label in second_sentence_map and system_label != second_sentence_map[gold_label]:
-                    pair_failed = True # Flag it as true if there is a change in system labels
-                    break
-            
-            if pair_failed: # Update counter and store failed sentence IDs.
-                failed_pairs += 1
-                failed_sentence_ids.extend([sentence_ids[i], sentence_ids[i+1]])
+        first_id, first_sentence_data = first_sentence
+        first_sentence = None
+        total_pairs += 1
+
+        # Map gold labels to system labels for easier comparison
+        second_sentence_map = {gold: system for gold, system in sentence_data}
+        # Check if the same gold label exists in the second sentence and focus on comparing system labels
+        if any(gold in second_sentence_map and system != second_sentence_map[gold]
+               for gold, system in first_sentence_data):
+            # Update counter and store failed sentence IDs.
+            failed_pairs += 1
+            failed_sentence_ids.extend([first_id, int(sentence_id)])
+
+    # Making sure that the number of input sentences is even
+    if first_sentence is not None:
+        print('Warning: uneven number of sentences!')
 
     failure_rate = ((failed_pairs / total_pairs) * 100) / 2
     return failure_rate, failed_sentence_ids
 
 
+def evaluate_mft(file_path):
+    """
+    Evaluates Minimum Functionality Tests (MFT) by comparing system labels to gold labels for each sentence in the dataset.
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    Returns:
+    - tuple: Contains the failure rate (as a percentage) and a list of sentence IDs that failed the MFT.
+    """
+    return score_mft(read_prediction_sentences(file_path))
+
+
+def evaluate_inv(file_path):
+    """
+    Evaluates Invariance tests (INV) by comparing pairs of sentences to ensure that system labels for tokens with relevant gold labels (not '_') do not change between the sentence pairs regardless of perturbations.
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    Returns:
+    - tuple: Contains the failure rate (as a percentage) and a list of sentence pair IDs that failed the INV test.
+    """
+    return score_inv(read_prediction_sentences(file_path))
+
+
+def with_confidences(sentences, confidences):
+    """
+    Pairs a stream of sentences with their confidences from a confidence sidecar.
+    Parameters:
+    - sentences (iterable): (sentence_id, gold_ids, system_ids) tuples, as yielded by read_prediction_sentences.
+    - confidences (array): The interleaved probabilities and margins of all tokens (see
+      prediction_store.read_confidences).
+    Yields:
+    - tuple: (sentence_id, gold_ids, system_ids, probabilities, margins) for each sentence.
+    """
+    offset = 0
+    for sentence_id, gold_ids, system_ids in sentences:
+        end = offset + 2 * len(gold_ids)
+        yield sentence_id, gold_ids, system_ids, confidences[offset:end:2], confidences[offset + 1:end:2]
+        offset = end
+
+
+def failure_weight(probability):
+    """
+    Weight of a wrong token label in the confidence-weighted failure rate: the probability the model gave it.
+    Tokens without a prediction (NaN) count fully.
+    """
+    return 1.0 if probability != probability else probability
+
+
+def score_mft_confidence(sentences, margin_threshold=NEAR_MISS_MARGIN):
+    """
+    Scores a stream of sentences with confidences as a Minimum Functionality Test (MFT), like score_mft.
+    Each failed sentence counts with the highest probability among its wrong token labels, and it is a near miss if
+    all of its wrong token labels won by less than margin_threshold.
+    Parameters:
+    - sentences (iterable): (sentence_id, gold_ids, system_ids, probabilities, margins) tuples, as yielded by
+      with_confidences.
+    - margin_threshold (float): The margin below which a wrong label is a near miss.
+    Returns:
+    - tuple: Contains the confidence-weighted failure rate (as a percentage) and a list of the IDs of the sentences
+      that failed as near misses.
+    """
+    total_sentences = 0
+    weighted_failures = 0.0
+    near_miss_ids = []
+
+    for sentence_id, gold_ids, system_ids, probabilities, margins in sentences:
+        total_sentences += 1
+        wrong = [index for index, (gold, system) in enumerate(zip(gold_ids, system_ids))
+                 if gold != NO_LABEL_ID and gold != system]
+        if not wrong:
+            continue
+        weighted_failures += max(failure_weight(probabilities[index]) for index in wrong)
+        if all(margins[index] < margin_threshold for index in wrong):
+            near_miss_ids.append(sentence_id)
+
+    return (weighted_failures / total_sentences) * 100, near_miss_ids
+
+
+def score_inv_confidence(sentences, margin_threshold=NEAR_MISS_MARGIN):
+    """
+    Scores a stream of sentences with confidences as an Invariance test (INV), pairing sentences like score_inv.
+    Each token whose system label differs from that of the token with the same gold label in the other sentence
+    counts with the lower probability of the two labels. A failed pair counts with its highest such probability,
+    and it is a near miss if one of the two labels of every differing token won by less than margin_threshold.
+    Parameters:
+    - sentences (iterable): (sentence_id, gold_ids, system_ids, probabilities, margins) tuples, as yielded by
+      with_confidences.
+    - margin_threshold (float): The margin below which a label is a near miss.
+    Returns:
+    - tuple: Contains the confidence-weighted failure rate (as a percentage) and a list of the IDs of the sentence
+      pairs that failed as near misses.
+    """
+    total_pairs = 0
+    weighted_failures = 0.0
+    near_miss_ids = []
+    # The first sentence of the pair being collected
+    first_sentence = None
+
+    for sentence_id, gold_ids, system_ids, probabilities, margins in sentences:
+        # (gold, system, probability, margin) of the tokens with a relevant gold label
+        sentence_data = [(gold, system, probability, margin)
+                         for gold, system, probability, margin in zip(gold_ids, system_ids, probabilities, margins)
+                         if gold != NO_LABEL_ID]
+        if not sentence_data:
+            continue
+        if first_sentence is None:
+            first_sentence = (int(sentence_id), sentence_data)
+            continue
+
+        first_id, first_sentence_data = first_sentence
+        first_sentence = None
+        total_pairs += 1
+
+        # As in score_inv, the last token with a gold label stands for it in the second sentence
+        second_sentence_map = {gold: (system, probability, margin)
+                               for gold, system, probability, margin in sentence_data}
+        differing = [(min(failure_weight(probability), failure_weight(second_sentence_map[gold][1])),
+                      min(margin, second_sentence_map[gold][2]))
+                     for gold, system, probability, margin in first_sentence_data
+                     if gold in second_sentence_map and system != second_sentence_map[gold][0]]
+        if not differing:
+            continue
+        weighted_failures += max(weight for weight, _ in differing)
+        if all(margin < margin_threshold for _, margin in differing):
+            near_miss_ids.extend([first_id, int(sentence_id)])
+
+    return ((weighted_failures / total_pairs) * 100) / 2, near_miss_ids
+
+
+def evaluate_confidence(file_path, margin_threshold=NEAR_MISS_MARGIN):
+    """
+    Scores a predictions file with its confidence sidecar (written by BERT_prediction.py with with_confidence).
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    - margin_threshold (float): The margin below which a failure is a near miss.
+    Returns:
+    - tuple: The confidence-weighted failure rate and the IDs of the near-miss failures, or None if the file is
+      neither an MFT nor an INV test or has no confidence sidecar (or one with a different number of tokens).
+    """
+    confidence_path = file_path + CONFIDENCE_SUFFIX
+    scorer = scorer_for(os.path.basename(file_path))
+    if scorer is None or not os.path.exists(confidence_path):
+        return None
+    confidences = read_confidences(confidence_path)
+    # A sidecar left behind by an earlier run may belong to other predictions
+    tokens = sum(len(gold_ids) for _, gold_ids, _ in read_prediction_sentences(file_path))
+    if len(confidences) != 2 * tokens:
+        print(f'Warning: {os.path.basename(confidence_path)} does not match its predictions file, '
+              'skipping the confidence scores.')
+        return None
+    scorer = score_mft_confidence if scorer is score_mft else score_inv_confidence
+    return scorer(with_confidences(read_prediction_sentences(file_path), confidences), margin_threshold)
+
+
+def scorer_for(name):
+    """
+    Selects the scoring function of a test from its name.
+    Parameters:
+    - name (str): The name of the predictions file (or of the test, e.g. '{capability}_{test_type}_{version}').
+    Returns:
+    - function: score_mft for MFT tests, score_inv for INV tests, or None for other files.
+    """
+    # Confidence sidecars are named after their predictions file, but are not predictions themselves
+    if name.endswith(CONFIDENCE_SUFFIX):
+        return None
+    if 'MFT' in name:
+        return score_mft
+    elif 'INV' in name:
+        return score_inv
+    return None
+
+
+def evaluate_file(file_path):
+    """
+    Evaluates a predictions file as an MFT or INV test, depending on its filename.
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    Returns:
+    - tuple: The failure rate and failed sentence IDs, or None if the file is neither an MFT nor an INV test.
+    """
+    scorer = scorer_for(os.path.basename(file_path))
+    if scorer is None:
+        return None
+    # Parsing and scoring are interleaved, so they are profiled as one stage
+    with profiler.context(**context_from_filename(file_path)), profiler.stage('parse_and_score'):
+        return scorer(read_prediction_sentences(file_path))
+
+
+def _evaluate_files(directory, filenames, backend, profile):
+    """
+    Evaluates some predictions files of a directory in a worker process (see evaluate_all_files).
+    Returns:
+    - tuple: A dict mapping each filename to its result, and the profiling records of the worker (None if not
+      profiling).
+    """
+    if profile:
+        profiler.enable()
+    if backend == 'numpy':
+        # Imported here so that the pure-Python backend does not need NumPy
+        from evaluation_numpy import evaluate_directory_numpy
+        with profiler.stage('numpy_bulk_score'):
+            results = evaluate_directory_numpy(directory, filenames)
+    else:
+        results = {filename: evaluate_file(os.path.join(directory, filename)) for filename in filenames}
+    return results, profiler.take_records() if profile else None
+
+
+def format_report(results, confidence_results=None):
+    """
+    Formats evaluation results as a report with one line per file, ordered by filename.
+    Parameters:
+    - results (dict): Maps the filename of each predictions file to its (failure rate, failed sentence IDs).
+    - confidence_results (dict): Optionally maps filenames to their (confidence-weighted failure rate, near-miss IDs),
+      which are added to the lines of those files.
+    Returns:
+    - str: The report.
+    """
+    if confidence_results is None:
+        confidence_results = {}
+    lines = []
+    for filename, (failure_rate, failed_sentence_ids) in sorted(results.items()):
+        line = f"File: {filename}, Failure Rate: {failure_rate}%, Failed Sentence IDs: {failed_sentence_ids}"
+        if filename in confidence_results:
+            weighted_failure_rate, near_miss_ids = confidence_results[filename]
+            line += f", Confidence-Weighted Failure Rate: {weighted_failure_rate}%, Near Misses: {near_miss_ids}"
+        lines.append(line + "\n")
+    return ''.join(lines)
+
+
+def evaluate_all_files(directory, backend='python', manifest_path=None, workers=1):
+    """
+    Evaluates all predictions files in a directory and prints the results as one report, ordered by filename.
+    Files with a confidence sidecar also get their confidence-weighted failure rate and near misses reported
+    (see evaluate_confidence).
+    Parameters:
+    - directory (str): The directory with the predictions files.
+    - backend (str): 'python' for the streaming pure-Python evaluation, or 'numpy' for the vectorized
+      evaluation in evaluation_numpy.py, which scores the whole directory in bulk.
+    - manifest_path (str): Optional path to the run manifest. If given, only files whose predictions changed since
+      the last run are scored again; the results of the other files are taken from the manifest.
+    - workers (int): Number of worker processes the files are spread over (None uses one per core, 1 scores
+      everything in this process).
+    Returns:
+    - dict: Maps the filename of each MFT and INV predictions file to its (failure rate, failed sentence IDs).
+    """
+    if backend not in ('python', 'numpy'):
+        raise ValueError(f"Unknown evaluation backend: {backend}")
+    manifest = load_manifest(manifest_path) if manifest_path is not None else None
+
+    results = {}
+    # Files that have to be scored, with the hashes their results depend on
+    pending = {}
+    for filename in sorted(os.listdir(directory)):
+        if scorer_for(filename) is None:
+            continue
+        inputs = None
+        if manifest is not None:
+            inputs = {'predictions': file_hash(os.path.join(directory, filename))}
+            if not unit_changed(manifest, 'evaluate', filename, inputs, []):
+                results[filename] = tuple(manifest['evaluate'][filename]['result'])
+                continue
+        pending[filename] = inputs
+
+    if workers == 1:
+        results.update(_evaluate_files(directory, list(pending), backend, False)[0])
+    else:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # The Python backend scores file by file; the NumPy backend scores one bulk share of the files per worker
+        if backend == 'numpy':
+            shares = [list(pending)[start::workers] for start in range(workers)]
+        else:
+            shares = [[filename] for filename in pending]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_evaluate_files, directory, share, backend, profiler.enabled)
+                       for share in shares if share]
+            for future in futures:
+                share_results, records = future.result()
+                results.update(share_results)
+                if records is not None:
+                    profiler.merge(records)
+
+    if manifest is not None:
+        for filename, inputs in pending.items():
+            record_unit(manifest, 'evaluate', filename, inputs, [], result=list(results[filename]))
+        save_manifest(manifest, manifest_path)
+
+    confidence_results = {}
+    for filename in results:
+        if os.path.exists(os.path.join(directory, filename + CONFIDENCE_SUFFIX)):
+            with profiler.context(**context_from_filename(filename)), profiler.stage('score_confidence'):
+                confidence_result = evaluate_confidence(os.path.join(directory, filename))
+            if confidence_result is not None:
+                confidence_results[filename] = confidence_result
 
-def evaluate_all_files(directory):
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if 'MFT' in filename:
-            failure_rate, failed_sentence_ids = evaluate_mft(file_path)
-            print(f"File: {filename}, Failure Rate: {failure_rate}%, Failed Sentence IDs: {failed_sentence_ids}")
-        elif 'INV' in filename:
-            failure_rate, failed_sentence_ids = evaluate_inv(file_path)
-            print(f"File: {filename}, Failure Rate: {failure_rate}%, Failed Sentence IDs: {failed_sentence_ids}")
+    print(format_report(results, confidence_results), end='')
+    return results
 
-# Call the function
-evaluate_all_files('../predictions')
 
+if __name__ == "__main__":
+    # Where to write a profile of the run, e.g. '../cache/profile_evaluation.json' (None disables profiling)
+    profile_path = None
+    if profile_path is not None:
+        profiler.enable()
+    # Number of worker processes (None uses one per core)
+    workers = None
+    # Call the function, re-scoring only the predictions that changed since the last run
+    evaluate_all_files('../predictions', manifest_path='../cache/manifest.json', workers=workers)
+    if profile_path is not None:
+        profiler.write_report(profile_path)
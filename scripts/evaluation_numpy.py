@@ -0,0 +1,272 @@
+import os
+from array import array
+import numpy as np
+from evaluation import NO_LABEL_ID, evaluate_file, read_prediction_sentences, scorer_for
+from prediction_store import STORE_SUFFIX, PredictionStore
+
+# Padding value for label matrices; it never equals a label id
+PAD_ID = -1
+
+
+def load_flat_labels(file_path):
+    """
+    Loads a predictions file into flat label id arrays.
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    Returns:
+    - tuple: (sentence_ids, gold, system, offsets), where sentence_ids is a list with the ID of each sentence,
+      gold and system hold the label ids of all tokens of the file, and sentence i covers
+      gold[offsets[i]:offsets[i+1]].
+    """
+    if file_path.endswith(STORE_SUFFIX):
+        return load_store_labels(file_path)
+    sentence_ids = []
+    gold = array('H')
+    system = array('H')
+    offsets = array('q', [0])
+    for sentence_id, gold_ids, system_ids in read_prediction_sentences(file_path):
+        sentence_ids.append(sentence_id)
+        gold.extend(gold_ids)
+        system.extend(system_ids)
+        offsets.append(len(gold))
+    return (sentence_ids, np.frombuffer(gold, dtype=np.uint16), np.frombuffer(system, dtype=np.uint16),
+            np.frombuffer(offsets, dtype=np.int64))
+
+
+def load_store_labels(file_path):
+    """
+    Loads a binary prediction store into flat label id arrays (see load_flat_labels).
+    The label arrays are copied out of the memory-mapped file in bulk, without parsing, so that the store can be
+    closed right away.
+    """
+    with PredictionStore(file_path) as store:
+        sentence_ids = [store.string(number) for number in store.sentence_ids]
+        gold = np.array(store.gold, dtype=np.uint8)
+        system = np.array(store.system, dtype=np.uint8)
+        translation = store.label_translation()
+        if translation is not None:
+            translation = np.array(translation, dtype=np.uint16)
+            gold, system = translation[gold], translation[system]
+        offsets = np.array(store.sentence_offsets, dtype=np.int64)
+    return sentence_ids, gold, system, offsets
+
+
+def pad_labels(flat, offsets):
+    """
+    Turns flat label ids into a padded label matrix with one row per sentence.
+    Parameters:
+    - flat (ndarray): The label ids of all tokens.
+    - offsets (ndarray): Sentence offsets into flat (one more than the number of sentences).
+    Returns:
+    - ndarray: An int32 matrix of shape (sentences, longest sentence), padded with PAD_ID.
+    """
+    lengths = np.diff(offsets)
+    width = int(lengths.max()) if len(lengths) else 0
+    matrix = np.full((len(lengths), width), PAD_ID, dtype=np.int32)
+    # Fill each row with the labels of its sentence, left-aligned
+    matrix[np.arange(width) < lengths[:, None]] = flat
+    return matrix
+
+
+def mft_failures(gold, system):
+    """
+    Computes the MFT failure mask of padded label matrices.
+    Parameters:
+    - gold (ndarray): Padded gold label matrix.
+    - system (ndarray): Padded system label matrix.
+    Returns:
+    - ndarray: A boolean array that is True for each sentence in which a token with a relevant gold label
+      (not '_') got a different system label.
+    """
+    evaluated = (gold != NO_LABEL_ID) & (gold != PAD_ID)
+    return np.any(evaluated & (gold != system), axis=1)
+
+
+def inv_pairs(gold):
+    """
+    Finds the sentence pairs of an INV test: consecutive sentences with at least one relevant gold label.
+    Parameters:
+    - gold (ndarray): Padded gold label matrix.
+    Returns:
+    - tuple: Row indices of the first and of the second sentence of each pair.
+    """
+    rows = np.flatnonzero(np.any((gold != NO_LABEL_ID) & (gold != PAD_ID), axis=1))
+    # Making sure that the number of input sentences is even
+    if len(rows) % 2 != 0:
+        print('Warning: uneven number of sentences!')
+        rows = rows[:-1]
+    return rows[0::2], rows[1::2]
+
+
+def inv_failures(first_gold, first_system, second_gold, second_system):
+    """
+    Computes the INV failure mask of sentence pairs given as padded label matrices.
+    A pair fails if a token of the first sentence got a different system label than the (last) token with the
+    same gold label in the second sentence.
+    Parameters:
+    - first_gold, first_system (ndarray): Padded label matrices of the first sentence of each pair.
+    - second_gold, second_system (ndarray): Padded label matrices of the second sentence of each pair.
+    Returns:
+    - ndarray: A boolean array that is True for each failed pair.
+    """
+    # Hide tokens with gold label '_' and padding, using different values so that they never match each other
+    first_gold = np.where(first_gold == NO_LABEL_ID, PAD_ID, first_gold)
+    second_gold = np.where((second_gold == NO_LABEL_ID) | (second_gold == PAD_ID), PAD_ID - 1, second_gold)
+    # matches[p, i, j] tells whether token i of the first sentence has the gold label of token j of the second
+    matches = first_gold[:, :, None] == second_gold[:, None, :]
+    found = np.any(matches, axis=2)
+    # The gold-to-system map of the second sentence keeps the last token with each gold label
+    width = second_gold.shape[1]
+    last_match = width - 1 - np.argmax(matches[:, :, ::-1], axis=2)
+    mapped_system = np.take_along_axis(second_system, last_match, axis=1)
+    return np.any(found & (first_system != mapped_system), axis=1)
+
+
+def score_mft_numpy(sentence_ids, gold, system):
+    """
+    Scores padded label matrices as a Minimum Functionality Test (MFT).
+    Returns:
+    - tuple: Contains the failure rate (as a percentage) and a list of sentence IDs that failed the MFT.
+    """
+    failed = mft_failures(gold, system)
+    failure_rate = (int(failed.sum()) / len(sentence_ids)) * 100
+    return failure_rate, [sentence_ids[row] for row in np.flatnonzero(failed)]
+
+
+def score_inv_numpy(sentence_ids, gold, system):
+    """
+    Scores padded label matrices as an Invariance test (INV).
+    Returns:
+    - tuple: Contains the failure rate (as a percentage) and a list of sentence pair IDs that failed the INV test.
+    """
+    first, second = inv_pairs(gold)
+    failed = inv_failures(gold[first], system[first], gold[second], system[second])
+    failed_sentence_ids = []
+    for pair in np.flatnonzero(failed):
+        failed_sentence_ids.extend([int(sentence_ids[first[pair]]), int(sentence_ids[second[pair]])])
+    failure_rate = ((int(failed.sum()) / len(first)) * 100) / 2
+    return failure_rate, failed_sentence_ids
+
+
+def evaluate_file_numpy(file_path):
+    """
+    Evaluates a predictions file as an MFT or INV test with the NumPy backend.
+    Parameters:
+    - file_path (str): The path to the file containing the dataset with system predictions.
+    Returns:
+    - tuple: The failure rate and failed sentence IDs, or None if the file is neither an MFT nor an INV test.
+    """
+    filename = os.path.basename(file_path)
+    if scorer_for(filename) is None:
+        return None
+    sentence_ids, gold, system, offsets = load_flat_labels(file_path)
+    gold, system = pad_labels(gold, offsets), pad_labels(system, offsets)
+    if 'MFT' in filename:
+        return score_mft_numpy(sentence_ids, gold, system)
+    return score_inv_numpy(sentence_ids, gold, system)
+
+
+def stack_flat_labels(loaded):
+    """
+    Concatenates the flat label arrays of several files.
+    Parameters:
+    - loaded (list): (sentence_ids, gold, system, offsets) tuples as returned by load_flat_labels.
+    Returns:
+    - tuple: (gold, system, offsets) covering the sentences of all files, in order.
+    """
+    gold = np.concatenate([file_gold for _, file_gold, _, _ in loaded])
+    system = np.concatenate([file_system for _, _, file_system, _ in loaded])
+    offsets = [np.zeros(1, dtype=np.int64)]
+    start = 0
+    for _, file_gold, _, file_offsets in loaded:
+        offsets.append(file_offsets[1:] + start)
+        start += len(file_gold)
+    return gold, system, np.concatenate(offsets)
+
+
+def evaluate_directory_numpy(directory, filenames=None):
+    """
+    Evaluates all predictions files of a directory in bulk with the NumPy backend.
+    The sentences of all MFT files are stacked into one label matrix, and the sentence pairs of all INV files into
+    another, so that every test type is scored with a single set of array operations.
+    Parameters:
+    - directory (str): The directory with the predictions files.
+    - filenames (list): Optional names of the files to evaluate (defaults to all files in the directory).
+    Returns:
+    - dict: Maps each MFT/INV filename to its (failure rate, failed sentence IDs).
+    """
+    if filenames is None:
+        filenames = os.listdir(directory)
+    mft_files = []
+    inv_files = []
+    for filename in sorted(filenames):
+        if scorer_for(filename) is None:
+            continue
+        if 'MFT' in filename:
+            mft_files.append(filename)
+        elif 'INV' in filename:
+            inv_files.append(filename)
+
+    results = {}
+
+    # Stack the sentences of all MFT files, remembering which rows belong to which file
+    loaded = [load_flat_labels(os.path.join(directory, filename)) for filename in mft_files]
+    if loaded:
+        gold, system, offsets = stack_flat_labels(loaded)
+        failed = mft_failures(pad_labels(gold, offsets), pad_labels(system, offsets))
+        row = 0
+        for filename, (sentence_ids, _, _, _) in zip(mft_files, loaded):
+            file_failed = failed[row:row + len(sentence_ids)]
+            row += len(sentence_ids)
+            failure_rate = (int(file_failed.sum()) / len(sentence_ids)) * 100
+            results[filename] = failure_rate, [sentence_ids[index] for index in np.flatnonzero(file_failed)]
+
+    # Pair the sentences within each INV file, then stack the pairs of all files
+    loaded = [load_flat_labels(os.path.join(directory, filename)) for filename in inv_files]
+    if loaded:
+        gold, system, offsets = stack_flat_labels(loaded)
+        gold, system = pad_labels(gold, offsets), pad_labels(system, offsets)
+        firsts = []
+        seconds = []
+        row = 0
+        for sentence_ids, _, _, _ in loaded:
+            first, second = inv_pairs(gold[row:row + len(sentence_ids)])
+            firsts.append(first + row)
+            seconds.append(second + row)
+            row += len(sentence_ids)
+        first, second = np.concatenate(firsts), np.concatenate(seconds)
+        failed = inv_failures(gold[first], system[first], gold[second], system[second])
+        pair = 0
+        row = 0
+        for filename, (sentence_ids, _, _, _), file_first in zip(inv_files, loaded, firsts):
+            file_failed = np.flatnonzero(failed[pair:pair + len(file_first)]) + pair
+            failed_sentence_ids = []
+            for index in file_failed:
+                failed_sentence_ids.extend([int(sentence_ids[first[index] - row]),
+                                            int(sentence_ids[second[index] - row])])
+            failure_rate = ((len(file_failed) / len(file_first)) * 100) / 2
+            results[filename] = failure_rate, failed_sentence_ids
+            pair += len(file_first)
+            row += len(sentence_ids)
+
+    return results
+
+
+def check_backends(directory):
+    """
+    Checks that the NumPy backend gives the same results as the pure-Python evaluation for every file.
+    Parameters:
+    - directory (str): The directory with the predictions files.
+    Returns:
+    - list: The filenames whose results differ between the backends (empty if all agree).
+    """
+    bulk_results = evaluate_directory_numpy(directory)
+    mismatches = []
+    for filename in sorted(os.listdir(directory)):
+        file_path = os.path.join(directory, filename)
+        python_result = evaluate_file(file_path)
+        if python_result is None:
+            continue
+        if python_result != evaluate_file_numpy(file_path) or python_result != bulk_results.get(filename):
+            mismatches.append(filename)
+    return mismatches
@@ -0,0 +1,159 @@
+import copy
+import os
+import torch
+from transformers.modeling_outputs import TokenClassifierOutput
+from BERT_prediction import BACKENDS, backend_fingerprint, index_to_label, load_model, predict_word_labels, \
+    prediction_sentences, read_sentences_from_file
+
+
+def bf16_supported():
+    """
+    Check whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX).
+
+    Returns:
+        True if bf16 inference can be expected to be faster than fp32 on this CPU.
+    """
+    return any(getattr(torch.cpu, check, lambda: False)()
+               for check in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'))
+
+
+class _TracedTokenClassifier(torch.nn.Module):
+    """
+    TorchScript-traced token classification model.
+
+    The model is traced on the first batch it gets, since tracing needs example inputs. The traced
+    graph keeps the batch and sequence dimensions dynamic, so it serves padded batches of any size.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.name_or_path = model.name_or_path
+        self.traced = None
+
+    def forward(self, **inputs):
+        if self.traced is None:
+            with torch.no_grad():
+                self.traced = torch.jit.trace(self.model, example_kwarg_inputs=dict(inputs), strict=False)
+        return TokenClassifierOutput(logits=self.traced(**inputs)['logits'])
+
+
+def prepare_model(model, backend='fp32'):
+    """
+    Prepare a model loaded with load_model for CPU inference with one of the BACKENDS.
+
+    - 'fp32': the model itself, run in fp32 eager mode.
+    - 'int8': a copy with the linear layers dynamically quantized to int8.
+    - 'bf16': a copy with bfloat16 weights (only on CPUs with native bf16 support).
+    - 'trace': the model as a TorchScript graph, traced on the first batch.
+    - 'compile': the model compiled with torch.compile for dynamic shapes.
+
+    The prepared model can be passed to bert_e2e and predict_word_labels like the original one.
+
+    Args:
+        model (AutoModelForTokenClassification): The fp32 model.
+        backend (str): The inference backend.
+
+    Returns:
+        The prepared model.
+    """
+    model.eval()
+    if backend == 'fp32':
+        return model
+    if backend == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == 'bf16':
+        if not bf16_supported():
+            raise ValueError("This CPU has no native bfloat16 support, use another inference backend")
+        return copy.deepcopy(model).to(torch.bfloat16)
+    if backend == 'trace':
+        return _TracedTokenClassifier(model).eval()
+    if backend == 'compile':
+        return torch.compile(model, dynamic=True)
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+
+def count_label_differences(sentence_list, gold_list, baseline_labels_list, word_labels_list):
+    """
+    Count the word labels that differ between two predictions of the same sentences.
+
+    Only the words that are written to the predictions file (see prediction_sentences) are compared.
+
+    Args:
+        sentence_list (list): List of sentences, each a list of words.
+        gold_list (list): List of gold labels for each sentence.
+        baseline_labels_list (list): Baseline word labels for each sentence.
+        word_labels_list (list): Word labels to compare for each sentence.
+
+    Returns:
+        A tuple of the number of differing word labels and the number of compared words.
+    """
+    differences = 0
+    words = 0
+    for (_, baseline_rows), (_, rows) in zip(prediction_sentences(sentence_list, gold_list, baseline_labels_list),
+                                             prediction_sentences(sentence_list, gold_list, word_labels_list)):
+        words += len(rows)
+        differences += sum(baseline_row[3] != row[3] for baseline_row, row in zip(baseline_rows, rows))
+    return differences, words
+
+
+def accuracy_guard(model, tokenizer, input_directory, version, backends=None, batch_size=32):
+    """
+    Compare the predictions of inference backends with the fp32 baseline, file by file.
+
+    Args:
+        model (AutoModelForTokenClassification): The fp32 model.
+        tokenizer (AutoTokenizer): The tokenizer.
+        input_directory (str): Path to the input directory.
+        version (int): Version number of the model; only the input files of this version are compared.
+        backends (tuple): The backends to compare with fp32 (defaults to all other backends this CPU supports).
+        batch_size (int): Maximum number of sentences per forward pass.
+
+    Returns:
+        A dict mapping each backend to a dict from filename to a tuple of the number of word labels that
+        differ from fp32 and the number of compared words.
+    """
+    if backends is None:
+        # prepare_model refuses bf16 on CPUs without native support for it
+        backends = tuple(backend for backend in BACKENDS[1:] if backend != 'bf16' or bf16_supported())
+    prepared_models = {backend: prepare_model(model, backend) for backend in backends}
+    report = {backend: {} for backend in backends}
+    for filename in sorted(os.listdir(input_directory)):
+        if not filename.endswith(f'V{version}.conllu'):
+            continue
+        sentence_list, gold_list = read_sentences_from_file(os.path.join(input_directory, filename))
+        baseline_labels_list = predict_word_labels(model, tokenizer, index_to_label, sentence_list, batch_size)
+        for backend, prepared_model in prepared_models.items():
+            word_labels_list = predict_word_labels(prepared_model, tokenizer, index_to_label, sentence_list,
+                                                   batch_size)
+            report[backend][filename] = count_label_differences(sentence_list, gold_list, baseline_labels_list,
+                                                                word_labels_list)
+    return report
+
+
+def print_accuracy_report(report):
+    """
+    Print the files whose predictions changed and the totals of each backend of an accuracy_guard report.
+    """
+    for backend, files in report.items():
+        for filename, (differences, words) in files.items():
+            if differences:
+                print(f"Backend: {backend}, File: {filename}, Differing Labels: {differences}/{words}")
+        total_differences = sum(differences for differences, _ in files.values())
+        total_words = sum(words for _, words in files.values())
+        print(f"Backend: {backend}, Total Differing Labels: {total_differences}/{total_words} "
+              f"in {sum(1 for differences, _ in files.values() if differences)}/{len(files)} files")
+
+
+if __name__ == "__main__":
+    # Paths to the fine-tuned models for each input format version
+    model_paths = {1: "/home/mumu/VU/PGRD/playground/BERT1_new",
+                   2: "/home/mumu/VU/PGRD/playground/BERT2_new",
+                   3: "/home/mumu/VU/PGRD/playground/BERT3_new"}
+    # Backends to compare with the fp32 baseline
+    backends = ('int8', 'trace') + (('bf16',) if bf16_supported() else ())
+
+    for version, model_path in sorted(model_paths.items()):
+        print(f"Model V{version}:")
+        model, tokenizer = load_model(model_path)
+        print_accuracy_report(accuracy_guard(model, tokenizer, '../dataset/bert_input', version, backends))
@@ -0,0 +1,96 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+from instrumentation import context_from_filename
+from prediction_store import remove_confidences
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_predictions(job, host='127.0.0.1', port=8765, socket_path=None, timeout=None):
+    """
+    Send a prediction job to a running inference server (see inference_server.py).
+
+    This module only uses the standard library, so a client starts without importing torch or transformers.
+
+    Args:
+        job (dict): The job, with the model 'version' and either 'conllu', 'input_file' or 'sentences'
+            (and optionally 'gold').
+        host (str): Host of the server.
+        port (int): Port of the server.
+        socket_path (str): Unix socket of the server, used instead of host and port.
+        timeout (float): Optional timeout in seconds.
+
+    Returns:
+        The predictions in the 5-column format, as a string.
+    """
+    if socket_path is not None:
+        connection = UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('POST', '/predict', json.dumps(job), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        body = response.read().decode('utf-8')
+        if response.status != 200:
+            raise RuntimeError(f"Inference server error {response.status}: {response.reason}")
+        return body
+    finally:
+        connection.close()
+
+
+def predict_file_remote(input_file_path, output_file_path, version=None, **server):
+    """
+    Predict a conllu input file with a running inference server and write the predictions file.
+
+    Args:
+        input_file_path (str): Path to the input file.
+        output_file_path (str): Path to the output file.
+        version (int): Model version; taken from the '_V{version}.conllu' filename if not given.
+        **server: host, port, socket_path or timeout of the server (see request_predictions).
+
+    Raises:
+        ValueError: If no version is given and the filename does not have one.
+    """
+    if version is None:
+        file_version = context_from_filename(input_file_path)['version']
+        if file_version is None or not file_version.startswith('V') or not file_version[1:].isdigit():
+            raise ValueError(f"Cannot tell the model version from the filename {input_file_path!r}, "
+                             f"pass it explicitly (--version)")
+        version = int(file_version[1:])
+    with open(input_file_path, 'r', encoding='utf-8') as input_file:
+        predictions = request_predictions({'version': version, 'conllu': input_file.read()}, **server)
+    with open(output_file_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(predictions)
+    remove_confidences(output_file_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Predict conllu files with a running inference server.')
+    parser.add_argument('input_files', nargs='+', help='bert_input conllu files')
+    parser.add_argument('--output-directory', default='../predictions', help='directory to write the predictions to')
+    parser.add_argument('--version', type=int, help='model version (default: from the filename)')
+    parser.add_argument('--host', default='127.0.0.1', help='host of the server')
+    parser.add_argument('--port', type=int, default=8765, help='port of the server')
+    parser.add_argument('--socket', help='Unix socket of the server')
+    args = parser.parse_args()
+
+    for file_path in args.input_files:
+        predict_file_remote(file_path, os.path.join(args.output_directory, os.path.basename(file_path)), args.version,
+                            host=args.host, port=args.port, socket_path=args.socket)
@@ -0,0 +1,296 @@
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from BERT_prediction import index_to_label, load_model, predict_word_labels, read_sentences, \
+    read_sentences_from_file, write_predictions
+from inference_backends import backend_fingerprint, prepare_model
+from prediction_cache import PredictionCache, model_fingerprint
+
+
+class ModelBatcher:
+    """
+    Serves the predictions of one warm model to any number of client threads.
+
+    Requests are put on a queue and a single thread runs the model. It takes all requests that are
+    waiting (or arrive within max_wait seconds) and predicts their sentences together, so that
+    concurrent clients share forward passes instead of taking turns with half-empty batches.
+    """
+
+    def __init__(self, model, tokenizer, batch_size=32, max_wait=0.005, cache_path=None, fingerprint=None):
+        """
+        Args:
+            model (AutoModelForTokenClassification): The model, already prepared for its inference backend.
+            tokenizer (AutoTokenizer): The tokenizer.
+            batch_size (int): Maximum number of sentences per forward pass.
+            max_wait (float): Seconds to wait for further requests to batch with the first one.
+            cache_path (str): Optional path to the prediction cache database.
+            fingerprint (str): Fingerprint of the model and backend, used to key the prediction cache.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.cache_path = cache_path
+        self.fingerprint = fingerprint
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, sentences):
+        """
+        Predict the word labels of a list of sentences, waiting until they are done.
+
+        Args:
+            sentences (list): List of sentences, each a list of words.
+
+        Returns:
+            A list with the word labels of each sentence (see predict_word_labels).
+        """
+        future = Future()
+        self.requests.put((sentences, future))
+        return future.result()
+
+    def _take_requests(self):
+        """
+        Wait for a request and collect the requests that arrive with it, up to batch_size sentences.
+        """
+        pending = [self.requests.get()]
+        sentences = len(pending[0][0])
+        while sentences < self.batch_size:
+            try:
+                request = self.requests.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            pending.append(request)
+            sentences += len(request[0])
+        return pending
+
+    def _run(self):
+        # SQLite connections belong to the thread that opened them, so the cache is opened here
+        cache = PredictionCache(self.cache_path, self.fingerprint) if self.cache_path is not None else None
+        while True:
+            pending = self._take_requests()
+            sentences = [sentence for request_sentences, _ in pending for sentence in request_sentences]
+            try:
+                word_labels_list = predict_word_labels(self.model, self.tokenizer, index_to_label, sentences,
+                                                       self.batch_size, cache)
+            except Exception:
+                # Predict every request on its own, so that only the request that caused the error fails
+                for request_sentences, future in pending:
+                    try:
+                        future.set_result(predict_word_labels(self.model, self.tokenizer, index_to_label,
+                                                              request_sentences, self.batch_size, cache))
+                    except Exception as error:
+                        future.set_exception(error)
+                continue
+            # Hand every client the predictions of its own sentences
+            start = 0
+            for request_sentences, future in pending:
+                future.set_result(word_labels_list[start:start + len(request_sentences)])
+                start += len(request_sentences)
+
+
+def check_sentences(sentence_list, gold_list):
+    """
+    Check the sentences (and gold labels) of a job before they are batched with those of other jobs.
+
+    Args:
+        sentence_list: The sentences of the job, which must be a list of word lists.
+        gold_list: The gold labels of the job, which must be a list of label lists matching the sentences.
+
+    Raises:
+        ValueError: If either is malformed.
+    """
+    if not isinstance(sentence_list, list) or not isinstance(gold_list, list) or len(gold_list) != len(sentence_list):
+        raise ValueError("'sentences' and 'gold' must be lists of the same length")
+    for sentence, gold in zip(sentence_list, gold_list):
+        if not isinstance(sentence, list) or not all(isinstance(word, str) for word in sentence):
+            raise ValueError("Every sentence must be a list of strings")
+        if not isinstance(gold, list) or len(gold) != len(sentence) \
+                or not all(isinstance(label, str) for label in gold):
+            raise ValueError("Every gold label list must be a list of strings as long as its sentence")
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the inference server.
+
+    GET /health returns the loaded model versions as JSON. POST /predict takes a JSON object with the
+    model 'version' (1, 2 or 3) and either 'conllu' (the text of a bert_input file), 'input_file' (the
+    path to one in the input directory of the server, if it has one) or 'sentences' (a list of word
+    lists, optionally with a matching 'gold' list of label lists), and returns the predictions in the
+    5-column format as plain text.
+    """
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        self._send(200, 'application/json', json.dumps({'versions': sorted(self.server.batchers)}))
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            batcher = self.server.batchers[int(job['version'])]
+            if 'conllu' in job:
+                if not isinstance(job['conllu'], str):
+                    raise ValueError("'conllu' must be the text of a conllu file")
+                sentence_list, gold_list = read_sentences(job['conllu'].splitlines())
+            elif 'input_file' in job:
+                if not isinstance(job['input_file'], str):
+                    raise ValueError("'input_file' must be a path")
+                sentence_list, gold_list = read_sentences_from_file(self.server.input_path(job['input_file']))
+            else:
+                sentence_list = job['sentences']
+                gold_list = job.get('gold')
+                if gold_list is None and isinstance(sentence_list, list):
+                    gold_list = [['_'] * len(sentence) if isinstance(sentence, list) else None
+                                 for sentence in sentence_list]
+                check_sentences(sentence_list, gold_list)
+        except PermissionError as error:
+            self.send_error(403, str(error))
+            return
+        except (ValueError, KeyError, TypeError, OSError) as error:
+            self.send_error(400, f"Invalid job: {error!r}")
+            return
+
+        try:
+            word_labels_list = batcher.predict(sentence_list)
+        except Exception as error:
+            self.send_error(500, f"Prediction failed: {error!r}")
+            return
+        output = io.StringIO()
+        write_predictions(output, sentence_list, gold_list, word_labels_list)
+        self._send(200, 'text/plain; charset=utf-8', output.getvalue())
+
+    def _send(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # Only log errors, a request per checked file would flood the console
+        pass
+
+    def log_error(self, format, *args):
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server listening on a Unix socket, with a thread per connection.
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace the socket file left behind by an earlier server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def input_path_checker(input_directory):
+    """
+    Build the function that resolves the 'input_file' of a job, which only allows files in input_directory.
+
+    Args:
+        input_directory (str): The directory clients may read input files from (None allows none).
+
+    Returns:
+        A function that takes the requested path and returns it resolved, or raises PermissionError.
+    """
+    root = os.path.realpath(input_directory) if input_directory is not None else None
+
+    def input_path(file_path):
+        if root is None:
+            raise PermissionError("This server does not read input files, send 'conllu' instead")
+        # Relative paths are taken relative to the input directory
+        resolved = os.path.realpath(os.path.join(root, file_path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise PermissionError(f"Input files must be in the input directory of the server: {file_path}")
+        return resolved
+
+    return input_path
+
+
+def create_server(model_paths, host='127.0.0.1', port=8765, socket_path=None, batch_size=32, backend='fp32',
+                  cache_path=None, input_directory=None):
+    """
+    Load the models once and create the inference server.
+
+    Args:
+        model_paths (dict): Mapping from version number to model directory.
+        host (str): Host to listen on for HTTP.
+        port (int): Port to listen on for HTTP.
+        socket_path (str): Path of a Unix socket to listen on instead of host and port.
+        batch_size (int): Maximum number of sentences per forward pass.
+        backend (str): Inference backend, one of inference_backends.BACKENDS.
+        cache_path (str): Optional path to the prediction cache database.
+        input_directory (str): Optional directory whose files clients may have predicted by path ('input_file'
+            jobs); without it, such jobs are refused.
+
+    Returns:
+        The server; call serve_forever() on it to start serving.
+    """
+    batchers = {}
+    for version, model_path in sorted(model_paths.items()):
+        model, tokenizer = load_model(model_path)
+        fingerprint = None
+        if cache_path is not None:
+            fingerprint = backend_fingerprint(model_fingerprint(model_path), backend)
+        batchers[version] = ModelBatcher(prepare_model(model, backend), tokenizer, batch_size,
+                                         cache_path=cache_path, fingerprint=fingerprint)
+
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, InferenceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.batchers = batchers
+    server.input_path = input_path_checker(input_directory)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Keep the BERT models warm and serve predictions to local clients.')
+    parser.add_argument('--model', action='append', required=True, metavar='VERSION=PATH',
+                        help='model directory for an input format version, e.g. 1=../models/BERT1 (repeatable)')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--socket', help='Unix socket to listen on instead of host and port')
+    parser.add_argument('--batch-size', type=int, default=32, help='sentences per forward pass')
+    parser.add_argument('--backend', default='fp32', help='inference backend (see inference_backends.py)')
+    parser.add_argument('--cache', help='prediction cache database, e.g. ../cache/predictions.sqlite')
+    parser.add_argument('--input-directory',
+                        help="directory whose files clients may send by path ('input_file' jobs), "
+                             "e.g. ../dataset/bert_input")
+    args = parser.parse_args()
+
+    model_paths = {}
+    for model in args.model:
+        version, model_path = model.split('=', 1)
+        model_paths[int(version)] = model_path
+    inference_server = create_server(model_paths, args.host, args.port, args.socket, args.batch_size, args.backend,
+                                     args.cache, args.input_directory)
+    print(f"Serving models {sorted(model_paths)} on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        inference_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inference_server.server_close()
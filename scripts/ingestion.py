@@ -0,0 +1,241 @@
+import json
+from collections import OrderedDict
+
+# Characters JSON allows between tokens
+_JSON_WHITESPACE = ' \t\n\r'
+
+
+class _JsonStream:
+    """
+    Reads JSON tokens and values from a file incrementally, keeping only the unread part of the
+    current chunk in memory. Values are decoded with json's own raw_decode once they are complete.
+    """
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Read the next chunk, dropping what was read already. Returns False at the end of the file.
+        """
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it ('' at the end of the file).
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _JSON_WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        """
+        Consume the next character, which must be one of characters, and return it.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Invalid JSON dataset: expected one of {characters!r}, got {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decode the next JSON value (a string or an object, as found in the datasets).
+        """
+        self.peek()
+        while True:
+            try:
+                value, self.position = self.decoder.raw_decode(self.buffer, self.position)
+                return value
+            except json.JSONDecodeError:
+                # The value continues in the next chunk
+                if not self._fill():
+                    raise
+
+
+def iter_nested_json_items(json_file, chunk_size=1 << 16, on_test_type=None):
+    """
+    Stream the items of a hierarchical JSON dataset ({capability: {test_type: [item, ...]}}) one at a time,
+    without loading the whole file.
+
+    Args:
+        json_file (str): Path to the JSON file.
+        chunk_size (int): Number of characters read at a time.
+        on_test_type (callable): Optionally called with (capability, test_type) when a test_type starts,
+            before its items, so that test_types without items are noticed too.
+
+    Yields:
+        A tuple (capability, test_type, item) for each item, in file order.
+    """
+    with open(json_file, 'r') as file:
+        stream = _JsonStream(file, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            capability = stream.value()
+            stream.expect(':')
+            stream.expect('{')
+            while stream.peek() != '}':
+                test_type = stream.value()
+                stream.expect(':')
+                stream.expect('[')
+                if on_test_type is not None:
+                    on_test_type(capability, test_type)
+                while stream.peek() != ']':
+                    yield capability, test_type, stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+                else:
+                    stream.expect(']')
+                if stream.expect(',}') == '}':
+                    break
+            else:
+                stream.expect('}')
+            if stream.expect(',}') == '}':
+                break
+
+
+def iter_jsonl_items(jsonl_file):
+    """
+    Stream the items of a JSON-Lines dataset, one item per line with its 'capability' and 'test_type' fields.
+
+    Args:
+        jsonl_file (str): Path to the JSON-Lines file.
+
+    Yields:
+        A tuple (capability, test_type, item) for each item, in file order.
+    """
+    with open(jsonl_file, 'r') as file:
+        for line in file:
+            if line.strip():
+                item = json.loads(line)
+                yield item['capability'], item['test_type'], item
+
+
+def iter_dataset_items(dataset_file, on_test_type=None):
+    """
+    Stream the items of a dataset, read as JSON-Lines if its name ends with '.jsonl' and as hierarchical
+    JSON otherwise.
+
+    Args:
+        dataset_file (str): Path to the dataset.
+        on_test_type (callable): Optionally called with (capability, test_type) when a test_type of a hierarchical
+            JSON dataset starts (see iter_nested_json_items). JSON-Lines datasets have no test_types without items.
+
+    Yields:
+        A tuple (capability, test_type, item) for each item, in file order.
+    """
+    if dataset_file.endswith('.jsonl'):
+        return iter_jsonl_items(dataset_file)
+    return iter_nested_json_items(dataset_file, on_test_type=on_test_type)
+
+
+def json_to_jsonl(json_file, jsonl_file):
+    """
+    Convert a hierarchical JSON dataset to JSON-Lines, streaming item by item.
+
+    Items get 'capability' and 'test_type' fields if they do not have them yet.
+    """
+    with open(jsonl_file, 'w') as output_file:
+        for capability, test_type, item in iter_nested_json_items(json_file):
+            item.setdefault('capability', capability)
+            item.setdefault('test_type', test_type)
+            output_file.write(json.dumps(item) + '\n')
+
+
+class ConlluWriters:
+    """
+    Buffered writers for many CoNLL-U files that receive their sentences interleaved, e.g. from a JSON-Lines
+    dataset whose test_types are not contiguous.
+
+    At most max_open files are open at a time; when another one is needed, the least recently used file is
+    closed and later reopened for appending. Every file is truncated when it is first written in a run.
+    Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, max_open=64, buffer_size=1 << 20):
+        """
+        Args:
+            max_open (int): Maximum number of files open at a time.
+            buffer_size (int): Write buffer size of each open file in bytes.
+        """
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        # Open files by path, least recently used first
+        self.files = OrderedDict()
+        # Paths written in this run, in the order they were first written
+        self.paths = []
+        self._started = set()
+        # Paths that have a sentence already
+        self._nonempty = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _file(self, path):
+        file = self.files.get(path)
+        if file is not None:
+            self.files.move_to_end(path)
+            return file
+        if len(self.files) >= self.max_open:
+            self.files.popitem(last=False)[1].close()
+        file = open(path, 'a' if path in self._started else 'w', buffering=self.buffer_size)
+        self.files[path] = file
+        return file
+
+    def create(self, path):
+        """
+        Create (or truncate) a file without writing to it yet, so that it exists even if no sentence is written
+        to it, as for a test_type without items.
+
+        Args:
+            path (str): Path to the file.
+
+        Returns:
+            The open file.
+        """
+        file = self._file(path)
+        if path not in self._started:
+            self._started.add(path)
+            self.paths.append(path)
+        return file
+
+    def write_sentence(self, path, lines):
+        """
+        Append the CoNLL-U lines of a sentence to a file, separated from the previous sentence by an empty line.
+
+        Args:
+            path (str): Path to the file.
+            lines (list): The lines of the sentence (see preprocess.conllu_lines).
+        """
+        file = self.create(path)
+        if path in self._nonempty:
+            file.write('\n')
+        else:
+            self._nonempty.add(path)
+        file.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        """
+        Flush and close all open files.
+        """
+        while self.files:
+            self.files.popitem()[1].close()
@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Context manager returned while profiling is off, so that instrumented code pays almost nothing
+_NO_STAGE = nullcontext()
+
+
+def context_from_filename(filename):
+    """
+    Get the profiling context of a conllu file named '{capability}_{test_type}_V{version}.conllu'.
+
+    Args:
+        filename (str): The name (or path) of the file.
+
+    Returns:
+        A dict with the 'version', 'capability' and 'test_type' of the file (None for parts it does not have).
+    """
+    parts = os.path.basename(filename).rsplit('.', 1)[0].rsplit('_', 2)
+    if len(parts) != 3:
+        return {'version': None, 'capability': None, 'test_type': None}
+    capability, test_type, version = parts
+    return {'version': version, 'capability': capability, 'test_type': test_type}
+
+
+class _Stage:
+    """
+    Context manager that measures one call of a stage.
+    """
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record = self.profiler.stages.setdefault(self.key, [0.0, 0.0, 0])
+        record[0] += time.perf_counter() - self.wall
+        record[1] += time.process_time() - self.cpu
+        record[2] += 1
+        return False
+
+
+class _Context:
+    """
+    Context manager that sets the current context of a profiler.
+    """
+
+    def __init__(self, profiler, context):
+        self.profiler = profiler
+        self.context = context
+
+    def __enter__(self):
+        self.previous = self.profiler.current_context
+        self.profiler.current_context = self.context
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.current_context = self.previous
+        return False
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the checklist pipeline.
+
+    Records the wall time, CPU time and number of calls of each stage, broken down by
+    (model version, capability, test_type), the number of sentences per file and the peak RSS.
+    While disabled, stage() returns a shared no-op context manager and count() returns at once.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # (stage, version, capability, test_type) -> [wall seconds, CPU seconds, calls]
+        self.stages = {}
+        # (version, capability, test_type) -> number of sentences
+        self.sentences = {}
+        # Peak RSS in KiB reported by other processes (see merge)
+        self.peak_rss_kb = 0
+        self.current_context = (None, None, None)
+
+    def enable(self):
+        """
+        Start recording.
+        """
+        self.enabled = True
+
+    def context(self, version=None, capability=None, test_type=None):
+        """
+        Set the (version, capability, test_type) the following stages are attributed to.
+        Use as a context manager; the previous context is restored on exit.
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Context(self, (version, capability, test_type))
+
+    def stage(self, name):
+        """
+        Measure a stage, e.g. `with profiler.stage('forward'): ...`.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, (name,) + self.current_context)
+
+    def count(self, sentences):
+        """
+        Add to the number of sentences of the current context.
+
+        Args:
+            sentences (int): The number of sentences.
+        """
+        if not self.enabled:
+            return
+        self.sentences[self.current_context] = self.sentences.get(self.current_context, 0) + sentences
+
+    def take_records(self):
+        """
+        Remove and return the records collected so far, e.g. to send them from a worker process to the main process.
+
+        Returns:
+            A picklable tuple of the stage records, the sentence counts and the peak RSS of this process.
+        """
+        records = (self.stages, self.sentences, peak_rss_kb())
+        self.stages = {}
+        self.sentences = {}
+        return records
+
+    def merge(self, records):
+        """
+        Add records taken from another profiler (see take_records).
+        """
+        stages, sentences, rss_kb = records
+        for key, (wall, cpu, calls) in stages.items():
+            record = self.stages.setdefault(key, [0.0, 0.0, 0])
+            record[0] += wall
+            record[1] += cpu
+            record[2] += calls
+        for key, count in sentences.items():
+            self.sentences[key] = self.sentences.get(key, 0) + count
+        if rss_kb is not None:
+            self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+
+    def report(self):
+        """
+        Build the profiling report.
+
+        Returns:
+            A JSON-serializable dict with the per-stage records, the per-file sentence counts,
+            the totals per stage and the peak RSS in MiB (None where it cannot be measured).
+        """
+        peak_kb = max(self.peak_rss_kb, peak_rss_kb() or 0)
+        totals = {}
+        for (name, version, capability, test_type), (wall, cpu, calls) in self.stages.items():
+            total = totals.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+            total['wall_seconds'] += wall
+            total['cpu_seconds'] += cpu
+            total['calls'] += calls
+        return {
+            'stages': [{'stage': name, 'version': version, 'capability': capability, 'test_type': test_type,
+                        'wall_seconds': wall, 'cpu_seconds': cpu, 'calls': calls}
+                       for (name, version, capability, test_type), (wall, cpu, calls)
+                       in sorted(self.stages.items(), key=lambda item: [str(part) for part in item[0]])],
+            'files': [{'version': version, 'capability': capability, 'test_type': test_type, 'sentences': count}
+                      for (version, capability, test_type), count
+                      in sorted(self.sentences.items(), key=lambda item: [str(part) for part in item[0]])],
+            'totals': totals,
+            'peak_rss_mb': peak_kb / 1024 if peak_kb else None,
+        }
+
+    def write_report(self, report_path):
+        """
+        Write the profiling report as JSON and print a short summary of it.
+
+        Args:
+            report_path (str): Path to the JSON file.
+        """
+        report = self.report()
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=1)
+
+        print(f"Profile ({report_path}):")
+        for name, total in sorted(report['totals'].items(), key=lambda item: -item[1]['wall_seconds']):
+            print(f"  {name}: {total['wall_seconds']:.3f}s wall, {total['cpu_seconds']:.3f}s CPU, "
+                  f"{total['calls']} calls")
+        peak_rss = f"{report['peak_rss_mb']:.1f} MiB" if report['peak_rss_mb'] is not None else 'unknown'
+        print(f"  sentences: {sum(file['sentences'] for file in report['files'])} in {len(report['files'])} files, "
+              f"peak RSS: {peak_rss}")
+
+
+def peak_rss_kb():
+    """
+    Get the peak resident set size of this process in KiB, or None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports it in bytes, other Unix systems in KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def current_rss_kb():
+    """
+    Get the current resident set size of this process in KiB (the peak where /proc is not available, and None where
+    neither is).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            resident_pages = int(file.read().split()[1])
+    except OSError:
+        return peak_rss_kb()
+    return resident_pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+
+def available_memory_kb():
+    """
+    Get the memory available for new processes in KiB, or None where /proc/meminfo is not available.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# The profiler shared by all modules; disabled unless enable() is called
+profiler = Profiler()
@@ -0,0 +1,32 @@
+# Define a dictionary to map labels to indices
+label_to_index = {'ARG0': 0, 'ARG1': 1, 'ARG1-DSP': 2, 'ARG2': 3, 'ARG3': 4, 'ARG4': 5, 'ARG5': 6, 'ARGA': 7,
+                      'ARGM-ADJ': 8, 'ARGM-ADV': 9, 'ARGM-CAU': 10, 'ARGM-COM': 11, 'ARGM-CXN': 12, 'ARGM-DIR': 13,
+                      'ARGM-DIS': 14, 'ARGM-EXT': 15, 'ARGM-GOL': 16, 'ARGM-LOC': 17, 'ARGM-LVB': 18, 'ARGM-MNR': 19,
+                      'ARGM-MOD': 20, 'ARGM-NEG': 21, 'ARGM-PRD': 22, 'ARGM-PRP': 23, 'ARGM-PRR': 24, 'ARGM-REC': 25,
+                      'ARGM-TMP': 26, 'C-ARG0': 27, 'C-ARG1': 28, 'C-ARG1-DSP': 29, 'C-ARG2': 30, 'C-ARG3': 31,
+                      'C-ARG4': 32, 'C-ARGM-ADV': 33, 'C-ARGM-COM': 34, 'C-ARGM-CXN': 35, 'C-ARGM-DIR': 36,
+                      'C-ARGM-EXT': 37, 'C-ARGM-GOL': 38, 'C-ARGM-LOC': 39, 'C-ARGM-MNR': 40, 'C-ARGM-PRP': 41,
+                      'C-ARGM-PRR': 42, 'C-ARGM-TMP': 43, 'R-ARG0': 44, 'R-ARG1': 45, 'R-ARG2': 46, 'R-ARG3': 47,
+                      'R-ARG4': 48, 'R-ARGM-ADJ': 49, 'R-ARGM-ADV': 50, 'R-ARGM-CAU': 51, 'R-ARGM-COM': 52,
+                      'R-ARGM-DIR': 53, 'R-ARGM-GOL': 54, 'R-ARGM-LOC': 55, 'R-ARGM-MNR': 56, 'R-ARGM-TMP': 57, '_': 58}
+index_to_label = {v: k for k, v in label_to_index.items()}
+
+# Ids of labels that are not in label_to_index (e.g. 'None' for words without a prediction),
+# assigned on first use after the known labels
+extra_label_ids = {}
+
+
+def label_id(label):
+    """
+    Map a label to its integer id, interning labels that are not in label_to_index.
+
+    Args:
+        label (str): The label.
+
+    Returns:
+        The id of the label in label_to_index, or a new id after the known labels for other labels.
+    """
+    index = label_to_index.get(label)
+    if index is None:
+        index = extra_label_ids.setdefault(label, len(label_to_index) + len(extra_label_ids))
+    return index
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+
+# The modules whose code decides the outputs of each stage. A change to any of them redoes all units of the stage,
+# so that e.g. a fix to the scoring code is not hidden behind results recorded before it.
+STAGE_MODULES = {
+    'preprocess': ('preprocess', 'ingestion'),
+    'predict': ('BERT_prediction', 'inference_backends', 'labels', 'prediction_store'),
+    'evaluate': ('evaluation', 'evaluation_numpy', 'labels', 'prediction_store'),
+}
+# Code hash of each stage, computed once per process
+_code_hashes = {}
+
+
+def load_manifest(manifest_path):
+    """
+    Load a run manifest, which records the hashes of the inputs and outputs of every unit of work.
+
+    The manifest maps a stage name ('preprocess', 'predict' or 'evaluate') to a dict of units, e.g.
+    {'predict': {'Locative_MFT-LOC1_V1.conllu': {'inputs': {...}, 'outputs': {...}}}}.
+
+    Args:
+        manifest_path (str): Path to the manifest file.
+
+    Returns:
+        The manifest as a dict (empty if the file does not exist yet).
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Save a run manifest, replacing the previous one only once it is completely written.
+
+    Args:
+        manifest (dict): The manifest.
+        manifest_path (str): Path to the manifest file.
+    """
+    directory = os.path.dirname(manifest_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = manifest_path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(temporary_path, manifest_path)
+
+
+def file_hash(file_path):
+    """
+    Compute the hash of a file's contents.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        The hex digest of the file, or None if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def data_hash(data):
+    """
+    Compute the hash of JSON-serializable data, independent of the order of dict keys.
+
+    Args:
+        data: The data, e.g. the list of items of one test_type.
+
+    Returns:
+        The hex digest of the data.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def stage_code_hash(stage):
+    """
+    Compute the hash of the code of a stage (see STAGE_MODULES).
+
+    Args:
+        stage (str): The stage.
+
+    Returns:
+        The hex digest of the source files of the stage's modules, or None for stages without modules.
+    """
+    if stage not in STAGE_MODULES:
+        return None
+    if stage not in _code_hashes:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        _code_hashes[stage] = data_hash({module: file_hash(os.path.join(directory, module + '.py'))
+                                         for module in STAGE_MODULES[stage]})
+    return _code_hashes[stage]
+
+
+def unit_changed(manifest, stage, unit, inputs, output_paths):
+    """
+    Check whether a unit of work has to be redone.
+
+    Args:
+        manifest (dict): The manifest.
+        stage (str): The stage the unit belongs to.
+        unit (str): The name of the unit.
+        inputs (dict): The hashes of everything the unit's outputs depend on.
+        output_paths (list): Paths to the unit's output files.
+
+    Returns:
+        True if the unit is new, its inputs or the code of its stage changed, or one of its outputs is missing
+        or was modified since it was recorded.
+    """
+    entry = manifest.get(stage, {}).get(unit)
+    if entry is None or entry['inputs'] != inputs or entry.get('code') != stage_code_hash(stage):
+        return True
+    return any(entry['outputs'].get(os.path.basename(path)) != file_hash(path) for path in output_paths)
+
+
+def record_unit(manifest, stage, unit, inputs, output_paths, **extra):
+    """
+    Record a finished unit of work in the manifest.
+
+    Args:
+        manifest (dict): The manifest.
+        stage (str): The stage the unit belongs to.
+        unit (str): The name of the unit.
+        inputs (dict): The hashes of everything the unit's outputs depend on.
+        output_paths (list): Paths to the unit's output files.
+        **extra: Further JSON-serializable fields to store with the unit (e.g. an evaluation result).
+    """
+    entry = {'inputs': inputs, 'code': stage_code_hash(stage),
+             'outputs': {os.path.basename(path): file_hash(path) for path in output_paths}}
+    entry.update(extra)
+    manifest.setdefault(stage, {})[unit] = entry
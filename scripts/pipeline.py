@@ -0,0 +1,97 @@
+import json
+import os
+from array import array
+from preprocess import INPUT_FORMATTERS, prepare_dataset, write_conllu_sentence
+from BERT_prediction import index_to_label, predict_word_labels, prediction_sentences, write_predictions
+from evaluation import scorer_for
+from labels import label_id
+from prediction_store import remove_confidences
+
+
+def evaluation_sentences(sentence_list, gold_list, word_labels_list):
+    """
+    Turn in-memory predictions into the sentence stream the evaluation scorers consume.
+
+    The sentences are the same as read_prediction_sentences would yield from the predictions file
+    written for them by write_predictions.
+
+    Args:
+        sentence_list (list): List of sentences, each a list of words.
+        gold_list (list): List of gold labels for each sentence.
+        word_labels_list (list): List of predicted word labels for each sentence.
+
+    Yields:
+        A tuple (sentence_id, gold_ids, system_ids) for each sentence.
+    """
+    for sentence_id, rows in prediction_sentences(sentence_list, gold_list, word_labels_list):
+        gold_ids = array('H', [label_id(gold_label) for _, _, gold_label, _ in rows])
+        # Labels are compared as they would be written, so a missing prediction becomes 'None'
+        system_ids = array('H', [label_id(str(system_label)) for _, _, _, system_label in rows])
+        yield str(sentence_id), gold_ids, system_ids
+
+
+def run_suite(dataset, models, batch_size=32, formatters=None, input_directory=None, predictions_directory=None):
+    """
+    Run the whole checklist (preprocessing, prediction and evaluation) in memory.
+
+    Tokenized sentences, predicted labels and scores are passed between the stages as Python objects,
+    without writing and re-reading CoNLL-U files. The files can still be written as optional sinks.
+
+    Args:
+        dataset (str or dict): Path to a hierarchical JSON dataset, or the already loaded data.
+        models (dict): Mapping from version suffix (e.g. 'V1') to a (model, tokenizer) tuple.
+        batch_size (int): Maximum number of sentences per forward pass.
+        formatters (dict): Mapping from version suffix to input formatter (defaults to the formatters
+            from INPUT_FORMATTERS for the versions in models).
+        input_directory (str): Optional directory to write the model inputs to ('bert_input' files).
+        predictions_directory (str): Optional directory to write the predictions to.
+
+    Returns:
+        A dict mapping (capability, test_type, version) to the (failure rate, failed sentence IDs) of the
+        test, or to None for tests that are neither MFT nor INV tests.
+    """
+    if isinstance(dataset, (str, os.PathLike)):
+        with open(dataset, 'r') as f:
+            dataset = json.load(f)
+    if formatters is None:
+        formatters = {version: INPUT_FORMATTERS[version] for version in models}
+
+    results = {}
+    for capability, test_type, prepared_items in prepare_dataset(dataset):
+        for version, formatter in formatters.items():
+            name = f'{capability}_{test_type}_{version}'
+            model, tokenizer = models[version]
+
+            # Format the tokenized items as model input
+            sentence_list = []
+            gold_list = []
+            input_file = None
+            if input_directory is not None:
+                input_file = open(os.path.join(input_directory, f'{name}.conllu'), 'w')
+            try:
+                for index, prepared in enumerate(prepared_items):
+                    rows = formatter(prepared)
+                    sentence_list.append([token for token, _ in rows])
+                    gold_list.append([label for _, label in rows])
+                    if input_file is not None:
+                        write_conllu_sentence(input_file, prepared['sentence_id'], rows, index == 0)
+            finally:
+                if input_file is not None:
+                    input_file.close()
+
+            # Predict the word labels
+            word_labels_list = predict_word_labels(model, tokenizer, index_to_label, sentence_list, batch_size)
+            if predictions_directory is not None:
+                with open(os.path.join(predictions_directory, f'{name}.conllu'), 'w',
+                          encoding='utf-8') as output_file:
+                    write_predictions(output_file, sentence_list, gold_list, word_labels_list)
+                remove_confidences(os.path.join(predictions_directory, f'{name}.conllu'))
+
+            # Score the test
+            scorer = scorer_for(name)
+            if scorer is None:
+                results[(capability, test_type, version)] = None
+            else:
+                results[(capability, test_type, version)] = scorer(
+                    evaluation_sentences(sentence_list, gold_list, word_labels_list))
+    return results
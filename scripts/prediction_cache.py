@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from manifest import stage_code_hash
+
+
+def model_fingerprint(model_path):
+    """
+    Compute a fingerprint of a model directory from the names and contents of its files.
+
+    Args:
+        model_path (str): Path to the model directory.
+
+    Returns:
+        The hex digest identifying the model; it changes whenever any weight, config or tokenizer file changes.
+
+    Raises:
+        ValueError: If model_path is not a local directory (e.g. a mistyped path or a Hugging Face hub ID), which
+            would otherwise get the same fingerprint as any other such path.
+    """
+    if not os.path.isdir(model_path):
+        raise ValueError(f"Cannot fingerprint {model_path!r}: not a model directory. The prediction cache and the "
+                         f"run manifest need the model in a local directory.")
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(model_path):
+        # Walk the directory in a fixed order so that the fingerprint does not depend on the file system
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            digest.update(os.path.relpath(file_path, model_path).encode('utf-8'))
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Persistent on-disk cache of word label predictions, stored in an SQLite database.
+
+    Entries are keyed by the model fingerprint, the code of the predict stage (see manifest.stage_code_hash) and a
+    hash of the word sequence, so the same sentence is only predicted once per model, whichever file it appears in,
+    and predictions made by older code are not reused. Several caches (e.g. one per model, or one per worker
+    process) can share the same database file. When the stored predictions grow beyond max_bytes, the least
+    recently used entries are evicted.
+
+    Attributes:
+        hits (int): Number of sentences found in the cache.
+        misses (int): Number of sentences not found in the cache.
+    """
+
+    def __init__(self, cache_path, fingerprint, max_bytes=256 * 1024 * 1024):
+        """
+        Args:
+            cache_path (str): Path to the SQLite database file (created if missing).
+            fingerprint (str): Fingerprint of the model the predictions belong to (see model_fingerprint).
+            max_bytes (int): Maximum total size of the stored predictions.
+        """
+        directory = os.path.dirname(cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Wait for other processes writing to the same database instead of failing
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                '(key TEXT PRIMARY KEY, labels TEXT, size INTEGER, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.connection.commit()
+        self.fingerprint = fingerprint
+        # A change to the prediction code (e.g. to how subtoken labels are pooled) must not hit old entries
+        self.code_hash = stage_code_hash('predict')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, words):
+        """
+        Build the cache key of a sentence.
+
+        Args:
+            words (list): The words of the sentence.
+
+        Returns:
+            The hex digest of the model fingerprint, the prediction code and the word sequence.
+        """
+        digest = hashlib.sha256(self.fingerprint.encode('utf-8'))
+        digest.update(self.code_hash.encode('utf-8'))
+        # Separate the words with a character that cannot occur inside a conllu token
+        digest.update('\t'.join(words).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, sentences):
+        """
+        Look up the word labels of several sentences.
+
+        Args:
+            sentences (list): List of sentences, each a list of words.
+
+        Returns:
+            A list with the cached word labels of each sentence, or None for sentences that are not cached.
+        """
+        keys = [self.key(sentence) for sentence in sentences]
+        found = {}
+        # Query in chunks to stay below SQLite's limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, labels FROM predictions WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            found.update(rows)
+
+        # Mark the found entries as recently used
+        now = time.time()
+        self.connection.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                    [(now, key) for key in found])
+        self.connection.commit()
+
+        results = []
+        for key in keys:
+            if key in found:
+                self.hits += 1
+                results.append(json.loads(found[key]))
+            else:
+                self.misses += 1
+                results.append(None)
+        return results
+
+    def put_many(self, sentences, word_labels_list):
+        """
+        Store the word labels of several sentences and evict old entries if the cache is too large.
+
+        Args:
+            sentences (list): List of sentences, each a list of words.
+            word_labels_list (list): List of predicted word labels for each sentence.
+        """
+        now = time.time()
+        rows = []
+        for sentence, word_labels in zip(sentences, word_labels_list):
+            labels = json.dumps(word_labels)
+            rows.append((self.key(sentence), labels, len(labels), now))
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the stored predictions fit in max_bytes.
+        """
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        excess = total_size - self.max_bytes
+        # Collect the oldest entries until enough space is freed
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM predictions ORDER BY last_used'):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany('DELETE FROM predictions WHERE key = ?', evicted)
+        self.connection.commit()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.connection.close()
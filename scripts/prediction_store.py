@@ -0,0 +1,358 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+from labels import index_to_label, label_id, label_to_index
+
+# Filename suffix of prediction stores, used instead of '.conllu'
+STORE_SUFFIX = '.preds'
+# Suffix appended to the name of a predictions file (of either format) for its confidence sidecar
+CONFIDENCE_SUFFIX = '.conf'
+STORE_MAGIC = b'SRLPRED1'
+# Magic, number of labels, number of strings, size of the string data, number of sentences, number of tokens,
+# size of the label table
+_HEADER = struct.Struct('<8s6Q')
+# The labels of label_to_index, in id order; they start the label table of every store
+_KNOWN_LABELS = [index_to_label[index] for index in range(len(label_to_index))]
+# Stores and sidecars are little-endian; on big-endian machines their arrays are byte-swapped when written and read
+_SWAP_BYTES = sys.byteorder == 'big'
+
+
+def _little_endian_bytes(values):
+    """
+    Get the bytes of an array in little-endian byte order.
+    """
+    if _SWAP_BYTES and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_prediction_store(sentences):
+    """
+    Encode predictions as a binary prediction store.
+
+    Layout (little-endian), after the header:
+    - string offsets (uint32, one more than the number of strings) into the UTF-8 string data
+    - sentence IDs (uint32 string numbers, one per sentence)
+    - sentence offsets (uint32, one more than the number of sentences) into the token arrays
+    - tokens (uint32 string numbers, one per token)
+    - gold and system labels (uint8 label ids, one per token)
+    - the string data and the label table ('\\n'-separated UTF-8)
+
+    Tokens and sentence IDs are interned in the string table. Label ids are those of label_to_index; other labels
+    (e.g. 'None' for words without a prediction) get the following ids, and the label table maps every id back to
+    its label. Token IDs are not stored, they are the positions of the tokens in their sentence.
+
+    Args:
+        sentences (iterable): (sentence_id, rows) tuples with rows of (token_id, token, gold_label, system_label),
+            as yielded by BERT_prediction.prediction_sentences.
+
+    Returns:
+        The prediction store as bytes.
+    """
+    strings = {}
+    labels = {label: index for index, label in enumerate(_KNOWN_LABELS)}
+    sentence_ids = array('I')
+    sentence_offsets = array('I', [0])
+    tokens = array('I')
+    gold = array('B')
+    system = array('B')
+
+    for sentence_id, rows in sentences:
+        sentence_ids.append(strings.setdefault(str(sentence_id), len(strings)))
+        for _, token, gold_label, system_label in rows:
+            tokens.append(strings.setdefault(token, len(strings)))
+            gold.append(labels.setdefault(str(gold_label), len(labels)))
+            system.append(labels.setdefault(str(system_label), len(labels)))
+        sentence_offsets.append(len(tokens))
+    # array('B') raises OverflowError for ids above 255 already, this gives a clearer message
+    if len(labels) > 256:
+        raise ValueError(f"A prediction store holds at most 256 labels, got {len(labels)}")
+
+    string_data = bytearray()
+    string_offsets = array('I', [0])
+    for string in strings:
+        string_data += string.encode('utf-8')
+        string_offsets.append(len(string_data))
+    label_table = '\n'.join(labels).encode('utf-8')
+
+    header = _HEADER.pack(STORE_MAGIC, len(labels), len(strings), len(string_data), len(sentence_ids), len(tokens),
+                          len(label_table))
+    return b''.join([header, _little_endian_bytes(string_offsets), _little_endian_bytes(sentence_ids),
+                     _little_endian_bytes(sentence_offsets), _little_endian_bytes(tokens), gold.tobytes(),
+                     system.tobytes(), bytes(string_data), label_table])
+
+
+def write_prediction_store(file_path, sentences):
+    """
+    Write predictions to a binary prediction store file.
+
+    Args:
+        file_path (str): Path to the store file.
+        sentences (iterable): (sentence_id, rows) tuples, as yielded by BERT_prediction.prediction_sentences.
+    """
+    with open(file_path, 'wb') as file:
+        file.write(encode_prediction_store(sentences))
+
+
+class PredictionStore:
+    """
+    Read-only view of a binary prediction store (see encode_prediction_store).
+
+    The file is memory-mapped and its arrays are exposed as memoryviews into the mapping, so opening a
+    store does not parse or copy anything; only the strings that are asked for are decoded. (On big-endian
+    machines, the arrays of more than one byte per item are copied and byte-swapped instead.)
+
+    Attributes:
+        labels (list): The label of each label id used in the store.
+        sentence_offsets (memoryview): Offsets of the sentences into tokens, gold and system.
+        tokens (memoryview): The string number of every token.
+        gold (memoryview): The gold label id of every token.
+        system (memoryview): The system label id of every token.
+    """
+
+    def __init__(self, file_path):
+        """
+        Args:
+            file_path (str): Path to the store file.
+        """
+        with open(file_path, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, label_count, string_count, string_bytes, sentence_count, token_count, label_bytes = \
+            _HEADER.unpack_from(self.mapping)
+        if magic != STORE_MAGIC:
+            self.mapping.close()
+            raise ValueError(f"Not a prediction store: {file_path}")
+
+        view = memoryview(self.mapping)
+        position = _HEADER.size
+
+        def section(length, format):
+            nonlocal position
+            size = length * struct.calcsize(format)
+            part = view[position:position + size]
+            position += size
+            if _SWAP_BYTES and format != 'B':
+                values = array(format)
+                values.frombytes(part)
+                values.byteswap()
+                return memoryview(values)
+            return part.cast(format)
+
+        self.string_offsets = section(string_count + 1, 'I')
+        self.sentence_ids = section(sentence_count, 'I')
+        self.sentence_offsets = section(sentence_count + 1, 'I')
+        self.tokens = section(token_count, 'I')
+        self.gold = section(token_count, 'B')
+        self.system = section(token_count, 'B')
+        self.string_data = section(string_bytes, 'B')
+        self.labels = bytes(section(label_bytes, 'B')).decode('utf-8').split('\n')[:label_count]
+        self._views = [view, self.string_offsets, self.sentence_ids, self.sentence_offsets, self.tokens, self.gold,
+                       self.system, self.string_data]
+
+    def __len__(self):
+        return len(self.sentence_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Release the memory mapping. If label id views handed out by the store are still in use,
+        the mapping is released once they are gone instead.
+        """
+        for view in reversed(self._views):
+            view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass
+
+    def string(self, number):
+        """
+        Decode a string of the string table.
+        """
+        return str(self.string_data[self.string_offsets[number]:self.string_offsets[number + 1]], 'utf-8')
+
+    def label_translation(self):
+        """
+        Get the translation from the label ids of this store to labels.label_id ids.
+
+        Returns:
+            None if the ids are the same (the store only uses labels of label_to_index), else a list
+            with the labels.label_id of every label id of the store.
+        """
+        if len(self.labels) <= len(label_to_index):
+            return None
+        return [label_id(label) for label in self.labels]
+
+    def sentences(self):
+        """
+        Decode the predictions sentence by sentence.
+
+        Yields:
+            A tuple (sentence_id, rows) for each sentence, where rows is a list of
+            (token_id, token, gold_label, system_label) tuples, as yielded by BERT_prediction.prediction_sentences.
+        """
+        for sentence, sentence_id in enumerate(self.sentence_ids):
+            start, end = self.sentence_offsets[sentence], self.sentence_offsets[sentence + 1]
+            rows = [(token_id, self.string(token), self.labels[gold], self.labels[system])
+                    for token_id, (token, gold, system)
+                    in enumerate(zip(self.tokens[start:end], self.gold[start:end], self.system[start:end]), start=1)]
+            yield self.string(sentence_id), rows
+
+    def label_id_sentences(self):
+        """
+        Stream the label ids of every sentence, without decoding the tokens.
+
+        Yields:
+            A tuple (sentence_id, gold_ids, system_ids) for each sentence, as evaluation.read_prediction_sentences
+            does. The label ids are labels.label_id ids; they are memoryviews into the file unless the store
+            uses labels outside label_to_index.
+        """
+        translation = self.label_translation()
+        for sentence, sentence_id in enumerate(self.sentence_ids):
+            start, end = self.sentence_offsets[sentence], self.sentence_offsets[sentence + 1]
+            gold, system = self.gold[start:end], self.system[start:end]
+            if translation is not None:
+                gold = array('H', [translation[index] for index in gold])
+                system = array('H', [translation[index] for index in system])
+            yield self.string(sentence_id), gold, system
+
+
+def encode_confidences(sentences):
+    """
+    Encode the confidences of word labels as a confidence sidecar.
+
+    The sidecar holds two little-endian float32 values per token of the predictions file, in the same
+    order: the probability of the token's system label and its margin over the most probable other label.
+    Tokens without a prediction get NaN for both.
+
+    Args:
+        sentences (iterable): (sentence_id, rows) tuples as yielded by BERT_prediction.prediction_sentences for the
+            word confidences, i.e. with the (probability, margin) of the word (or None) as the last element of each row.
+
+    Returns:
+        The sidecar as bytes.
+    """
+    values = array('f')
+    for _, rows in sentences:
+        for row in rows:
+            values.extend(row[3] if row[3] is not None else (float('nan'), float('nan')))
+    return _little_endian_bytes(values)
+
+
+def write_confidences(file_path, sentences):
+    """
+    Write the confidence sidecar of a predictions file (see encode_confidences).
+    """
+    with open(file_path, 'wb') as file:
+        file.write(encode_confidences(sentences))
+
+
+def remove_confidences(predictions_path):
+    """
+    Remove the confidence sidecar of a predictions file, if there is one, so that predictions written without
+    confidences are not scored with those of an earlier run.
+    """
+    if os.path.exists(predictions_path + CONFIDENCE_SUFFIX):
+        os.remove(predictions_path + CONFIDENCE_SUFFIX)
+
+
+def read_confidences(file_path):
+    """
+    Read a confidence sidecar.
+
+    Args:
+        file_path (str): Path to the sidecar (the predictions file path followed by CONFIDENCE_SUFFIX).
+
+    Returns:
+        An array('f') with the probability and the margin of every token, interleaved.
+    """
+    values = array('f')
+    with open(file_path, 'rb') as file:
+        values.frombytes(file.read())
+    if _SWAP_BYTES:
+        values.byteswap()
+    return values
+
+
+def read_conllu_predictions(file_path):
+    """
+    Read a predictions file in the 5-column conllu layout.
+
+    Args:
+        file_path (str): Path to the predictions file.
+
+    Yields:
+        A tuple (sentence_id, rows) for each sentence, with rows of (token_id, token, gold_label, system_label).
+    """
+    sentence_id = None
+    rows = []
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip() == "":
+                if sentence_id is not None:
+                    yield sentence_id, rows
+                    sentence_id = None
+                    rows = []
+                continue
+            current_id, token_id, token, gold_label, system_label = line.strip().split('\t')
+            if sentence_id is None:
+                sentence_id = current_id
+            rows.append((int(token_id), token, gold_label, system_label))
+    if sentence_id is not None:
+        yield sentence_id, rows
+
+
+def conllu_to_store(conllu_path, store_path):
+    """
+    Convert a predictions file from the conllu layout to a prediction store.
+    """
+    write_prediction_store(store_path, read_conllu_predictions(conllu_path))
+
+
+def store_to_conllu(store_path, conllu_path):
+    """
+    Convert a prediction store to a predictions file in the conllu layout, as BERT_prediction.write_predictions
+    would have written it.
+    """
+    with PredictionStore(store_path) as store, open(conllu_path, 'w', encoding='utf-8') as output_file:
+        for sentence_id, rows in store.sentences():
+            for token_id, token, gold_label, system_label in rows:
+                output_file.write(f"{sentence_id}\t{token_id}\t{token}\t{gold_label}\t{system_label}\n")
+            output_file.write("\n")
+
+
+def convert_directory(input_directory, output_directory, to_store=True):
+    """
+    Convert all predictions files of a directory between the conllu layout and prediction stores.
+
+    Args:
+        input_directory (str): Directory with the files to convert.
+        output_directory (str): Directory to write the converted files to.
+        to_store (bool): True to convert '.conllu' files to stores, False to convert stores to '.conllu' files.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    suffix, new_suffix = ('.conllu', STORE_SUFFIX) if to_store else (STORE_SUFFIX, '.conllu')
+    convert = conllu_to_store if to_store else store_to_conllu
+    for filename in sorted(os.listdir(input_directory)):
+        if filename.endswith(suffix):
+            convert(os.path.join(input_directory, filename),
+                    os.path.join(output_directory, filename[:-len(suffix)] + new_suffix))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert predictions between the conllu layout and prediction stores.')
+    parser.add_argument('input_directory', help='directory with the predictions to convert')
+    parser.add_argument('output_directory', help='directory to write the converted predictions to')
+    parser.add_argument('--to', choices=['store', 'conllu'], default='store', help='format to convert to')
+    args = parser.parse_args()
+    convert_directory(args.input_directory, args.output_directory, args.to == 'store')
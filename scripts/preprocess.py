@@ -1,142 +1,389 @@
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 from nltk.tokenize import word_tokenize
-nltk.download('punkt')
+from ingestion import ConlluWriters, iter_dataset_items
+from instrumentation import profiler
+from manifest import data_hash, file_hash, load_manifest, record_unit, save_manifest, unit_changed
 
-def preprocess_V1(json_file, output_directory):
-    # Open the hierarchical JSON file and load the data
-    with open(json_file, 'r') as f:
-        data = json.load(f)
+# Whether the NLTK tokenizer data was found (or downloaded) in this process
+_nltk_data_ready = False
+
+def ensure_nltk_data():
+    """
+    Makes sure the NLTK 'punkt' tokenizer data is installed, downloading it only if it is missing.
+    The check is done once per process, so preprocessing does not go to the network on every run.
+    """
+    global _nltk_data_ready
+    if _nltk_data_ready:
+        return
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+    _nltk_data_ready = True
+
+def prepare_dataset(data, streaming=False):
+    """
+    Tokenizes every item of already loaded hierarchical data once.
+
+    Parameters:
+    - data (dict): The hierarchical data, mapping capability to test_type to a list of items.
+    - streaming (bool): If True, the items of each test_type are tokenized lazily, one at a time,
+      instead of being collected in a list. Use this for datasets too large to keep tokenized in memory.
 
+    Yields:
+    - tuple: (capability, test_type, prepared_items), where prepared_items is a list (or a generator
+      in streaming mode) of prepared items as returned by prepare_item.
+    """
+    ensure_nltk_data()
     # Iterate over each capability in the data
     for capability in data:
         # Iterate over each test_type in the capability
         for test_type in data[capability]:
-            # Initialize an empty list for the CoNLL-U format output
-            conllu_output = []
-            # Iterate over each item in the test_type
-            for item in data[capability][test_type]:
-                # Get the 'sentence_id', 'sentence', and 'predicate_id' fields from the item
-                sentence_id = item['sentence_id']
-                sentence = item['sentence']
-                predicate_id = item['predicate_id']
-
-                # Tokenize the sentence using NLTK
-                tokens = word_tokenize(sentence)
-                # Get the predicate from the tokens using the 'predicate_id'
-                predicate = tokens[predicate_id - 1]
-
-                # Prepare the CoNLL-U format output
-                for i, token in enumerate(tokens, start=1):
-                    # Initialize the label as '_' (the default label if the token doesn't match any 'tokenX' field in the item)
-                    label = '_'
-                    # For each key in the item
-                    for key in item.keys():
-                        # If the key starts with 'token' and the token matches the value of the key
-                        if key.startswith('token') and token == item[key]:
-                            # Replace 'token' with 'expected' in the key to get the label key
-                            label_key = key.replace('token', 'expected')
-                            # If the label key is in the item, get the label
-                            if label_key in item:
-                                label = item[label_key]
-                                break  # Stop searching if the token is found
-
-                    # Append the 'sentence_id', token index, token, and label to the output
-                    conllu_output.append(f"{sentence_id}\t{i}\t{token}\t{label}")
-
-                # Add the '[SEP]' token and the predicate after the sentence
-                conllu_output.append(f"{sentence_id}\t{i+1}\t[SEP]\t_")
-                conllu_output.append(f"{sentence_id}\t{i+2}\t{predicate}\t_")
-                # Add an empty line between sentences
-                conllu_output.append('')
-
-            # Write the output to a file named '{capability}_{test_type}_V1.conllu'
-            output = os.path.join(output_directory, f'{capability}_{test_type}_V1.conllu')
-            with open(output, 'w') as f:
-                f.write('\n'.join(conllu_output))
+            prepared_items = (prepare_item(item) for item in data[capability][test_type])
+            if not streaming:
+                with profiler.context(capability=capability, test_type=test_type):
+                    prepared_items = list(prepared_items)
+            yield capability, test_type, prepared_items
 
-def preprocess_V2(json_file, output_directory):
+def prepare_item(item):
     """
-    Preprocesses the given JSON file into a CoNLL-U format for version 2.
+    Tokenizes a single dataset item into the representation shared by all input formatters.
+
+    Parameters:
+    - item (dict): A dataset item with at least 'sentence_id', 'sentence' and 'predicate_id' fields.
+
+    Returns:
+    - dict: The original item, its NLTK tokens, its predicate token and its token-to-label lookup.
+    """
+    # Tokenize the sentence using NLTK
+    with profiler.stage('nltk_tokenize'):
+        tokens = word_tokenize(item['sentence'])
+    return {
+        'item': item,
+        'sentence_id': item['sentence_id'],
+        'tokens': tokens,
+        # Get the predicate from the tokens using the 'predicate_id'
+        'predicate': tokens[item['predicate_id'] - 1],
+        # Compile the expected labels once, so that the formatters can share the lookup
+        'labels': build_label_index(item),
+    }
+
+def build_label_index(item):
+    """
+    Compiles the 'tokenX'/'expectedX' fields of an item into a token-to-label lookup.
+
+    Parameters:
+    - item (dict): The dataset item.
+
+    Returns:
+    - dict: Maps each token value to the value of its 'expectedX' field. If several 'tokenX' fields hold
+      the same token, the first one (in key order) that has an 'expectedX' field wins, as in a key scan.
+      Tokens missing from the lookup get the label '_'.
+    """
+    label_index = {}
+    # For each key in the item
+    for key, value in item.items():
+        # Only 'tokenX' fields with a string value can match a token
+        if key.startswith('token') and isinstance(value, str) and value not in label_index:
+            # Replace 'token' with 'expected' in the key to get the label key
+            label_key = key.replace('token', 'expected')
+            # If the label key is in the item, store the label
+            if label_key in item:
+                label_index[value] = item[label_key]
+    return label_index
+
+def format_V1(prepared):
+    """
+    Formats a prepared item for version 1: the sentence, a [SEP] token and the predicate.
+
+    Parameters:
+    - prepared (dict): A prepared item as returned by prepare_item.
+
+    Returns:
+    - list: The (token, label) rows of the sentence.
+    """
+    labels = prepared['labels']
+    # Get the label of each token, '_' if the token doesn't match any 'tokenX' field in the item
+    rows = [(token, labels.get(token, '_')) for token in prepared['tokens']]
+
+    # Add the '[SEP]' token and the predicate after the sentence
+    rows.append(('[SEP]', '_'))
+    rows.append((prepared['predicate'], '_'))
+    return rows
+
+def format_V2(prepared):
+    """
+    Formats a prepared item for version 2: the sentence, a [SEP] token and the
+    predicate together with its preceding and following token.
+
+    Parameters:
+    - prepared (dict): A prepared item as returned by prepare_item.
+
+    Returns:
+    - list: The (token, label) rows of the sentence.
+    """
+    tokens = prepared['tokens']
+    labels = prepared['labels']
+    rows = [(token, labels.get(token, '_')) for token in tokens]
+
+    # Find the position of the predicate in the tokens
+    predicate_index = tokens.index(prepared['predicate']) + 1
+
+    # Add [SEP] token
+    rows.append(('[SEP]', '_'))
+
+    # Add preceding token, predicate, and token after predicate
+    for j in range(predicate_index - 2, predicate_index + 1):
+        if j >= 0 and j < len(tokens):
+            rows.append((tokens[j], labels.get(tokens[j], '_')))
+    return rows
+
+def format_V3(prepared):
+    """
+    Formats a prepared item for version 3: the sentence with the predicate
+    marked by a '[PRED] ' prefix.
+
+    Parameters:
+    - prepared (dict): A prepared item as returned by prepare_item.
+
+    Returns:
+    - list: The (token, label) rows of the sentence.
+    """
+    predicate = prepared['predicate']
+    labels = prepared['labels']
+    predicate_encountered = False
+    rows = []
+
+    for token in prepared['tokens']:
+        # Marking the predicate with the special token if it's the first matching token
+        if token == predicate and not predicate_encountered:
+            token = '[PRED] ' + token
+            predicate_encountered = True
+        rows.append((token, labels.get(token, '_')))
+    return rows
+
+def conllu_lines(sentence_id, rows):
+    """
+    Turns the rows of a sentence into CoNLL-U lines.
+
+    Parameters:
+    - sentence_id (int): The ID of the sentence.
+    - rows (list): The (token, label) rows of the sentence, as returned by a formatter.
+
+    Returns:
+    - list: A line with the 'sentence_id', token index, token, and label for each row.
+    """
+    return [f"{sentence_id}\t{i}\t{token}\t{label}" for i, (token, label) in enumerate(rows, start=1)]
+
+def write_conllu_sentence(output_file, sentence_id, rows, first):
+    """
+    Writes the CoNLL-U lines of a sentence to a file.
+
+    Parameters:
+    - output_file (file): The open output file.
+    - sentence_id (int): The ID of the sentence.
+    - rows (list): The (token, label) rows of the sentence, as returned by a formatter.
+    - first (bool): Whether this is the first sentence of the file.
+    """
+    # Add an empty line between sentences
+    if not first:
+        output_file.write('\n')
+    output_file.write('\n'.join(conllu_lines(sentence_id, rows)) + '\n')
+
+# The input formatters, by the version suffix of the files they write.
+# A new input format only needs a formatter function and an entry here.
+INPUT_FORMATTERS = {
+    'V1': format_V1,
+    'V2': format_V2,
+    'V3': format_V3,
+}
+
+def write_test_type(capability, test_type, prepared_items, output_directory, formatters):
+    """
+    Writes the CoNLL-U files of one test_type, one file per formatter.
+
+    Parameters:
+    - capability (str): The capability of the test_type.
+    - test_type (str): The test_type.
+    - prepared_items (iterable): The prepared items of the test_type (see prepare_dataset).
+    - output_directory (str): The directory the CoNLL-U files are written to.
+    - formatters (dict): Mapping from version suffix to formatter function.
+
+    Returns:
+    - list: The paths of the written files.
+    """
+    # Open one output file per formatter
+    output_files = {}
+    try:
+        for version in formatters:
+            output = os.path.join(output_directory, f'{capability}_{test_type}_{version}.conllu')
+            output_files[version] = open(output, 'w')
+
+        with profiler.context(capability=capability, test_type=test_type):
+            index = -1
+            for index, prepared in enumerate(prepared_items):
+                with profiler.stage('format_and_write'):
+                    for version, formatter in formatters.items():
+                        write_conllu_sentence(output_files[version], prepared['sentence_id'],
+                                              formatter(prepared), index == 0)
+            profiler.count(index + 1)
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+    return [output_file.name for output_file in output_files.values()]
+
+def _preprocess_test_type(capability, test_type, items, output_directory, formatters, streaming, profile):
+    """
+    Tokenizes and writes one test_type in a worker process (see run_pipeline).
+
+    Returns:
+    - tuple: The paths of the written files and the profiling records of the worker (None if not profiling).
+    """
+    if profile:
+        profiler.enable()
+    for _, _, prepared_items in prepare_dataset({capability: {test_type: items}}, streaming):
+        output_paths = write_test_type(capability, test_type, prepared_items, output_directory, formatters)
+    return output_paths, profiler.take_records() if profile else None
+
+def run_pipeline(json_file, output_directory, formatters=None, streaming=False, manifest=None, executor=None):
+    """
+    Preprocesses the given JSON file into CoNLL-U files for several input formats in a single pass.
 
     Parameters:
     - json_file (str): The path to the JSON file to preprocess.
+    - output_directory (str): The directory the CoNLL-U files are written to.
+    - formatters (dict): Mapping from version suffix to formatter function (defaults to INPUT_FORMATTERS).
+    - streaming (bool): If True, items are tokenized and written one at a time instead of per test_type.
+    - manifest (dict): Optional run manifest (see manifest.py). If given, only the test_types whose items changed
+      since the last run (or whose output files are missing or modified) are preprocessed, and the manifest is updated.
+    - executor (ProcessPoolExecutor): Optional process pool. If given, the test_types are tokenized and written
+      on its workers in parallel; the manifest is still updated in dataset order.
 
     The function operates as follows:
-    - Opens the JSON file and loads the data.
-    - Iterates over each capability in the data.
-    - For each capability, it iterates over each test_type.
-    - For each test_type, it iterates over each item.
-    - For each item, it tokenizes the 'sentence' field using NLTK, and prepares a CoNLL-U format output.
-    - Writes the output to a file named '{capability}_{test_type}_V2.conllu'.
+    - Loads the data and tokenizes every item once (see prepare_dataset).
+    - For each test_type, it passes every tokenized item to each formatter.
+    - Writes the output of each formatter to a file named '{capability}_{test_type}_{version}.conllu'.
     """
+    if formatters is None:
+        formatters = INPUT_FORMATTERS
+
     # Open the hierarchical JSON file and load the data
     with open(json_file, 'r') as f:
         data = json.load(f)
 
-    # Iterate over each capability in the data
-    for capability in data:
-        # Iterate over each test_type in the capability
-        for test_type in data[capability]:
-            # Initialize an empty list for the CoNLL-U format output
-            conllu_output = []
-            # Iterate over each item in the test_type
-            for item in data[capability][test_type]:
-                # Get the 'sentence_id', 'sentence', and 'predicate_id' fields from the item
-                sentence_id = item['sentence_id']
-                sentence = item['sentence']
-                predicate_id = item['predicate_id']
-
-                # Tokenize the sentence using NLTK
-                tokens = word_tokenize(sentence)
-                # Get the predicate from the tokens using the 'predicate_id'
-                predicate = tokens[predicate_id - 1]
-
-                # Find the position of the predicate in the tokens
-                predicate_index = tokens.index(predicate) + 1
-
-                # Prepare CoNLL-U format output
-                for i, token in enumerate(tokens, start=1):
-                    # Initialize the label as '_' (the default label if the token doesn't match any 'tokenX' field in the item)
-                    label = '_'
-                    # For each key in the item
-                    for key in item.keys():
-                        # If the key starts with 'token' and the token matches the value of the key
-                        if key.startswith('token') and token == item[key]:
-                            # Replace 'token' with 'expected' in the key to get the label key
-                            label_key = key.replace('token', 'expected')
-                            # If the label key is in the item, get the label
-                            if label_key in item:
-                                label = item[label_key]
-                                break  # Stop searching if the token is found
-
-                    # Append the 'sentence_id', token index, token, and label to the output
-                    conllu_output.append(f"{sentence_id}\t{i}\t{token}\t{label}")
-
-                # Add [SEP] token
-                conllu_output.append(f"{sentence_id}\t{i+1}\t[SEP]\t_")
-
-                # Add preceding token, predicate, and token after predicate
-                for j in range(predicate_index - 2, predicate_index + 1):
-                    if j >= 0 and j < len(tokens):
-                        token = tokens[j]
-                        label = '_'
-                        for key in item.keys():
-                            if key.startswith('token') and token == item[key]:
-                                label_key = key.replace('token', 'expected')
-                                if label_key in item:
-                                    label = item[label_key]
-                                    break
-                        conllu_output.append(f"{sentence_id}\t{i+2}\t{token}\t{label}")
-                        i += 1
-
-                conllu_output.append('')  # Add an empty line between sentences
-
-            # Write output to a file
-            output = os.path.join(output_directory, f'{capability}_{test_type}_V2.conllu')
-            with open(output, 'w') as f:
-                f.write('\n'.join(conllu_output))
+    # Hashes of the inputs of each test_type, used to skip the unchanged ones
+    unit_inputs = {}
+    if manifest is not None:
+        changed_data = {}
+        for capability in data:
+            for test_type in data[capability]:
+                unit = f'{capability}_{test_type}'
+                unit_inputs[unit] = {'items': data_hash(data[capability][test_type]),
+                                     'versions': sorted(formatters)}
+                output_paths = [os.path.join(output_directory, f'{unit}_{version}.conllu') for version in formatters]
+                if unit_changed(manifest, 'preprocess', unit, unit_inputs[unit], output_paths):
+                    changed_data.setdefault(capability, {})[test_type] = data[capability][test_type]
+        data = changed_data
+
+    if executor is None:
+        written = ((capability, test_type,
+                    write_test_type(capability, test_type, prepared_items, output_directory, formatters))
+                   for capability, test_type, prepared_items in prepare_dataset(data, streaming))
+    else:
+        futures = [(capability, test_type,
+                    executor.submit(_preprocess_test_type, capability, test_type, items, output_directory,
+                                    formatters, streaming, profiler.enabled))
+                   for capability in data for test_type, items in data[capability].items()]
+        written = ((capability, test_type, _merge_worker_result(future.result()))
+                   for capability, test_type, future in futures)
+
+    for capability, test_type, output_paths in written:
+        if manifest is not None:
+            unit = f'{capability}_{test_type}'
+            record_unit(manifest, 'preprocess', unit, unit_inputs[unit], output_paths)
+
+def stream_pipeline(dataset_file, output_directory, formatters=None, manifest=None, max_open_files=64):
+    """
+    Preprocesses a dataset into CoNLL-U files item by item, without loading the dataset into memory.
+
+    The items are read with a streaming parser from the hierarchical JSON file or from a JSON-Lines file
+    (one item per line, see ingestion.py), tokenized one at a time and appended to buffered output files,
+    so memory use stays flat however large the dataset is. In a JSON-Lines file the items of a test_type
+    do not have to be contiguous.
+
+    Parameters:
+    - dataset_file (str): The path to the '.json' or '.jsonl' dataset.
+    - output_directory (str): The directory the CoNLL-U files are written to.
+    - formatters (dict): Mapping from version suffix to formatter function (defaults to INPUT_FORMATTERS).
+    - manifest (dict): Optional run manifest. The whole dataset file is one unit of work here: it is skipped
+      if neither the file nor the files written from it changed since the last run.
+    - max_open_files (int): Maximum number of output files open at a time.
+    """
+    if formatters is None:
+        formatters = INPUT_FORMATTERS
+    unit = os.path.basename(dataset_file)
+    if manifest is not None:
+        inputs = {'file': file_hash(dataset_file), 'versions': sorted(formatters)}
+        previous = manifest.get('preprocess', {}).get(unit)
+        output_paths = [os.path.join(output_directory, filename) for filename in previous['outputs']] \
+            if previous is not None else []
+        if previous is not None and not unit_changed(manifest, 'preprocess', unit, inputs, output_paths):
+            return
+
+    ensure_nltk_data()
+    with ConlluWriters(max_open_files) as writers:
+        def create_files(capability, test_type):
+            # Like run_pipeline, write the (possibly empty) files of every test_type
+            for version in formatters:
+                writers.create(os.path.join(output_directory, f'{capability}_{test_type}_{version}.conllu'))
+
+        for capability, test_type, item in iter_dataset_items(dataset_file, create_files):
+            with profiler.context(capability=capability, test_type=test_type):
+                prepared = prepare_item(item)
+                with profiler.stage('format_and_write'):
+                    for version, formatter in formatters.items():
+                        output = os.path.join(output_directory, f'{capability}_{test_type}_{version}.conllu')
+                        writers.write_sentence(output, conllu_lines(prepared['sentence_id'], formatter(prepared)))
+                profiler.count(1)
+
+    if manifest is not None:
+        record_unit(manifest, 'preprocess', unit, inputs, writers.paths)
+
+def _merge_worker_result(result):
+    """
+    Merges the profiling records of a worker result into the profiler and returns the rest of the result.
+    """
+    output_paths, records = result
+    if records is not None:
+        profiler.merge(records)
+    return output_paths
+
+def preprocess_V1(json_file, output_directory):
+    """
+    Preprocesses the given JSON file into a CoNLL-U format for version 1.
+
+    Parameters:
+    - json_file (str): The path to the JSON file to preprocess.
+    - output_directory (str): The directory the CoNLL-U files are written to.
+
+    Writes the output to files named '{capability}_{test_type}_V1.conllu'.
+    """
+    run_pipeline(json_file, output_directory, {'V1': format_V1})
+
+def preprocess_V2(json_file, output_directory):
+    """
+    Preprocesses the given JSON file into a CoNLL-U format for version 2.
+
+    Parameters:
+    - json_file (str): The path to the JSON file to preprocess.
+    - output_directory (str): The directory the CoNLL-U files are written to.
+
+    Writes the output to files named '{capability}_{test_type}_V2.conllu'.
+    """
+    run_pipeline(json_file, output_directory, {'V2': format_V2})
 
 def preprocess_V3(json_file, output_directory):
     """
@@ -144,73 +391,49 @@ def preprocess_V3(json_file, output_directory):
 
     Parameters:
     - json_file (str): The path to the JSON file to preprocess.
+    - output_directory (str): The directory the CoNLL-U files are written to.
 
-    The function operates as follows:
-    - Opens the JSON file and loads the data.
-    - Iterates over each capability in the data.
-    - For each capability, it iterates over each test_type.
-    - For each test_type, it iterates over each item.
-    - For each item, it tokenizes the 'sentence' field using NLTK, and prepares a CoNLL-U format output.
-    - Writes the output to a file named '{capability}_{test_type}_V3.conllu'.
+    Writes the output to files named '{capability}_{test_type}_V3.conllu'.
     """
-    # Open the hierarchical JSON file and load the data
-    with open(json_file, 'r') as f:
-        data = json.load(f)
+    run_pipeline(json_file, output_directory, {'V3': format_V3})
 
-    # Iterate over each capability in the data
-    for capability in data:
-        # Iterate over each test_type in the capability
-        for test_type in data[capability]:
-            # Initialize an empty list for the CoNLL-U format output
-            conllu_output = []
-            # Iterate over each item in the test_type
-            for item in data[capability][test_type]:
-                # Get the 'sentence_id', 'sentence', and 'predicate_id' fields from the item
-                sentence_id = item['sentence_id']
-                sentence = item['sentence']
-                predicate_id = item['predicate_id']
-
-                # Tokenize the sentence using NLTK
-                tokens = word_tokenize(sentence)
-                predicate = tokens[predicate_id - 1]
-                predicate_encountered = False
-
-                # Prepare CoNLL-U format output
-                for i, token in enumerate(tokens, start=1):
-                    # Marking the predicate with the special token if it's the first matching token
-                    if token == predicate and not predicate_encountered:
-                        token = '[PRED] ' + token
-                        predicate_encountered = True
-                    label = '_'  # Default label if token doesn't match any tokenX
-                    for key in item.keys():
-                        if key.startswith('token') and token == item[key]:
-                            label_key = key.replace('token', 'expected')
-                            if label_key in item:
-                                label = item[label_key]
-                                break
-
-                    # Append the 'sentence_id', token index, token, and label to the output
-                    conllu_output.append(f"{sentence_id}\t{i}\t{token}\t{label}")
-                conllu_output.append('')  # Add an empty line between sentences
-
-            # Write output to a file
-            output = os.path.join(output_directory, f'{capability}_{test_type}_V3.conllu')
-            with open(output, 'w') as f:
-                f.write('\n'.join(conllu_output))
-
-def process_all_json_files(directory):
+def process_all_json_files(directory, streaming=False, manifest_path=None, workers=1):
+    """
+    Preprocesses all JSON files in a directory into the 'bert_input' subdirectory.
+
+    Parameters:
+    - directory (str): The directory with the JSON files.
+    - streaming (bool): If True, the JSON files are read, tokenized and written one item at a time (see
+      stream_pipeline), in this process. '.jsonl' files are always streamed.
+    - manifest_path (str): Optional path to the run manifest. If given, only changed test_types are preprocessed.
+    - workers (int): Number of worker processes the test_types are spread over (None uses one per core,
+      1 preprocesses everything in this process).
+    """
     # Create a new directory for the output files
     output_directory = os.path.join(directory, 'bert_input')
     os.makedirs(output_directory, exist_ok=True)
+    manifest = load_manifest(manifest_path) if manifest_path is not None else None
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.jsonl') or (streaming and filename.endswith('.json')):
+                # Stream large datasets item by item
+                stream_pipeline(os.path.join(directory, filename), output_directory, INPUT_FORMATTERS, manifest)
+            elif filename.endswith('.json'):
+                json_file_path = os.path.join(directory, filename)
+                # Load and tokenize the file once, and write all input formats from it
+                run_pipeline(json_file_path, output_directory, INPUT_FORMATTERS, streaming, manifest, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    for filename in os.listdir(directory):
-        if filename.endswith('.json'):
-            json_file_path = os.path.join(directory, filename)
-            # Change the output directory for the preprocess functions
-            preprocess_V1(json_file_path, output_directory)
-            preprocess_V2(json_file_path, output_directory)
-            preprocess_V3(json_file_path, output_directory)
+    if manifest is not None:
+        save_manifest(manifest, manifest_path)
 
 if __name__ == "__main__":
     datasets_directory = "../dataset"
-    process_all_json_files(datasets_directory)
\ No newline at end of file
+    # Number of worker processes (None uses one per core)
+    workers = None
+    # Record what was preprocessed, so that a re-run only redoes the test_types that changed
+    process_all_json_files(datasets_directory, manifest_path='../cache/manifest.json', workers=workers)
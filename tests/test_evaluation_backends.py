@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from evaluation import evaluate_file
+from evaluation_numpy import check_backends
+from prediction_store import conllu_to_store
+
+# Sentences as (id, [(word, gold, system), ...])
+MFT_SENTENCES = [
+    (1, [('The', '_', '_'), ('cat', 'ARG0', 'ARG0'), ('sleeps', '_', '_'), ('.', '_', 'ARG1')]),
+    (2, [('The', '_', '_'), ('dog', 'ARG0', 'ARG1'), ('barks', '_', '_')]),
+    (3, [('Birds', 'ARG0', 'ARG0'), ('sing', '_', '_'), ('songs', 'ARG1', 'ARG1'), ('loudly', 'ARGM-MNR', '_'),
+         ('.', '_', '_')]),
+]
+INV_SENTENCES = [
+    # Both sentences of this pair label ARG0 and ARG1 alike
+    (1, [('John', 'ARG0', 'ARG0'), ('ate', '_', '_'), ('apples', 'ARG1', 'ARG1')]),
+    (2, [('John', 'ARG0', 'ARG0'), ('did', '_', '_'), ('not', '_', '_'), ('eat', '_', '_'),
+         ('apples', 'ARG1', 'ARG1')]),
+    # The second sentence of this pair labels its ARG1 differently
+    (3, [('Mary', 'ARG0', 'ARG0'), ('wrote', '_', '_'), ('letters', 'ARG1', 'ARG1')]),
+    (4, [('Letters', 'ARG1', 'ARG2'), ('were', '_', '_'), ('written', '_', '_'), ('by', '_', '_'),
+         ('Mary', 'ARG0', 'ARG0')]),
+]
+
+
+def write_predictions_file(file_path, sentences):
+    with open(file_path, 'w') as f:
+        f.write('\n'.join('\n'.join(f'{sentence_id}\t{index}\t{word}\t{gold}\t{system}'
+                                    for index, (word, gold, system) in enumerate(tokens, 1)) + '\n'
+                          for sentence_id, tokens in sentences))
+
+
+def test_check_backends_agree(tmp_path):
+    write_predictions_file(tmp_path / 'Test_MFT-A_V1.conllu', MFT_SENTENCES)
+    write_predictions_file(tmp_path / 'Test_MFT-B_V2.conllu', MFT_SENTENCES[:1])
+    write_predictions_file(tmp_path / 'Test_INV-A_V1.conllu', INV_SENTENCES)
+    conllu_to_store(str(tmp_path / 'Test_INV-A_V1.conllu'), str(tmp_path / 'Test_INV-A_V2.preds'))
+    # Files that are neither MFT nor INV tests are skipped
+    write_predictions_file(tmp_path / 'Test_DIR-A_V1.conllu', MFT_SENTENCES)
+
+    assert check_backends(str(tmp_path)) == []
+    # The fixture has failures, so the agreement is not between empty results
+    assert evaluate_file(str(tmp_path / 'Test_MFT-A_V1.conllu')) == ((2 / 3) * 100, ['2', '3'])
+    assert evaluate_file(str(tmp_path / 'Test_INV-A_V2.preds')) == (25.0, [3, 4])